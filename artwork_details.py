@@ -1,9 +1,47 @@
 import rate_limited_requests as requests
 from log_config import logger
 from handle_429 import handle_429_error
+from metadata_cache import metadata_cache
+from single_flight import single_flight
+from pdi_config import config
+from tracing import tracer
+
+
+def get_json(url, headers, cookies):
+    """
+    请求 ajax 接口并解析 JSON，作品详情和分页接口会先查元数据缓存.
+
+    缓存未过期时不发请求；过期时带 If-None-Match / If-Modified-Since 发条件请求，304 则继续使用缓存.
+    """
+    data = metadata_cache.get_fresh(url)
+    if data is not None:
+        return data
+
+    conditional = metadata_cache.conditional_headers(url)
+    response = requests.get(url, headers={**headers, **conditional}, cookies=cookies)
+    if response.status_code == 304 and conditional:
+        data = metadata_cache.revalidate(url)
+        if data is not None:
+            return data
+        # 缓存条目在此期间被淘汰，重新完整请求
+        response = requests.get(url, headers=headers, cookies=cookies)
+    response.raise_for_status()  # 确保请求成功
+
+    data = response.json()  # 解析响应数据
+    metadata_cache.put(url, data, response.headers)
+    return data
 
 
 def fetch_artwork_info(artwork_id, headers, cookies):
+    """
+    获取作品的详细信息，同一作品在一次运行中只请求一次（见 single_flight）.
+    """
+    with tracer.request("fetch_artwork_info", artwork_id=str(artwork_id)):
+        return single_flight.do(("info", str(artwork_id)), lambda: _fetch_artwork_info(artwork_id, headers, cookies),
+                                keep=lambda result: result[0] is not None)
+
+
+def _fetch_artwork_info(artwork_id, headers, cookies):
     """
     获取作品的详细信息，包括用户 ID、用户名、作品标题.
 
@@ -16,21 +54,13 @@ def fetch_artwork_info(artwork_id, headers, cookies):
     返回:
         tuple: 包含用户 ID、用户名、作品标题的元组 (user_id, user_name, illust_title).
     """
-    url = f"https://www.pixiv.net/ajax/illust/{artwork_id}"
+    url = f"{config.api_base}/ajax/illust/{artwork_id}"
     logger.debug(f"正在请求作品 {artwork_id} 的详细信息...")
 
     try:
-        # 发送请求获取作品信息
-        response = requests.get(url, headers=headers, cookies=cookies)
-        response.raise_for_status()  # 确保请求成功
-
-        data = response.json()  # 解析响应数据
-        if data["error"] is False:
-            illust_data = data["body"]
-            logger.info(f"成功获取作品 {artwork_id} 的详细信息")
-            return illust_data["userId"], illust_data["userName"], illust_data["illustTitle"]
-        else:
-            logger.warning(f"作品 {artwork_id} 获取失败，错误信息：{data.get('message', '无详细错误信息')}")
+        # 发送请求获取作品信息（可能来自缓存）
+        data = get_json(url, headers, cookies)
+        return parse_artwork_info(artwork_id, data)
     except requests.exceptions.RequestException as e:
         logger.error(f"请求错误: {e}")
         # handle_429_error(url, headers,cookies)
@@ -38,7 +68,31 @@ def fetch_artwork_info(artwork_id, headers, cookies):
     return None, None, None
 
 
+def parse_artwork_info(artwork_id, data):
+    """
+    解析 /ajax/illust/{id} 的响应数据，线程版与异步版共用.
+
+    返回:
+        tuple: (user_id, user_name, illust_title)，失败时为 (None, None, None).
+    """
+    if data["error"] is False:
+        illust_data = data["body"]
+        logger.info(f"成功获取作品 {artwork_id} 的详细信息")
+        return illust_data["userId"], illust_data["userName"], illust_data["illustTitle"]
+
+    logger.warning(f"作品 {artwork_id} 获取失败，错误信息：{data.get('message', '无详细错误信息')}")
+    return None, None, None
+
+
 def fetch_image_urls(artwork_id, headers, cookies):
+    """
+    获取作品的所有图片 URL 列表，同一作品在一次运行中只请求一次（见 single_flight）.
+    """
+    with tracer.request("fetch_image_urls", artwork_id=str(artwork_id)):
+        return single_flight.do(("pages", str(artwork_id)), lambda: _fetch_image_urls(artwork_id, headers, cookies))
+
+
+def _fetch_image_urls(artwork_id, headers, cookies):
     """
     获取作品的所有图片 URL 列表.
 
@@ -51,22 +105,30 @@ def fetch_image_urls(artwork_id, headers, cookies):
     返回:
         list: 图片 URL 列表.
     """
-    url = f"https://www.pixiv.net/ajax/illust/{artwork_id}/pages"
+    url = f"{config.api_base}/ajax/illust/{artwork_id}/pages"
     logger.debug(f"正在请求作品 {artwork_id} 的图片 URL 列表...")
 
     try:
-        # 发送请求获取图片 URL 列表
-        response = requests.get(url, headers=headers, cookies=cookies)
-        response.raise_for_status()  # 确保请求成功
-
-        data = response.json()  # 解析响应数据
-        if data["error"] is False:
-            img_urls = [page["urls"]["original"] for page in data["body"]]
-            logger.info(f"成功获取作品 {artwork_id} 的 {len(img_urls)} 张图片 URL")
-            return img_urls
-        else:
-            logger.warning(f"作品 {artwork_id} 图片 URL 获取失败，错误信息：{data.get('message', '无详细错误信息')}")
+        # 发送请求获取图片 URL 列表（可能来自缓存）
+        data = get_json(url, headers, cookies)
+        return parse_image_urls(artwork_id, data)
     except requests.exceptions.RequestException as e:
         logger.error(f"请求错误: {e}")
 
     return []
+
+
+def parse_image_urls(artwork_id, data):
+    """
+    解析 /ajax/illust/{id}/pages 的响应数据，线程版与异步版共用.
+
+    返回:
+        list: 图片 URL 列表，失败时为空列表.
+    """
+    if data["error"] is False:
+        img_urls = [page["urls"]["original"] for page in data["body"]]
+        logger.info(f"成功获取作品 {artwork_id} 的 {len(img_urls)} 张图片 URL")
+        return img_urls
+
+    logger.warning(f"作品 {artwork_id} 图片 URL 获取失败，错误信息：{data.get('message', '无详细错误信息')}")
+    return []
@@ -0,0 +1,392 @@
+# async_engine.py
+# 异步下载引擎：在一个事件循环里用协程完成元数据请求和图片传输，替代嵌套的线程池
+import asyncio
+import functools
+import itertools
+import os
+import time
+
+from artwork_details import parse_artwork_info, parse_image_urls
+from artwork_down import artwork_folder_for, record_artwork_failure, record_artwork_pages
+from download import (clean_path, image_path_with_ext, user_id_for, record_file_exists, image_written,
+                      record_image_failure, resume_request_headers, resume_offset, expected_total_length,
+                      resume_state, clear_resume_state)
+from disk_writer import disk_writer
+from bandwidth import bandwidth
+from log_config import logger
+from manifest import manifest
+from library_index import library_index
+from stats import stats
+from metrics import metrics
+from metadata_cache import metadata_cache
+from single_flight import single_flight
+from pdi_config import config
+from handle_429 import controller, THROTTLE_STATUSES
+from rate_limited_requests import _rate_limiter
+from retry_policy import retry_policy, CircuitOpenError, RETRY_STATUSES
+from user_artworks import parse_user_artworks, parse_profile_illusts, prime_artwork_metadata, profile_illusts_urls
+
+
+async def acquire_breaker(url, kind):
+    # 熔断器打开时只挂起当前协程；等待超时按连接错误处理，调用方照常记录失败
+    import aiohttp
+
+    try:
+        return await retry_policy.async_acquire(url, kind)
+    except CircuitOpenError as e:
+        raise aiohttp.ClientConnectionError(str(e)) from e
+
+
+async def acquire_slot(url):
+    # 等待自适应控制器的暂停窗口结束并占用并发名额：名额已满时排队，由 controller.release() 唤醒
+    await controller.async_acquire(url)
+
+
+async def rate_limit(url):
+    # 向共享的令牌桶预约时间点，只挂起当前协程，不占用线程也不持锁等待
+    delay = _rate_limiter.reserve(url)
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+class AsyncEngine:
+    def __init__(self, session, down_path):
+        self.session = session
+        self.down_path = down_path
+        # 同时进行的图片传输数
+        self.transfer_slots = asyncio.Semaphore(config.async_transfers)
+        # 同时处理的作品数：作品多的用户不会一次创建成千上万个协程，作品数与传输数相同足以让传输名额保持占满
+        self.artwork_slots = asyncio.Semaphore(config.async_transfers)
+        # 全局在途字节预算，以数据块为单位
+        self.chunk_slots = asyncio.Semaphore(max(config.max_inflight_bytes // config.chunk_size, 1))
+        self.loop = asyncio.get_running_loop()
+        # 本次运行已经开始下载的作品，USER_IDS 与 ARTWORK_IDS 重叠时只下载一次
+        self.started_artworks = set()
+
+    def release_chunk_slot(self):
+        # 在写盘线程中调用：把归还 chunk_slots 交回事件循环执行
+        try:
+            self.loop.call_soon_threadsafe(self.chunk_slots.release)
+        except RuntimeError:
+            pass  # 事件循环已经结束，不再需要归还
+
+    async def blocking(self, func, *args, **kwargs):
+        # SQLite 查询和提交、目录重命名、stat 等可能阻塞的调用交给线程池，磁盘或 NAS 慢时不卡住其他传输
+        return await self.loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    async def _get_json(self, url):
+        """带元数据缓存的 ajax 请求，对应线程版的 artwork_details.get_json。"""
+        data = await self.blocking(metadata_cache.get_fresh, url)
+        if data is not None:
+            return data
+
+        conditional = await self.blocking(metadata_cache.conditional_headers, url)
+        status, headers, data = await self._request_json(url, conditional)
+        if status == 304 and conditional:
+            data = await self.blocking(metadata_cache.revalidate, url)
+            if data is not None:
+                return data
+            status, headers, data = await self._request_json(url, {})
+        await self.blocking(metadata_cache.put, url, data, headers)
+        return data
+
+    async def _request_json(self, url, extra_headers):
+        """带频率限制和重试的 ajax 请求，对应线程版的 _rate_limited_request。"""
+        import aiohttp
+
+        for attempt in itertools.count():
+            ticket = await acquire_breaker(url, "metadata")
+            await acquire_slot(url)
+            status_code = None
+            retry_after = None
+            started = None
+            delay = None
+            try:
+                await rate_limit(url)
+                started = time.perf_counter()
+                async with self.session.get(url, headers=extra_headers) as response:
+                    status_code = response.status
+                    retry_after = response.headers.get("Retry-After")
+                    if response.status in RETRY_STATUSES or response.status in THROTTLE_STATUSES:
+                        # 429/503 由控制器统一暂停，下一轮 acquire_slot 会等待；5xx 由重试策略退避
+                        delay = retry_policy.failed(url, "metadata", attempt, status=response.status, ticket=ticket)
+                        if delay is not None:
+                            logger.warning(f"请求 {url} 返回 {response.status}，{delay:.1f} 秒后重试")
+                            metrics.count_retry("metadata")
+                    else:
+                        retry_policy.succeeded(url, ticket)  # 404 等结果说明主机正常
+                    if delay is None:
+                        response.raise_for_status()
+                        if response.status == 304:
+                            return response.status, response.headers, None
+                        return response.status, response.headers, await response.json(content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                delay = retry_policy.failed(url, "metadata", attempt, error=e, ticket=ticket)
+                if delay is None:
+                    raise
+                logger.warning(f"请求 {url} 出错：{e}，{delay:.1f} 秒后重试")
+                metrics.count_retry("metadata")
+            finally:
+                controller.release(url, status_code, retry_after)
+                if started is not None:
+                    metrics.observe_request("api", "metadata", time.perf_counter() - started, status_code or "error")
+            await asyncio.sleep(delay)
+
+    async def download_user(self, user_id):
+        import aiohttp
+
+        url = f"{config.api_base}/ajax/user/{user_id}/profile/all"
+        logger.info(f"正在请求用户 {user_id} 的作品信息...")
+        try:
+            artwork_ids = parse_user_artworks(user_id, await self._get_json(url))
+        except aiohttp.ClientError as e:
+            logger.error(f"请求错误: {e}")
+            artwork_ids = []
+
+        if not artwork_ids:
+            logger.warning(f"用户 {user_id} 没有作品可下载，跳过该用户。")
+            return
+
+        artwork_ids = await self.blocking(manifest.pending, artwork_ids, label=f"用户 {user_id}：")
+        artwork_ids = await self.blocking(library_index.pending, artwork_ids, label=f"用户 {user_id}：")
+        await self.fetch_artwork_metadata(user_id, artwork_ids)
+
+        logger.info(f"开始下载用户 {user_id} 的 {len(artwork_ids)} 个作品...")
+        await self.download_artworks(artwork_ids, user_id)
+
+    async def download_artworks(self, artwork_ids, user_id=None):
+        """先占用 artwork_slots 再创建任务，同时进行的作品数不超过 artwork_slots."""
+        tasks = []
+        for artwork_id in artwork_ids:
+            await self.artwork_slots.acquire()
+            tasks.append(asyncio.create_task(self._download_artwork_in_slot(artwork_id, user_id)))
+        await asyncio.gather(*tasks)
+
+    async def _download_artwork_in_slot(self, artwork_id, user_id):
+        try:
+            await self.download_artwork(artwork_id, user_id)
+        finally:
+            self.artwork_slots.release()
+
+    async def fetch_artwork_metadata(self, user_id, artwork_ids):
+        """批量获取作品信息，对应线程版的 user_artworks.fetch_artwork_metadata。"""
+        urls = profile_illusts_urls(user_id, artwork_ids, config.profile_batch_size)
+        if not urls:
+            return
+        works = {}
+        for batch in await asyncio.gather(*(self._fetch_profile_illusts(user_id, url) for url in urls)):
+            works.update(batch)
+        await self.blocking(prime_artwork_metadata, user_id, works, len(artwork_ids))
+
+    async def _fetch_profile_illusts(self, user_id, url):
+        import aiohttp
+
+        try:
+            _, _, data = await self._request_json(url, {})
+            return parse_profile_illusts(user_id, data)
+        except (aiohttp.ClientError, ValueError) as e:
+            logger.warning(f"批量获取用户 {user_id} 的作品信息失败，这一批作品改为逐个请求：{e}")
+            return {}
+
+    async def fetch_artwork_info(self, artwork_id):
+        # 同一作品在一次运行中只请求一次，与线程版共用 single_flight 的结果
+        return await single_flight.async_do(("info", str(artwork_id)), lambda: self._fetch_artwork_info(artwork_id),
+                                            keep=lambda result: result[0] is not None)
+
+    async def _fetch_artwork_info(self, artwork_id):
+        import aiohttp
+
+        try:
+            data = await self._get_json(f"{config.api_base}/ajax/illust/{artwork_id}")
+            return parse_artwork_info(artwork_id, data)
+        except aiohttp.ClientError as e:
+            logger.error(f"请求错误: {e}")
+            return None, None, None
+
+    async def fetch_image_urls(self, artwork_id):
+        return await single_flight.async_do(("pages", str(artwork_id)), lambda: self._fetch_image_urls(artwork_id))
+
+    async def _fetch_image_urls(self, artwork_id):
+        import aiohttp
+
+        try:
+            return parse_image_urls(
+                artwork_id, await self._get_json(f"{config.api_base}/ajax/illust/{artwork_id}/pages"))
+        except aiohttp.ClientError as e:
+            logger.error(f"请求错误: {e}")
+            return []
+
+    async def download_artwork(self, artwork_id, user_id=None):
+        if str(artwork_id) in self.started_artworks:
+            logger.debug(f"作品 {artwork_id} 已在本次运行中下载，跳过重复项")
+            return
+        self.started_artworks.add(str(artwork_id))
+
+        error_dict = config.error_dict
+        illust_title = None
+        try:
+            user_id, user_name, illust_title = await self.fetch_artwork_info(artwork_id)
+
+            if not user_id or not user_name or not illust_title:
+                stats.count_user("download_failed", user_id, "artworks")  # 跳过作品数量
+                logger.warning(f"作品 {artwork_id} 信息获取失败，跳过该作品。")
+                return
+
+            artwork_folder = artwork_folder_for(self.down_path, user_id, user_name, illust_title, artwork_id)
+            logger.debug(f"下载路径:{artwork_folder}")
+            # 用户名或标题改变时沿用已有文件（可能重命名整个目录）
+            await self.blocking(library_index.relocate, artwork_id, artwork_folder)
+
+            img_urls = await self.fetch_image_urls(artwork_id)
+            # 与线程版相同：记录清单和统计，跳过目录索引中已有或磁盘上已存在的页
+            jobs = await self.blocking(record_artwork_pages, artwork_id, user_id, user_name, illust_title,
+                                       artwork_folder, img_urls)
+            await asyncio.gather(*(self.download_image(img_url, save_path) for img_url, save_path in jobs))
+        except Exception as e:
+            record_artwork_failure(artwork_id, user_id, illust_title, e, error_dict)
+
+    async def download_image(self, img_url, save_path, max_retries=None):
+        import aiohttp
+
+        save_path = clean_path(save_path)
+        save_path_with_ext = image_path_with_ext(save_path, img_url)
+
+        if await self.blocking(os.path.exists, save_path_with_ext):
+            await self.blocking(record_file_exists, save_path_with_ext)
+            return
+
+        async with self.transfer_slots:
+            for attempt in itertools.count():
+                ticket = None
+                try:
+                    logger.debug(f"开始下载图片: {img_url} 到 {save_path_with_ext}")
+                    ticket = await acquire_breaker(img_url, "image")
+                    await self._stream_to_file(img_url, save_path_with_ext,
+                                               image_written(img_url, save_path, save_path_with_ext))
+                    retry_policy.succeeded(img_url, ticket)  # 写盘完成后由 image_written 记录成功
+                    return
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = e.__cause__ if isinstance(e.__cause__, CircuitOpenError) else e
+                    status = getattr(e, "status", None) if isinstance(e, aiohttp.ClientResponseError) else None
+                    delay = retry_policy.failed(img_url, "image", attempt, status=status, error=error,
+                                                max_attempts=max_retries, ticket=ticket)
+                    if delay is None:
+                        logger.warning(f"下载失败，不再重试（已尝试 {attempt + 1} 次）: {img_url}")
+                        await self.blocking(record_image_failure, img_url, save_path, save_path_with_ext, e)
+                        return
+                    logger.warning(f"下载失败，{delay:.1f} 秒后重试（第 {attempt + 1} 次重试）: {img_url}")
+                    metrics.count_retry("image")
+                    await asyncio.sleep(delay)
+
+    async def _stream_to_file(self, img_url, save_path_with_ext, on_done):
+        import aiohttp
+
+        job = None
+        written = 0
+        resumable = False
+        status_code = None
+        retry_after = None
+        started = None
+        await acquire_slot(img_url)
+        try:
+            await rate_limit(img_url)
+            started = time.perf_counter()
+            while True:
+                range_headers, offset = await self.blocking(resume_request_headers, save_path_with_ext)
+                async with self.session.get(img_url, headers=range_headers) as response:
+                    if response.status == 416:
+                        await self.blocking(clear_resume_state, save_path_with_ext)  # 续传范围无效，下次从头下载
+                    if response.status >= 400:
+                        status_code = response.status
+                        retry_after = response.headers.get("Retry-After")
+                    response.raise_for_status()
+
+                    requested = offset
+                    offset = resume_offset(response.status, response.headers, offset)
+                    if offset is None:
+                        # 206 的起始位置与续传位置不同：和 416 一样丢弃 .part，不带 Range 重新请求
+                        await self.blocking(clear_resume_state, save_path_with_ext)
+                        content_range = response.headers.get("Content-Range")
+                        if not requested:
+                            raise aiohttp.ClientPayloadError(f"没有请求 Range 却收到 206（{content_range}）")
+                        logger.warning(f"续传位置 {requested} 与响应的 Content-Range（{content_range}）不符，"
+                                       f"重新下载: {img_url}")
+                        continue
+                    total = expected_total_length(response.status, response.headers, offset)
+                    meta = resume_state(img_url, response.headers, total)
+                    resumable = meta is not None
+                    # 写文件交给写盘线程，事件循环只读取网络数据；数据块写入后才归还 chunk_slots
+                    job = disk_writer.open(save_path_with_ext, offset, total, meta)
+                    user_id = user_id_for(save_path_with_ext)
+                    while True:
+                        job.check()
+                        await self.chunk_slots.acquire()
+                        granted = False
+                        try:
+                            await bandwidth.async_acquire(user_id, config.chunk_size)
+                            granted = True
+                            chunk = await response.content.read(config.chunk_size)
+                        except BaseException:
+                            self.chunk_slots.release()
+                            if granted:
+                                bandwidth.refund(user_id, config.chunk_size)
+                            raise
+                        bandwidth.refund(user_id, config.chunk_size - len(chunk))
+                        if not chunk:
+                            self.chunk_slots.release()
+                            break
+                        await job.async_write(chunk, self.release_chunk_slot)
+                        written += len(chunk)
+                break
+
+            if total is not None and offset + written != total:
+                raise aiohttp.ClientPayloadError(f"内容不完整：收到 {offset + written}/{total} 字节")
+            await job.async_finish(on_done)
+            status_code = response.status
+        except BaseException:
+            # 等待已提交的数据块写完；可续传时保留 .part，供重试或下次运行用 Range 继续
+            if job is not None:
+                await job.async_abort()
+            if not resumable:
+                await self.blocking(clear_resume_state, save_path_with_ext)
+            raise
+        finally:
+            controller.release(img_url, status_code, retry_after)
+            if started is not None:
+                metrics.observe_request("image", "image", time.perf_counter() - started, status_code or "error",
+                                        written)
+        return written
+
+    async def run(self, user_ids, artwork_ids, image_jobs=()):
+        tasks = [self.download_user(user_id) for user_id in dict.fromkeys(user_ids)]
+        tasks.append(self.download_artworks(dict.fromkeys(artwork_ids)))
+        tasks += [self.download_image(img_url, save_path) for img_url, save_path in image_jobs]
+        await asyncio.gather(*tasks)
+
+
+async def _run(user_ids, artwork_ids, down_path, image_jobs=()):
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(limit=config.async_transfers + config.artwork_threads)
+    timeout = aiohttp.ClientTimeout(sock_connect=5, sock_read=5)
+    async with aiohttp.ClientSession(headers=config.HEADERS, cookies=config.COOKIES, connector=connector,
+                                     timeout=timeout) as session:
+        await AsyncEngine(session, down_path).run(user_ids, artwork_ids, image_jobs)
+
+
+def run_async_engine(user_ids, artwork_ids, down_path, image_jobs=()):
+    """
+    用异步引擎下载全部用户和作品，以及 image_jobs 中单独的图片 [(img_url, save_path), ...].
+
+    返回:
+        bool: 是否已由异步引擎完成；未安装 aiohttp 时返回 False，由调用方回退到线程引擎。
+    """
+    try:
+        import aiohttp  # noqa: F401
+    except ImportError:
+        logger.error("engine = async 需要安装 aiohttp（pip install aiohttp），将使用线程引擎。")
+        return False
+
+    logger.info(f"使用异步引擎，最多同时传输 {config.async_transfers} 张图片")
+    asyncio.run(_run(user_ids, artwork_ids, down_path, image_jobs))
+    return True
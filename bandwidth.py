@@ -0,0 +1,264 @@
+# bandwidth.py
+# 原图传输的带宽整形：全局每秒字节数上限、可选的按用户上限和按时段的上限，
+# 同时进行的传输按用户轮流分配（max-min 公平），某个用户用不完的带宽立即让给其他用户
+import asyncio
+import collections
+import threading
+import time
+
+from log_config import logger
+
+SCHEDULE_CHECK_INTERVAL = 1.0  # 每秒检查一次当前时段的上限
+BURST_SECONDS = 0.25  # 令牌桶最多积攒的时长，越小越平滑
+
+
+class _Request:
+    __slots__ = ("nbytes", "granted")
+
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+        self.granted = False
+
+
+class _Bucket:
+    # 允许透支的令牌桶：令牌为正时放行一个数据块，透支的部分由之后的时间补上
+    def __init__(self, rate):
+        self.rate = 0.0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self.refill(time.monotonic())
+        unlimited = self.rate <= 0
+        self.rate = float(rate)
+        # 从不限速切换为限速时从满桶开始，否则保留当前令牌
+        self.tokens = self.capacity if unlimited else min(self.tokens, self.capacity)
+
+    @property
+    def capacity(self):
+        return self.rate * BURST_SECONDS
+
+    def refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self):
+        return self.rate <= 0 or self.tokens > 0
+
+    def wait_time(self):
+        return -self.tokens / self.rate if self.rate > 0 and self.tokens <= 0 else 0.0
+
+
+class BandwidthShaper:
+    """
+    原图传输的带宽整形器。
+
+    - 每个传输在读取一个数据块之前调用 acquire(user, nbytes)，读到的不足 nbytes 时用 refund 退回差额；
+    - 等待中的请求按用户轮流放行，同一用户的多个传输按先后顺序放行，各用户得到相同的份额；
+    - 达到自己上限的用户被跳过，没有在传输的用户不参与分配，空出的带宽立即分给其他用户；
+    - schedule 中的时段（如 09:00-18:00）使用该时段的全局上限，其他时间使用 rate.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.base_rate = 0.0
+        self.user_rates = {}  # user_id -> 上限，"*" 为默认值
+        self.schedule = []  # [(开始分钟, 结束分钟, 上限), ...]
+        self.bucket = _Bucket(0)
+        self.users = {}  # user_id -> {"bucket", "queue"}
+        self.round = collections.deque()  # 有请求在等待的用户，轮流放行
+        self.next_schedule_check = 0.0
+        self.reset_stats()
+
+    def configure(self, rate=0, user_rates=None, schedule=None):
+        with self.condition:
+            self.base_rate = float(rate)
+            self.user_rates = dict(user_rates or {})
+            self.schedule = list(schedule or [])
+            self.users.clear()
+            self.round.clear()
+            self.bucket = _Bucket(self.current_rate())
+            self.next_schedule_check = time.monotonic() + SCHEDULE_CHECK_INTERVAL
+            self.condition.notify_all()
+
+    def reset_stats(self):
+        with self.condition:
+            self.bytes = collections.Counter()  # user_id -> 放行的字节数
+            self.waits = 0
+            self.wait_seconds = 0.0
+
+    @property
+    def enabled(self):
+        return bool(self.base_rate or self.user_rates or self.schedule)
+
+    def current_rate(self, now=None):
+        """当前时段的全局上限（字节/秒），0 为不限。"""
+        now = now or time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.schedule:
+            # 结束时间早于开始时间的时段跨过午夜，例如 23:00-07:00
+            if start <= minute < end or (end <= start and (minute >= start or minute < end)):
+                return rate
+        return self.base_rate
+
+    def _check_schedule(self, now):
+        if not self.schedule or now < self.next_schedule_check:
+            return
+        self.next_schedule_check = now + SCHEDULE_CHECK_INTERVAL
+        rate = self.current_rate()
+        if rate != self.bucket.rate:
+            logger.info(f"带宽上限切换为 {format_rate(rate)}")
+            self.bucket.set_rate(rate)
+
+    def _user(self, user):
+        state = self.users.get(user)
+        if state is None:
+            rate = self.user_rates.get(user, self.user_rates.get("*", 0))
+            state = self.users[user] = {"bucket": _Bucket(rate), "queue": collections.deque()}
+        return state
+
+    def _submit(self, user, nbytes):
+        state = self._user(user)
+        request = _Request(nbytes)
+        state["queue"].append(request)
+        if user not in self.round:
+            self.round.append(user)
+        return request
+
+    def _cancel(self, user, request):
+        # 等待期间被中断（异常或协程取消）的请求从队列中移除，避免之后白白占用带宽
+        state = self.users[user]
+        if request in state["queue"]:
+            state["queue"].remove(request)
+            if not state["queue"] and user in self.round:
+                self.round.remove(user)
+
+    def _dispatch(self, now):
+        """在锁内放行当前能放行的请求，返回是否放行了请求。"""
+        self._check_schedule(now)
+        self.bucket.refill(now)
+        granted = False
+        skipped = 0
+        while self.round and skipped < len(self.round) and self.bucket.ready():
+            user = self.round[0]
+            state = self.users[user]
+            state["bucket"].refill(now)
+            if not state["bucket"].ready():
+                self.round.rotate(-1)  # 该用户已达到上限，这一轮让给其他用户
+                skipped += 1
+                continue
+            skipped = 0
+            request = state["queue"].popleft()
+            request.granted = True
+            granted = True
+            if self.bucket.rate > 0:
+                self.bucket.tokens -= request.nbytes
+            if state["bucket"].rate > 0:
+                state["bucket"].tokens -= request.nbytes
+            self.bytes[user] += request.nbytes
+            self.round.popleft()
+            if state["queue"]:
+                self.round.append(user)
+        return granted
+
+    def _wait_time(self):
+        # 距离下一次可能放行的时间：全局令牌或某个等待中用户的令牌变为正数
+        if not self.bucket.ready():
+            return self.bucket.wait_time()
+        waits = [self.users[user]["bucket"].wait_time() for user in self.round]
+        return min(waits, default=0.0) or 0.01
+
+    def acquire(self, user, nbytes):
+        """
+        为 user 的一次读取申请 nbytes 字节的带宽，必要时阻塞.
+
+        返回:
+            float: 等待的秒数.
+        """
+        if not self.enabled:
+            return 0.0
+        started = time.monotonic()
+        with self.condition:
+            request = self._submit(user, nbytes)
+            try:
+                while True:
+                    if self._dispatch(time.monotonic()):
+                        self.condition.notify_all()  # 可能放行了其他线程的请求
+                    if request.granted:
+                        break
+                    self.condition.wait(self._wait_time())
+            finally:
+                if not request.granted:
+                    self._cancel(user, request)
+        return self._record_wait(started)
+
+    async def async_acquire(self, user, nbytes):
+        """acquire 的协程版本，等待时只挂起当前协程。"""
+        if not self.enabled:
+            return 0.0
+        started = time.monotonic()
+        with self.condition:
+            request = self._submit(user, nbytes)
+        try:
+            while True:
+                with self.condition:
+                    if self._dispatch(time.monotonic()):
+                        self.condition.notify_all()
+                    if request.granted:
+                        break
+                    delay = self._wait_time()
+                await asyncio.sleep(min(delay, 0.05))
+        finally:
+            if not request.granted:
+                with self.condition:
+                    self._cancel(user, request)
+        return self._record_wait(started)
+
+    def refund(self, user, nbytes):
+        """退回申请了但没有用到的字节（最后一块不足 nbytes，或读取失败）。"""
+        if not self.enabled or nbytes <= 0:
+            return
+        with self.condition:
+            if self.bucket.rate > 0:
+                self.bucket.tokens = min(self.bucket.capacity, self.bucket.tokens + nbytes)
+            state = self.users.get(user)
+            if state is not None and state["bucket"].rate > 0:
+                state["bucket"].tokens = min(state["bucket"].capacity, state["bucket"].tokens + nbytes)
+            self.bytes[user] -= nbytes
+            self.condition.notify_all()
+
+    def _record_wait(self, started):
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            with self.condition:
+                self.waits += 1
+                self.wait_seconds += waited
+        return waited
+
+    def stats(self):
+        with self.condition:
+            return {
+                "rate": self.bucket.rate,
+                "bytes": dict(self.bytes),
+                "waits": self.waits,
+                "wait_seconds": round(self.wait_seconds, 3),
+            }
+
+    def log_stats(self):
+        if not self.enabled:
+            return
+        shaper_stats = self.stats()
+        logger.info(f"带宽整形：当前上限 {format_rate(shaper_stats['rate'])}，等待 {shaper_stats['waits']} 次，"
+                    f"累计 {shaper_stats['wait_seconds']} 秒")
+        for user, nbytes in sorted(shaper_stats["bytes"].items(), key=lambda item: -item[1]):
+            logger.info(f"带宽整形 用户 {user}: {nbytes / (1024 * 1024):.1f} MB")
+
+
+def format_rate(rate):
+    return f"{rate / (1024 * 1024):.2f} MB/s" if rate else "不限"
+
+
+# 全局带宽整形器
+bandwidth = BandwidthShaper()
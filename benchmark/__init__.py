@@ -0,0 +1,2 @@
+# benchmark
+# 离线吞吐量基准：mock_server 模拟 Pixiv 接口和原图，run 驱动 main.run 的完整下载流程并输出 JSON
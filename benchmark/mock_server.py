@@ -0,0 +1,445 @@
+# benchmark/mock_server.py
+# 本地模拟 Pixiv 服务器：提供用户作品列表、作品详情、分页 URL 和原图，
+# 可配置延迟、带宽、文件大小、429 注入和连接重置，完全离线运行；
+# --http2 时原图改由单独端口上的 h2c（HTTP/2 prior knowledge）服务器提供（需要 pip install h2）
+import argparse
+import hashlib
+import http.server
+import json
+import random
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+# 原图 URL 使用的主机名，与 ajax 接口的 127.0.0.1 区分开，下载端按原图主机处理
+IMAGE_HOSTNAME = "localhost"
+
+
+class MockSettings:
+    """模拟服务器的参数，所有随机行为都由 seed 决定，便于复现。"""
+
+    def __init__(self, users=3, artworks=10, pages=3, size_kb=512, size_jitter=0.0, latency_ms=50.0,
+                 image_latency_ms=30.0, bandwidth_kbps=0.0, throttle_rate=0.0, reset_rate=0.0, error_rate=0.0,
+                 duplicate_rate=0.0, reset_offsets=(), range_skew=0, seed=1):
+        self.users = users  # 用户数，用户 ID 为 1..users
+        self.artworks = artworks  # 每个用户的作品数
+        self.pages = pages  # 每个作品的页数
+        self.size_kb = size_kb  # 原图平均大小（KB）
+        self.size_jitter = size_jitter  # 原图大小的随机浮动比例，0~1
+        self.latency_ms = latency_ms  # ajax 接口响应延迟
+        self.image_latency_ms = image_latency_ms  # 原图首字节延迟
+        self.bandwidth_kbps = bandwidth_kbps  # 每个连接的带宽（KB/s），0 为不限
+        self.throttle_rate = throttle_rate  # ajax 请求返回 429 的概率
+        self.reset_rate = reset_rate  # 原图传输中途断开连接的概率
+        self.error_rate = error_rate  # 原图请求返回 500 的概率
+        self.duplicate_rate = duplicate_rate  # 作品内容与另一个作品相同（转载）的比例
+        self.reset_offsets = list(reset_offsets)  # 依次在原图的这些字节位置断开连接（每个位置用于一次请求），优先于 reset_rate
+        self.range_skew = range_skew  # 续传响应比请求的位置提前这么多字节开始（模拟不按 Range 对齐的缓存）
+        self.seed = seed
+
+    @classmethod
+    def add_arguments(cls, parser):
+        defaults = cls()
+        parser.add_argument("--users", type=int, default=defaults.users)
+        parser.add_argument("--artworks", type=int, default=defaults.artworks, help="每个用户的作品数")
+        parser.add_argument("--pages", type=int, default=defaults.pages, help="每个作品的页数")
+        parser.add_argument("--size-kb", type=int, default=defaults.size_kb, help="原图平均大小（KB）")
+        parser.add_argument("--size-jitter", type=float, default=defaults.size_jitter, help="原图大小浮动比例")
+        parser.add_argument("--latency-ms", type=float, default=defaults.latency_ms, help="ajax 接口延迟")
+        parser.add_argument("--image-latency-ms", type=float, default=defaults.image_latency_ms, help="原图首字节延迟")
+        parser.add_argument("--bandwidth-kbps", type=float, default=defaults.bandwidth_kbps, help="每连接带宽，0 为不限")
+        parser.add_argument("--throttle-rate", type=float, default=defaults.throttle_rate, help="ajax 返回 429 的概率")
+        parser.add_argument("--reset-rate", type=float, default=defaults.reset_rate, help="原图传输中断开的概率")
+        parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="原图返回 500 的概率")
+        parser.add_argument("--duplicate-rate", type=float, default=defaults.duplicate_rate,
+                            help="原图内容与其他作品相同（转载）的作品比例")
+        parser.add_argument("--reset-offsets", type=int, nargs="*", default=defaults.reset_offsets,
+                            help="依次在原图的这些字节位置断开连接")
+        parser.add_argument("--range-skew", type=int, default=defaults.range_skew, help="续传响应起始位置的偏差（字节）")
+        parser.add_argument("--seed", type=int, default=defaults.seed)
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(users=args.users, artworks=args.artworks, pages=args.pages, size_kb=args.size_kb,
+                   size_jitter=args.size_jitter, latency_ms=args.latency_ms, image_latency_ms=args.image_latency_ms,
+                   bandwidth_kbps=args.bandwidth_kbps, throttle_rate=args.throttle_rate, reset_rate=args.reset_rate,
+                   error_rate=args.error_rate, duplicate_rate=args.duplicate_rate, reset_offsets=args.reset_offsets,
+                   range_skew=args.range_skew, seed=args.seed)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    def user_ids(self):
+        return [str(user_id) for user_id in range(1, self.users + 1)]
+
+    def content_id(self, artwork_id):
+        """原图内容的来源：转载的作品使用少数几个“原作”的内容，其余作品使用自己的内容。"""
+        if not self.duplicate_rate:
+            return artwork_id
+        rng = random.Random(f"{self.seed}-duplicate-{artwork_id}")
+        return f"original-{rng.randrange(4)}" if rng.random() < self.duplicate_rate else artwork_id
+
+    def image_size(self, artwork_id, page):
+        if not self.size_jitter:
+            return self.size_kb * 1024
+        rng = random.Random(f"{self.seed}-{artwork_id}-{page}")
+        return max(int(self.size_kb * 1024 * (1 + rng.uniform(-self.size_jitter, self.size_jitter))), 1)
+
+
+def image_body(artwork_id, page, size):
+    """按作品和页码生成确定的图片内容，多次请求结果相同（续传时可以拼接）。"""
+    block = hashlib.sha256(f"{artwork_id}-{page}".encode()).digest() * 128  # 4 KB
+    return (block * (size // len(block) + 1))[:size]
+
+
+def image_response(server, artwork_id, page, request_headers):
+    """
+    HTTP/1.1 和 HTTP/2 共用的原图响应，支持 ETag / Range 续传和连接重置注入.
+
+    参数:
+        request_headers: 请求头，键为小写.
+
+    返回:
+        tuple: (状态码, 响应头, 响应体, reset_at)，reset_at 不为 None 时写到该位置后断开.
+    """
+    server.count("image")
+    settings = server.settings
+    time.sleep(settings.image_latency_ms / 1000)
+    content_id = settings.content_id(artwork_id)
+    size = settings.image_size(content_id, page)
+    body = image_body(content_id, page, size)
+    etag = f'"{artwork_id}-{page}"'
+    if settings.error_rate and server.random() < settings.error_rate:
+        server.count("error")
+        return 500, {"Content-Type": "text/plain", "Content-Length": "0"}, b"", None
+
+    start = 0
+    status = 200
+    headers = {"Content-Type": "image/jpeg", "ETag": etag, "Accept-Ranges": "bytes"}
+    range_header = request_headers.get("range")
+    if range_header and request_headers.get("if-range", etag) == etag:
+        match = re.match(r"bytes=(\d+)-$", range_header)
+        if match and int(match[1]) < size:
+            start = max(int(match[1]) - settings.range_skew, 0)
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{size - 1}/{size}"
+            server.count("image_resumed")
+
+    payload = body[start:]
+    headers["Content-Length"] = str(len(payload))
+    reset_at = None
+    reset_offset = server.next_reset_offset()
+    if reset_offset is not None:
+        reset_at = max(reset_offset - start, 0)  # 相对本次响应体的位置
+        server.count("reset")
+    elif settings.reset_rate and server.random() < settings.reset_rate:
+        reset_at = len(payload) // 2
+        server.count("reset")
+    return status, headers, payload, reset_at
+
+
+def paced_chunks(settings, payload, chunk_size=16 * 1024):
+    """按每连接带宽分块产出 (起点, 终点)，不限带宽时不等待。"""
+    rate = settings.bandwidth_kbps * 1024
+    started = time.monotonic()
+    sent = 0
+    while sent < len(payload):
+        end = min(sent + chunk_size, len(payload))
+        yield sent, end
+        sent = end
+        if rate:
+            delay = sent / rate - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def settings(self):
+        return self.server.settings
+
+    def _count(self, name):
+        self.server.count(name)
+
+    def _send(self, body, status=200, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data, headers=None):
+        self._send(json.dumps(data).encode(), headers=headers)
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/__stats":
+            with self.server.lock:
+                return self._send_json(dict(self.server.counts))
+        if path.startswith("/ajax/"):
+            return self._ajax(path, urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query))
+        match = re.match(r"/img-original/img/(\d+)_p(\d+)\.jpg$", path)
+        if match:
+            return self._image(match[1], int(match[2]))
+        self._count("not_found")
+        self._send(b"{}", status=404)
+
+    def _ajax(self, path, query):
+        time.sleep(self.settings.latency_ms / 1000)
+        if self.settings.throttle_rate and self.server.random() < self.settings.throttle_rate:
+            self._count("throttled")
+            return self._send(b"{}", status=429, headers={"Retry-After": "1"})
+
+        match = re.match(r"/ajax/user/(\d+)/profile/all$", path)
+        if match:
+            self._count("user")
+            user_id = int(match[1])
+            illusts = {str(user_id * 100000 + index): None for index in range(1, self.settings.artworks + 1)}
+            return self._send_json({"error": False, "body": {"illusts": illusts, "manga": []}})
+
+        match = re.match(r"/ajax/user/(\d+)/profile/illusts$", path)
+        if match:
+            self._count("profile_illusts")
+            user_id = int(match[1])
+            works = {artwork_id: self._work(artwork_id) for artwork_id in query.get("ids[]", [])
+                     if int(artwork_id) // 100000 == user_id}
+            return self._send_json({"error": False, "body": {"works": works}})
+
+        match = re.match(r"/ajax/illust/(\d+)(/pages)?$", path)
+        if not match:
+            self._count("not_found")
+            return self._send(b"{}", status=404)
+
+        artwork_id = match[1]
+        etag = f'"{artwork_id}"'
+        if self.headers.get("If-None-Match") == etag:
+            self._count("not_modified")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if match[2]:
+            self._count("pages")
+            image_base = f"http://{IMAGE_HOSTNAME}:{self.server.image_port}/img-original/img"
+            body = [{"urls": {"original": f"{image_base}/{artwork_id}_p{page}.jpg"}}
+                    for page in range(self.settings.pages)]
+        else:
+            self._count("illust")
+            work = self._work(artwork_id)
+            body = {"illustId": artwork_id, "illustTitle": work["title"], "userId": work["userId"],
+                    "userName": work["userName"]}
+        self._send_json({"error": False, "body": body}, headers={"ETag": etag})
+
+    def _work(self, artwork_id):
+        # 批量接口和作品详情接口共用的作品信息
+        user_id = int(artwork_id) // 100000
+        return {"id": artwork_id, "title": f"作品{artwork_id}", "userId": str(user_id), "userName": f"用户{user_id}",
+                "pageCount": self.settings.pages}
+
+    def _image(self, artwork_id, page):
+        request_headers = {key.lower(): value for key, value in self.headers.items()}
+        status, headers, payload, reset_at = image_response(self.server, artwork_id, page, request_headers)
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self._write_body(payload, reset_at)
+
+    def _write_body(self, payload, reset_at=None):
+        # 按带宽分块写出；reset_at 不为 None 时写到一半直接断开连接
+        for start, end in paced_chunks(self.settings, payload):
+            if reset_at is not None and end > reset_at:
+                self.wfile.write(payload[start:reset_at])
+                self.wfile.flush()
+                self.connection.shutdown(socket.SHUT_RDWR)
+                self.close_connection = True
+                return
+            self.wfile.write(payload[start:end])
+
+
+class H2ImageServer:
+    """
+    h2c 原图服务器：每个连接一个读线程，每个流一个写线程，按流量控制窗口分帧发送.
+    连接重置注入改为 RST_STREAM，只中断当前的流，同一连接上的其他传输不受影响.
+    """
+
+    def __init__(self, server, port=0):
+        import h2.connection  # noqa: F401  未安装时抛出 ImportError
+
+        self.server = server
+        self.sock = socket.create_server(("127.0.0.1", port))
+        self.connections = 0
+
+    @property
+    def port(self):
+        return self.sock.getsockname()[1]
+
+    def start(self):
+        threading.Thread(target=self._accept, name="mock-h2", daemon=True).start()
+        return self
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                return
+            self.server.count("h2_connections")
+            threading.Thread(target=self._serve, args=(sock,), daemon=True).start()
+
+    def _serve(self, sock):
+        import h2.config
+        import h2.connection
+        import h2.events
+
+        conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding="utf-8"))
+        state = {"conn": conn, "sock": sock, "cond": threading.Condition(), "closed": set()}
+        with state["cond"]:
+            conn.initiate_connection()
+            sock.sendall(conn.data_to_send())
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                with state["cond"]:
+                    events = conn.receive_data(data)
+                    sock.sendall(conn.data_to_send())
+                    for event in events:
+                        if isinstance(event, h2.events.RequestReceived):
+                            threading.Thread(target=self._respond, args=(state, event.stream_id, dict(event.headers)),
+                                             daemon=True).start()
+                        elif isinstance(event, h2.events.StreamReset):
+                            state["closed"].add(event.stream_id)
+                        elif isinstance(event, h2.events.ConnectionTerminated):
+                            return
+                    state["cond"].notify_all()  # 窗口可能已更新
+        except OSError:
+            pass
+        finally:
+            with state["cond"]:
+                state["closed"].add(None)  # 连接关闭，所有流停止写出
+                state["cond"].notify_all()
+            sock.close()
+
+    def _respond(self, state, stream_id, headers):
+        conn, sock, cond, closed = state["conn"], state["sock"], state["cond"], state["closed"]
+        match = re.match(r"/img-original/img/(\d+)_p(\d+)\.jpg$", headers.get(":path", "").split("?")[0])
+        if match:
+            status, response_headers, payload, reset_at = image_response(self.server, match[1], int(match[2]), headers)
+        else:
+            self.server.count("not_found")
+            status, response_headers, payload, reset_at = 404, {"Content-Length": "0"}, b"", None
+
+        try:
+            with cond:
+                conn.send_headers(stream_id, [(":status", str(status))]
+                                  + [(key.lower(), value) for key, value in response_headers.items()],
+                                  end_stream=not payload)
+                sock.sendall(conn.data_to_send())
+            for start, end in paced_chunks(self.server.settings, payload):
+                while start < end:
+                    with cond:
+                        while not (closed & {stream_id, None}) and min(
+                                conn.local_flow_control_window(stream_id), conn.max_outbound_frame_size) <= 0:
+                            cond.wait(1)
+                        if closed & {stream_id, None}:
+                            return
+                        stop = start + min(conn.local_flow_control_window(stream_id), conn.max_outbound_frame_size,
+                                           end - start)
+                        if reset_at is not None and stop > reset_at:
+                            conn.reset_stream(stream_id)
+                            sock.sendall(conn.data_to_send())
+                            return
+                        conn.send_data(stream_id, payload[start:stop], end_stream=stop == len(payload))
+                        sock.sendall(conn.data_to_send())
+                    start = stop
+        except Exception:  # 连接已关闭或流已被对方重置
+            return
+
+
+class MockServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # 默认的监听队列只有 5，异步引擎同时建立几十个连接时，溢出的连接在客户端看来已经建立，却一直收不到响应
+    request_queue_size = 128
+
+    def __init__(self, settings, port=0):
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.settings = settings
+        self.counts = {}
+        self.lock = threading.Lock()
+        self._random = random.Random(settings.seed)
+        self.reset_offsets = list(settings.reset_offsets)
+        self.h2_server = None
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def enable_http2(self, port=0):
+        """原图改由 h2c 服务器提供，返回其端口。"""
+        self.h2_server = H2ImageServer(self, port).start()
+        return self.h2_server.port
+
+    @property
+    def image_port(self):
+        return self.h2_server.port if self.h2_server else self.server_address[1]
+
+    def random(self):
+        with self.lock:
+            return self._random.random()
+
+    def next_reset_offset(self):
+        with self.lock:
+            return self.reset_offsets.pop(0) if self.reset_offsets else None
+
+    @property
+    def api_base(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="mock-pixiv", daemon=True).start()
+        return self
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地模拟 Pixiv 服务器")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--http2", action="store_true", help="原图使用 h2c（HTTP/2 prior knowledge）")
+    MockSettings.add_arguments(parser)
+    args = parser.parse_args(argv)
+    server = MockServer(MockSettings.from_args(args), args.port)
+    if args.http2:
+        try:
+            server.enable_http2()
+        except ImportError as e:
+            server.server_close()
+            print(f"--http2 需要安装 h2（pip install h2）：{e}", file=sys.stderr, flush=True)
+            return 2
+    # 第一行输出地址，供基准测试的运行器读取
+    print(f"PORT {server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+# benchmark/run.py
+# 吞吐量基准：启动本地模拟服务器，用 main.run 走一遍完整的下载流程，输出 JSON 结果便于前后对比
+#
+# 用法（在项目根目录）:
+#   python -m benchmark.run --users 3 --artworks 20 --size-kb 512 --output before.json
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark.mock_server import IMAGE_HOSTNAME, MockSettings
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_server(settings, http2=False):
+    """在子进程中启动模拟服务器，避免与下载端争用 GIL，返回 (进程, 端口)。"""
+    args = [sys.executable, "-m", "benchmark.mock_server", "--port", "0"] + (["--http2"] if http2 else [])
+    for key, value in settings.to_dict().items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        args += [f"--{key.replace('_', '-')}", *map(str, values)]
+    process = subprocess.Popen(args, cwd=REPO_ROOT, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline().strip()
+    if not line.startswith("PORT "):
+        process.kill()
+        # 模拟服务器把原因写到 stderr（与本进程共用），这里只补充退出码
+        raise RuntimeError(f"模拟服务器启动失败（退出码 {process.wait()}），原因见上方输出：{line!r}")
+    return process, int(line.split()[1])
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows 没有 resource 模块
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def server_counts(port):
+    import urllib.request
+
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/__stats", timeout=5) as response:
+        return json.loads(response.read())
+
+
+def run_benchmark(settings, client):
+    """
+    执行一次基准测试.
+
+    参数:
+        settings (MockSettings): 模拟服务器参数.
+        client (dict): 下载端配置，键与 config_loader.load_config 返回的字典相同.
+
+    返回:
+        dict: 耗时、图片数、吞吐量、峰值内存和请求计数.
+    """
+    process, port = start_server(settings, http2=client.get("transport") == "http2")
+    work_dir = tempfile.mkdtemp(prefix="pdi-bench-")
+    old_cwd = os.getcwd()
+    os.chdir(work_dir)  # PDI.log、error.json 等运行文件都写到临时目录
+    try:
+        sys.path.insert(0, REPO_ROOT)
+        from log_config import logger
+        from pdi_config import config
+        from http_pool import add_image_host
+        import main as pdi_main
+        from metrics import metrics
+        from stats import stats
+        from transport import transport
+        from retry_policy import retry_policy
+        from disk_writer import disk_writer
+        from bandwidth import bandwidth
+        from blob_store import blob_store
+
+        # 日志只输出警告到标准错误，标准输出留给 JSON 结果
+        logger.remove()
+        logger.add(sys.stderr, level="WARNING")
+        add_image_host(IMAGE_HOSTNAME)
+        down_path = os.path.join(work_dir, "downloads")
+        config.store_config({
+            "PHPSESSID": "benchmark",
+            "USER_IDS": settings.user_ids(),
+            "down_path": down_path,
+            "api_base": f"http://127.0.0.1:{port}",
+            "metrics_interval": 0,
+            **client,
+        })
+        pdi_main.apply_config()
+
+        started = time.perf_counter()
+        pdi_main.run(config.USER_IDS, [], down_path)
+        elapsed = time.perf_counter() - started
+
+        images = sum(user["images"] for user in stats.user_stats()["success"].values())
+        snapshot = metrics.snapshot()
+        image_bytes = snapshot["bytes"].get("image", 0)
+        return {
+            "settings": settings.to_dict(),
+            "client": client,
+            "elapsed_s": round(elapsed, 3),
+            "images": images,
+            "expected_images": settings.users * settings.artworks * settings.pages,
+            "failed_images": stats.skipped_stats()["download_failed_count"],
+            "images_per_s": round(images / elapsed, 2) if elapsed else 0,
+            "bytes": image_bytes,
+            "mb_per_s": round(image_bytes / elapsed / (1024 * 1024), 2) if elapsed else 0,
+            "peak_rss_mb": peak_rss_mb(),
+            "client_requests": {f"{host}/{status}": count
+                                for (host, status), count in sorted(snapshot["requests"].items())},
+            "retries": snapshot["retries"],
+            "attempts": retry_policy.stats(),
+            "disk": disk_writer.stats(),
+            "bandwidth": bandwidth.stats(),
+            "dedup": blob_store.stats(),
+            "transport": transport.name,
+            "connections": {host: host_stats["connections_created"] for host, host_stats in transport.stats().items()},
+            "server_requests": server_counts(port),
+        }
+    finally:
+        os.chdir(old_cwd)
+        process.terminate()
+        process.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PDI 下载吞吐量基准测试（离线）")
+    MockSettings.add_arguments(parser)
+    parser.add_argument("--engine", choices=("thread", "async"), default="thread")
+    parser.add_argument("--artwork-threads", type=int, default=2)
+    parser.add_argument("--image-workers", type=int, default=6)
+    parser.add_argument("--async-transfers", type=int, default=64)
+    parser.add_argument("--api-rate", type=float, default=0, help="ajax 每秒请求数，0 为不限速")
+    parser.add_argument("--image-rate", type=float, default=0, help="原图每秒请求数，0 为不限速")
+    parser.add_argument("--no-adaptive", action="store_true", help="关闭自适应并发控制")
+    parser.add_argument("--transport", choices=("requests", "http2"), default="requests",
+                        help="线程引擎的传输后端，http2 时模拟服务器的原图改用 h2c")
+    parser.add_argument("--disk-writers", type=int, default=2, help="写盘线程数，0 为在下载线程中直接写盘")
+    parser.add_argument("--fsync", choices=("none", "file", "artwork"), default="none")
+    parser.add_argument("--preallocate", action="store_true", help="按 Content-Length 预先分配文件空间")
+    parser.add_argument("--dedup", action="store_true", help="写盘时计算摘要并存入去重存储")
+    parser.add_argument("--bandwidth-mb", type=float, default=0, help="原图下载的全局带宽上限（MB/s），0 为不限")
+    parser.add_argument("--user-bandwidth-mb", type=float, default=0, help="每个用户的带宽上限（MB/s），0 为不限")
+    parser.add_argument("--profile-batch-size", type=int, default=48, help="批量获取作品信息的批次大小，0 为逐个请求")
+    parser.add_argument("--trace", help="同时输出 Chrome trace 文件")
+    parser.add_argument("--trace-sample-rate", type=float, default=1.0)
+    parser.add_argument("--output", help="结果 JSON 文件，默认只输出到标准输出")
+    args = parser.parse_args(argv)
+    if args.transport == "http2":
+        # 模拟服务器需要 h2，下载端需要 httpx 和 h2（否则会回退到 requests，测到的不是 HTTP/2）
+        try:
+            import h2  # noqa: F401
+            import httpx  # noqa: F401
+        except ImportError as e:
+            parser.error(f'--transport http2 需要安装 httpx 和 h2（pip install "httpx[http2]"）：{e}')
+
+    client = {
+        "engine": args.engine,
+        "artwork_threads": args.artwork_threads,
+        "image_workers": args.image_workers,
+        "image_queue_size": args.image_workers * 2,
+        "async_transfers": args.async_transfers,
+        "rate_limits": {"api_rate": args.api_rate, "api_burst": 2, "image_rate": args.image_rate, "image_burst": 10},
+        "adaptive": not args.no_adaptive,
+        "profile_batch_size": args.profile_batch_size,
+        "disk_writers": args.disk_writers,
+        "fsync": args.fsync,
+        "preallocate": args.preallocate,
+        "dedup": args.dedup,
+        "bandwidth": {"rate": args.bandwidth_mb * 1024 * 1024,
+                      "user_rates": {"*": args.user_bandwidth_mb * 1024 * 1024} if args.user_bandwidth_mb else {},
+                      "schedule": []},
+        "transport": args.transport,
+        "trace_file": os.path.abspath(args.trace) if args.trace else "",
+        "trace_sample_rate": args.trace_sample_rate,
+    }
+    result = run_benchmark(MockSettings.from_args(args), client)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+# blob_store.py
+# 内容寻址存储（可选）：下载完成的图片按 SHA-256 只保存一份，下载目录中的
+# {用户名}-{用户ID}/{作品标题}-{作品ID}/{作品标题}-{作品ID}-{页码}.{扩展名} 都是指向它的硬链接
+import hashlib
+import os
+import threading
+
+from log_config import logger
+
+BLOB_DIR = ".pdi_blobs"  # 存储目录，放在下载目录下；以 . 开头，扫描下载目录时会跳过
+
+
+class BlobStore:
+    """
+    内容寻址的图片存储.
+
+    - 写盘线程在写入数据块的同时计算摘要，文件重命名为正式文件后调用 adopt()，不需要再读一遍文件；
+    - 存储项为 {root}/{摘要前两位}/{摘要}，第一次出现的内容直接把正式文件硬链接进来；
+    - 内容已经存在时，正式文件换成指向已有存储项的硬链接，重复的内容（改名的作品、重复提交、转载）不再占用空间；
+    - 文件系统不支持硬链接（例如 FAT32）或链接数达到上限时保留原文件，不影响下载.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.lock = threading.Lock()
+        self.warned = False
+        self.reset_stats()
+
+    @property
+    def enabled(self):
+        return self.root is not None
+
+    def open(self, root):
+        os.makedirs(root, exist_ok=True)
+        self.root = os.path.abspath(root)
+        logger.info(f"已启用去重存储 {self.root}")
+
+    def close(self):
+        self.root = None
+
+    def reset_stats(self):
+        with self.lock:
+            self.new_blobs = 0
+            self.linked = 0
+            self.saved_bytes = 0
+
+    @staticmethod
+    def hasher():
+        return hashlib.sha256()
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def adopt(self, path, digest):
+        """
+        把正式文件 path 纳入存储.
+
+        参数:
+            path (str): 已经写完并重命名的文件.
+            digest (str): 文件内容的十六进制摘要.
+
+        返回:
+            int: 因为链接到已有内容而释放的字节数.
+        """
+        if not self.enabled:
+            return 0
+        blob = self.blob_path(digest)
+        try:
+            path_stat = os.stat(path)
+            if not os.path.exists(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                try:
+                    os.link(path, blob)
+                    with self.lock:
+                        self.new_blobs += 1
+                    return 0
+                except FileExistsError:
+                    pass  # 另一个写盘线程刚刚存入了相同的内容
+            if os.path.samestat(path_stat, os.stat(blob)):
+                return 0
+            # 先在旁边建立链接再原子替换，任何时候 path 都是完整的文件
+            link_path = f"{path}.link"
+            os.link(blob, link_path)
+            try:
+                os.replace(link_path, path)
+            except OSError:
+                os.remove(link_path)
+                raise
+        except OSError as e:
+            self._warn(path, e)
+            return 0
+        saved = path_stat.st_size if path_stat.st_nlink == 1 else 0  # path 还有其他链接时数据并没有释放
+        with self.lock:
+            self.linked += 1
+            self.saved_bytes += saved
+        return saved
+
+    def _warn(self, path, error):
+        # 同一原因通常对所有文件都成立（例如文件系统不支持硬链接），只完整提示一次
+        if not self.warned:
+            self.warned = True
+            logger.warning(f"无法把 {path} 链接到去重存储，保留为普通文件：{error}")
+        else:
+            logger.debug(f"无法把 {path} 链接到去重存储：{error}")
+
+    def inodes(self):
+        """存储中所有存储项的 (st_dev, st_ino)，用于跳过已经链接到存储的文件。"""
+        found = set()
+        for entry in self._blobs():
+            stat = entry.stat()
+            found.add((stat.st_dev, stat.st_ino))
+        return found
+
+    def prune(self):
+        """
+        删除下载目录中已经没有任何文件链接到的存储项（链接数为 1）.
+
+        返回:
+            tuple: (删除的存储项数, 释放的字节数).
+        """
+        removed = freed = 0
+        for entry in self._blobs():
+            stat = entry.stat()
+            if stat.st_nlink != 1:
+                continue
+            try:
+                os.remove(entry.path)
+            except OSError as e:
+                logger.warning(f"删除无引用的存储项 {entry.path} 失败：{e}")
+                continue
+            removed += 1
+            freed += stat.st_size
+        return removed, freed
+
+    def _blobs(self):
+        if not self.enabled or not os.path.isdir(self.root):
+            return
+        with os.scandir(self.root) as prefixes:
+            for prefix in prefixes:
+                if not prefix.is_dir():
+                    continue
+                with os.scandir(prefix.path) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            yield entry
+
+    def stats(self):
+        with self.lock:
+            return {"new_blobs": self.new_blobs, "linked": self.linked, "saved_bytes": self.saved_bytes}
+
+    def log_stats(self):
+        if not self.enabled:
+            return
+        store_stats = self.stats()
+        logger.info(f"去重存储：新内容 {store_stats['new_blobs']} 个，链接到已有内容 {store_stats['linked']} 个，"
+                    f"节省 {store_stats['saved_bytes'] / (1024 * 1024):.1f} MB")
+
+
+# 全局去重存储
+blob_store = BlobStore()
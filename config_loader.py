@@ -23,6 +23,63 @@ def process_id_list(id_string):
     return [item.strip() for part in id_string.split("|") for item in part.split() if item.strip()]
 
 
+def parse_rate(text):
+    """
+    解析带宽，例如 "512K"、"2M"、"1.5MB/s"，单位按 1024 计算，没有单位时为字节/秒.
+
+    返回:
+        float: 每秒字节数，0 表示不限.
+    """
+    text = text.strip().upper().removesuffix("/S").removesuffix("IB").removesuffix("B")
+    if not text:
+        return 0.0
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    multiplier = units.get(text[-1], 1)
+    if text[-1] in units:
+        text = text[:-1]
+    return float(text) * multiplier
+
+
+def parse_user_rates(text):
+    """
+    解析按用户的带宽上限 "用户ID=上限|..."，用户 ID 为 * 时作为所有用户的默认上限.
+
+    返回:
+        dict: {用户 ID: 每秒字节数}.
+    """
+    user_rates = {}
+    for item in text.split("|"):
+        if not item.strip():
+            continue
+        try:
+            user_id, rate = item.split("=", 1)
+            user_rates[user_id.strip()] = parse_rate(rate)
+        except ValueError:
+            logger.error(f"无法解析按用户的带宽上限：{item.strip()}，应为 用户ID=上限")
+    return user_rates
+
+
+def parse_schedule(text):
+    """
+    解析按时段的全局带宽上限 "HH:MM-HH:MM=上限|..."，结束时间早于开始时间的时段跨过午夜.
+
+    返回:
+        list: [(开始分钟, 结束分钟, 每秒字节数), ...].
+    """
+    schedule = []
+    for item in text.split("|"):
+        if not item.strip():
+            continue
+        try:
+            window, rate = item.split("=", 1)
+            start, end = (int(hour) * 60 + int(minute)
+                          for hour, minute in (moment.strip().split(":") for moment in window.split("-")))
+            schedule.append((start, end, parse_rate(rate)))
+        except ValueError:
+            logger.error(f"无法解析带宽时段：{item.strip()}，应为 HH:MM-HH:MM=上限")
+    return schedule
+
+
 def load_config(debug=True):
     """
     加载配置文件，如果配置文件不存在则创建一个默认配置文件。
@@ -48,7 +105,50 @@ def load_config(debug=True):
             "debug": "True",  # 新增配置项，启用调试模式（默认为 True）
             "artwork_threads": 2,  # 默认作品线程数
             "img_threads": 3,  # 默认图片线程数
-            "down_path": ""
+            "down_path": "",
+            "chunk_size_kb": 256,  # 流式下载每块大小（KB）
+            "max_inflight_mb": 64,  # 全局在途数据上限（MB）
+            "disk_writers": 2,  # 写盘线程数，0 为在下载线程中直接写盘
+            "disk_queue_size": 64,  # 每个写盘线程的队列容量（数据块数）
+            "fsync": "none",  # 刷盘策略：none、file（每个文件）或 artwork（每个作品目录一起）
+            "preallocate": "False",  # 按 Content-Length 预先分配文件空间
+            "dedup": "False",  # 去重存储：相同内容只保存一份，下载目录中为硬链接
+            "bandwidth_limit": "0",  # 原图下载的全局带宽上限，例如 4M；0 为不限
+            "bandwidth_users": "",  # 按用户的带宽上限，例如 *=1M|12345=512K
+            "bandwidth_schedule": "",  # 按时段的全局带宽上限，例如 09:00-18:00=2M|23:00-07:00=0
+            "engine": "thread",  # 下载引擎：thread 或 async
+            "async_transfers": 64,  # 异步引擎同时传输的图片数
+            "api_rate": 1.5,  # ajax 接口每秒请求数
+            "api_burst": 2,  # ajax 接口突发请求数
+            "image_rate": 0,  # 原图每秒请求数，0 为不限速
+            "image_burst": 10,  # 原图突发请求数
+            "adaptive": "True",  # 根据 429/503 自动调整并发数和速率
+            "api_max_rate": 3,  # 自适应提速时 ajax 接口速率上限
+            "manifest": "True",  # 使用下载清单做增量同步
+            "manifest_path": "",  # 清单文件路径，留空为 下载路径/.pdi_manifest.sqlite3
+            "metadata_cache": "True",  # 缓存作品详情和分页 URL
+            "metadata_cache_ttl_hours": 24,  # 缓存有效期（小时）
+            "metadata_cache_mb": 64,  # 缓存大小上限（MB）
+            "metadata_cache_bypass": "False",  # 跳过缓存读取，强制刷新
+            "image_workers": 0,  # 图片下载线程数，0 为 作品线程数 * 图片线程数
+            "image_queue_size": 0,  # 图片任务队列容量，0 为图片下载线程数的 2 倍
+            "max_concurrency": 0,  # 所有用户共用的总并发上限，0 为不额外限制
+            "retry_failed": "False",  # 只重试错误日志中未成功的图片和作品
+            "stats_detail_limit": 0,  # 按文件记录统计明细的最大条数，0 为只保留聚合计数
+            "metrics_interval": 10,  # 进度输出和指标文件写入间隔（秒），0 为关闭
+            "metrics_textfile": "",  # Prometheus textfile 路径，留空不写
+            "api_base": "https://www.pixiv.net",  # ajax 接口地址
+            "trace_file": "",  # Chrome trace 输出路径，留空不追踪
+            "trace_sample_rate": 1.0,  # 被追踪请求的采样比例
+            "library_index": "True",  # 启动时扫描下载目录，跳过磁盘上已完整的作品
+            "library_index_cache": "True",  # 缓存目录索引，下次只重新列出有变化的作品目录
+            "transport": "requests",  # HTTP 传输后端：requests 或 http2（原图主机使用 HTTP/2 多路复用）
+            "profile_batch_size": "48",  # 批量获取作品信息时每次请求的作品数，0 为逐个请求
+            "rename_sync": "move",  # 用户名或作品标题改变时：move 移动已有目录，link 硬链接，off 重新下载
+            "retry_max_attempts": "3",  # 每个请求最多尝试的次数（含第一次）
+            "retry_budget": "20",  # 重试次数不超过本次运行请求数的百分比
+            "breaker_failures": "5",  # 同一主机连续失败多少次后熔断，0 为关闭熔断器
+            "breaker_cooldown": "30",  # 熔断后等待多少秒再放行探测请求
         }
 
         # 手动写入注释（确保以UTF-8编码写入）
@@ -72,7 +172,90 @@ def load_config(debug=True):
             configfile.write("# 是一个必须项，用于指定下载路径，你也可以不填，不填会提示你输入\n")
             configfile.write("# 示例: 下载路径配置\n")
             configfile.write('#down_path = D:\\download\\xxxx \n')
-            configfile.write("down_path = ")
+            configfile.write("down_path = \n\n")
+            configfile.write("# 流式下载设置：每次读取的块大小（KB），以及所有线程同时在内存中的数据上限（MB）\n")
+            configfile.write("chunk_size_kb = 256\n")
+            configfile.write("max_inflight_mb = 64\n")
+            configfile.write("# 写盘线程：下载线程只读取网络数据，写文件、刷盘和重命名交给 disk_writers 个写盘线程（0 为下载线程直接写盘）；\n")
+            configfile.write("# fsync 为 none 时交给操作系统刷盘，file 每个文件完成时刷盘，artwork 同一作品的文件一起刷盘；\n")
+            configfile.write("# preallocate 按文件大小预先分配空间，可以减少 NAS / 机械硬盘上的碎片\n")
+            configfile.write("disk_writers = 2\n")
+            configfile.write("disk_queue_size = 64\n")
+            configfile.write("fsync = none\n")
+            configfile.write("preallocate = False\n")
+            configfile.write("# dedup 为 True 时相同内容的图片只保存一份（下载路径/.pdi_blobs），下载目录中的文件都是指向它的硬链接，\n")
+            configfile.write("# 需要支持硬链接的文件系统（NTFS、ext4 等）；已有的下载目录用 python main.py dedup 转换\n")
+            configfile.write("dedup = False\n\n")
+            configfile.write("# 带宽整形（只限制原图下载）：bandwidth_limit 为全局上限，单位 K / M（按 1024 计算），0 为不限；\n")
+            configfile.write("# 同时下载的用户平分带宽，某个用户用不完的部分立即分给其他用户\n")
+            configfile.write("bandwidth_limit = 0\n")
+            configfile.write("# 按用户的上限，用 '|' 分隔，* 为所有用户的默认值，示例: *=1M|12345=512K\n")
+            configfile.write("bandwidth_users = \n")
+            configfile.write("# 按时段的全局上限，时段内代替 bandwidth_limit，结束时间早于开始时间表示跨过午夜，\n")
+            configfile.write("# 示例（白天限速、夜间不限）: 09:00-18:00=2M|23:00-07:00=0\n")
+            configfile.write("bandwidth_schedule = \n\n")
+            configfile.write("# 下载引擎：thread 为线程池（默认），async 为单事件循环的异步引擎（需要 pip install aiohttp）\n")
+            configfile.write("engine = thread\n")
+            configfile.write("# 异步引擎同时传输的图片数\n")
+            configfile.write("async_transfers = 64\n\n")
+            configfile.write("# 频率限制（令牌桶）：ajax 接口与原图分开限速，rate 为每秒请求数（0 为不限速），burst 为可积攒的突发请求数\n")
+            configfile.write("api_rate = 1.5\n")
+            configfile.write("api_burst = 2\n")
+            configfile.write("image_rate = 0\n")
+            configfile.write("image_burst = 10\n\n")
+            configfile.write("# 自适应控制：收到 429/503 时所有线程一起暂停并降速，连续成功后逐步提速，api_max_rate 为 ajax 速率上限\n")
+            configfile.write("adaptive = True\n")
+            configfile.write("api_max_rate = 3\n\n")
+            configfile.write("# 下载清单（SQLite）：记录已完成的作品，再次同步时不再请求这些作品的元数据\n")
+            configfile.write("# manifest_path 留空时保存在 下载路径/.pdi_manifest.sqlite3\n")
+            configfile.write("manifest = True\n")
+            configfile.write("manifest_path = \n\n")
+            configfile.write("# 元数据缓存：作品详情和分页 URL 保存在 下载路径/.pdi_cache.sqlite3，过期后发条件请求确认\n")
+            configfile.write("# metadata_cache_bypass = True 时不读取缓存（仍写入），用于强制刷新\n")
+            configfile.write("metadata_cache = True\n")
+            configfile.write("metadata_cache_ttl_hours = 24\n")
+            configfile.write("metadata_cache_mb = 64\n")
+            configfile.write("metadata_cache_bypass = False\n\n")
+            configfile.write("# 线程引擎流水线：artwork_threads 个线程获取作品信息，image_workers 个常驻线程下载图片\n")
+            configfile.write("# image_workers 为 0 时取 artwork_threads * img_threads；image_queue_size 为 0 时取 image_workers 的 2 倍\n")
+            configfile.write("image_workers = 0\n")
+            configfile.write("image_queue_size = 0\n")
+            configfile.write("# 所有用户的作品同时排队并按用户轮转调度，max_concurrency 为两个阶段同时执行任务的总上限（0 为不额外限制）\n")
+            configfile.write("max_concurrency = 0\n\n")
+            configfile.write("# 失败记录追加到 error_journal.jsonl，运行结束时导出 error.json；retry_failed = True 时只重试其中未成功的项\n")
+            configfile.write("retry_failed = False\n\n")
+            configfile.write("# 统计默认只保留聚合计数；stats_detail_limit 大于 0 时按文件记录跳过和失败的明细，最多保留这么多条\n")
+            configfile.write("stats_detail_limit = 0\n\n")
+            configfile.write("# 每 metrics_interval 秒输出一行进度（0 为关闭）；metrics_textfile 设置后同时写 Prometheus textfile\n")
+            configfile.write("# 例如 /var/lib/node_exporter/textfile_collector/pdi.prom\n")
+            configfile.write("metrics_interval = 10\n")
+            configfile.write("metrics_textfile = \n\n")
+            configfile.write("# ajax 接口地址，一般不需要修改；基准测试时指向本地模拟服务器\n")
+            configfile.write("api_base = https://www.pixiv.net\n\n")
+            configfile.write("# 设置 trace_file（如 pdi_trace.json）后记录每个请求的限速等待、连接/TLS、首字节、传输和写盘耗时，\n")
+            configfile.write("# 可在 chrome://tracing 或 ui.perfetto.dev 打开；作品很多时用 trace_sample_rate（0~1）只追踪一部分请求\n")
+            configfile.write("trace_file = \n")
+            configfile.write("trace_sample_rate = 1.0\n\n")
+            configfile.write("# 启动时扫描下载目录，总页数已知且每页文件都存在的作品不再请求；索引缓存在 下载路径/.pdi_index.json\n")
+            configfile.write("library_index = True\n")
+            configfile.write("library_index_cache = True\n")
+            configfile.write("# 作品按 ID 识别：用户改名或作品改标题后，move 把已有目录和文件重命名到新路径，\n")
+            configfile.write("# link 硬链接到新路径并保留旧目录，off 按新路径重新下载（需要开启 library_index）\n")
+            configfile.write("rename_sync = move\n\n")
+            configfile.write("# 下载用户作品时，用用户主页的批量接口每次获取 profile_batch_size 个作品的标题、用户名和页数，\n")
+            configfile.write("# 不再逐个请求作品详情；设为 0 则逐个请求\n")
+            configfile.write("profile_batch_size = 48\n\n")
+            configfile.write("# 线程引擎的 HTTP 传输后端：requests（默认）；http2 让原图主机的并发传输复用少量 HTTP/2 连接，\n")
+            configfile.write('# 需要 pip install "httpx[http2]"\n')
+            configfile.write("transport = requests\n\n")
+            configfile.write("# 失败的请求（连接错误、超时、5xx）按指数退避加随机抖动重试，每个请求最多尝试 retry_max_attempts 次，\n")
+            configfile.write("# 整个运行的重试次数不超过请求数的 retry_budget%，避免故障时成倍增加请求；404 等客户端错误不重试\n")
+            configfile.write("retry_max_attempts = 3\n")
+            configfile.write("retry_budget = 20\n")
+            configfile.write("# 同一主机连续失败 breaker_failures 次后熔断 breaker_cooldown 秒，期间先处理其他主机的请求，\n")
+            configfile.write("# 之后放行一个探测请求，成功则恢复；breaker_failures 为 0 时关闭熔断器\n")
+            configfile.write("breaker_failures = 5\n")
+            configfile.write("breaker_cooldown = 30\n")
 
         logger.info(f"已创建默认配置文件 {config_path}，请设置 PHPSESSID 和其他值后重新运行程序。")
         return {"need_restart": True}  # 返回额外的标志，表明需要用户手动配置并重启程序
@@ -92,8 +275,65 @@ def load_config(debug=True):
     # 获取线程数配置，默认为 2（作品）和 3（图片）
     artwork_threads = int(config["DEFAULT"].get("artwork_threads", "2").strip())
     image_threads = int(config["DEFAULT"].get("img_threads", "3").strip())
+    # 流水线图片线程数和队列容量
+    image_workers = int(config["DEFAULT"].get("image_workers", "0").strip()) or artwork_threads * image_threads
+    image_queue_size = int(config["DEFAULT"].get("image_queue_size", "0").strip()) or image_workers * 2
+    max_concurrency = int(config["DEFAULT"].get("max_concurrency", "0").strip())
+    retry_failed = config["DEFAULT"].get("retry_failed", "False").strip().lower() == "true"
+    stats_detail_limit = int(config["DEFAULT"].get("stats_detail_limit", "0").strip())
+    metrics_interval = float(config["DEFAULT"].get("metrics_interval", "10").strip() or 0)
+    metrics_textfile = config["DEFAULT"].get("metrics_textfile", "").strip()
+    api_base = config["DEFAULT"].get("api_base", "").strip() or "https://www.pixiv.net"
+    trace_file = config["DEFAULT"].get("trace_file", "").strip()
+    trace_sample_rate = float(config["DEFAULT"].get("trace_sample_rate", "1.0").strip() or 1.0)
+    use_library_index = config["DEFAULT"].get("library_index", "True").strip().lower() == "true"
+    library_index_cache = config["DEFAULT"].get("library_index_cache", "True").strip().lower() == "true"
+    rename_sync = config["DEFAULT"].get("rename_sync", "move").strip().lower()
+    transport = config["DEFAULT"].get("transport", "requests").strip().lower()
+    profile_batch_size = int(config["DEFAULT"].get("profile_batch_size", "48").strip() or 0)
+    retry = {
+        "max_attempts": int(config["DEFAULT"].get("retry_max_attempts", "3").strip() or 1),
+        "budget_ratio": float(config["DEFAULT"].get("retry_budget", "20").strip() or 0) / 100,
+        "failure_threshold": int(config["DEFAULT"].get("breaker_failures", "5").strip() or 0),
+        "cooldown": float(config["DEFAULT"].get("breaker_cooldown", "30").strip() or 0),
+    }
     # down_path
     down_path = config["DEFAULT"].get("down_path", "")
+    # 流式下载块大小与在途数据上限
+    chunk_size = int(config["DEFAULT"].get("chunk_size_kb", "256").strip()) * 1024
+    max_inflight_bytes = int(config["DEFAULT"].get("max_inflight_mb", "64").strip()) * 1024 * 1024
+    # 写盘线程
+    disk_writers = int(config["DEFAULT"].get("disk_writers", "2").strip() or 0)
+    disk_queue_size = int(config["DEFAULT"].get("disk_queue_size", "64").strip() or 64)
+    fsync = config["DEFAULT"].get("fsync", "none").strip().lower() or "none"
+    preallocate = config["DEFAULT"].get("preallocate", "False").strip().lower() == "true"
+    dedup = config["DEFAULT"].get("dedup", "False").strip().lower() == "true"
+    # 带宽整形
+    bandwidth = {
+        "rate": parse_rate(config["DEFAULT"].get("bandwidth_limit", "0")),
+        "user_rates": parse_user_rates(config["DEFAULT"].get("bandwidth_users", "")),
+        "schedule": parse_schedule(config["DEFAULT"].get("bandwidth_schedule", "")),
+    }
+    # 下载引擎
+    engine = config["DEFAULT"].get("engine", "thread").strip().lower()
+    async_transfers = int(config["DEFAULT"].get("async_transfers", "64").strip())
+    # 按主机分类的令牌桶限速
+    adaptive = config["DEFAULT"].get("adaptive", "True").strip().lower() == "true"
+    api_max_rate = float(config["DEFAULT"].get("api_max_rate", "3").strip())
+    use_manifest = config["DEFAULT"].get("manifest", "True").strip().lower() == "true"
+    manifest_path = config["DEFAULT"].get("manifest_path", "").strip()
+    metadata_cache_settings = {
+        "enabled": config["DEFAULT"].get("metadata_cache", "True").strip().lower() == "true",
+        "ttl": float(config["DEFAULT"].get("metadata_cache_ttl_hours", "24").strip()) * 3600,
+        "max_bytes": int(float(config["DEFAULT"].get("metadata_cache_mb", "64").strip()) * 1024 * 1024),
+        "bypass": config["DEFAULT"].get("metadata_cache_bypass", "False").strip().lower() == "true",
+    }
+    rate_limits = {
+        "api_rate": float(config["DEFAULT"].get("api_rate", "1.5").strip()),
+        "api_burst": float(config["DEFAULT"].get("api_burst", "2").strip()),
+        "image_rate": float(config["DEFAULT"].get("image_rate", "0").strip()),
+        "image_burst": float(config["DEFAULT"].get("image_burst", "10").strip()),
+    }
 
     logger.warning("已加载配置文件，但未检查 USER_IDS 和 ARTWORK_IDS 是否为空字符串。")
 
@@ -113,7 +353,7 @@ def load_config(debug=True):
 
     logger.info(
         f"成功加载配置：PHPSESSID={PHPSESSID}, Presets={Presets}, USER_IDS={USER_IDS}, ARTWORK_IDS={ARTWORK_IDS}")
-    logger.info(f"线程设置：作品线程数={artwork_threads}, 图片线程数={image_threads}")
+    logger.info(f"线程设置：作品线程数={artwork_threads}, 图片线程数={image_threads}, 下载引擎={engine}")
 
     # 返回配置字典，键值对形式
     return {
@@ -125,7 +365,39 @@ def load_config(debug=True):
         "artwork_threads": artwork_threads,
         "img_threads": image_threads,
         "need_restart": False,  # 配置已成功加载
-        "down_path": down_path
+        "down_path": down_path,
+        "chunk_size": chunk_size,
+        "max_inflight_bytes": max_inflight_bytes,
+        "disk_writers": disk_writers,
+        "disk_queue_size": disk_queue_size,
+        "fsync": fsync,
+        "preallocate": preallocate,
+        "dedup": dedup,
+        "bandwidth": bandwidth,
+        "engine": engine,
+        "async_transfers": async_transfers,
+        "rate_limits": rate_limits,
+        "adaptive": adaptive,
+        "api_max_rate": api_max_rate,
+        "manifest": use_manifest,
+        "manifest_path": manifest_path,
+        "metadata_cache": metadata_cache_settings,
+        "image_workers": image_workers,
+        "image_queue_size": image_queue_size,
+        "max_concurrency": max_concurrency,
+        "retry_failed": retry_failed,
+        "stats_detail_limit": stats_detail_limit,
+        "metrics_interval": metrics_interval,
+        "metrics_textfile": metrics_textfile,
+        "api_base": api_base,
+        "trace_file": trace_file,
+        "trace_sample_rate": trace_sample_rate,
+        "library_index": use_library_index,
+        "library_index_cache": library_index_cache,
+        "rename_sync": rename_sync,
+        "profile_batch_size": profile_batch_size,
+        "transport": transport,
+        "retry": retry,
     }
 
 
@@ -0,0 +1,150 @@
+# dedup.py
+# 把已有的下载目录转换为去重存储：用进程池并行计算每张图片的摘要，相同内容只保留一份，其余换成硬链接，
+# 并报告释放的空间；之后设置 dedup = True，新下载的图片在写盘时就会去重
+import argparse
+import collections
+import mmap
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from blob_store import blob_store, BLOB_DIR
+from log_config import logger
+from verify import iter_images
+
+BATCH_SIZE = 64  # 每个进程任务计算摘要的文件数
+PROGRESS_INTERVAL = 10.0
+
+
+def hash_file(path):
+    """用内存映射计算文件的 SHA-256，不把文件读入内存；读取失败时返回 None。"""
+    hasher = blob_store.hasher()
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    hasher.update(mm)
+    except OSError as e:
+        logger.warning(f"无法读取 {path}：{e}")
+        return None
+    return hasher.hexdigest()
+
+
+def hash_batch(batch):
+    """在工作进程中计算一批文件的摘要，返回 [(路径, 大小, 摘要), ...]。"""
+    return [(path, size, hash_file(path)) for path, size in batch]
+
+
+def _batches(root, adopted, skipped):
+    batch = []
+    for path in iter_images(root):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if (stat.st_dev, stat.st_ino) in adopted:
+            skipped[0] += 1  # 已经是存储项的硬链接
+            continue
+        batch.append((path, stat.st_size))
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def dedup_library(root, blob_root, workers=0, dry_run=False):
+    """
+    把 root 下的图片纳入 blob_root 的去重存储.
+
+    参数:
+        root (str): 下载目录.
+        blob_root (str): 存储目录.
+        workers (int): 计算摘要的进程数，0 为 CPU 核数，1 时在当前进程中计算.
+        dry_run (bool): 只统计重复的内容和可以释放的空间，不修改文件.
+
+    返回:
+        dict: 文件数、跳过数、不同内容数和释放（或可释放）的字节数.
+    """
+    workers = workers or os.cpu_count() or 1
+    if not dry_run or os.path.isdir(blob_root):
+        blob_store.open(blob_root)  # 预览时不创建存储目录
+    blob_store.reset_stats()
+    started = time.perf_counter()
+    adopted = blob_store.inodes()
+    skipped = [0]
+    files = hashed_bytes = reclaimed = 0
+    sizes = collections.defaultdict(list)  # dry_run：摘要 -> [大小, ...]
+    next_progress = started + PROGRESS_INTERVAL
+
+    batches = _batches(root, adopted, skipped)
+    if workers == 1:
+        results = (hash_batch(batch) for batch in batches)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(hash_batch, batches)
+    try:
+        for batch in results:
+            # 链接都在当前进程中按顺序建立，工作进程只读文件
+            for path, size, digest in batch:
+                if digest is None:
+                    continue
+                files += 1
+                hashed_bytes += size
+                if dry_run:
+                    sizes[digest].append(size)
+                else:
+                    reclaimed += blob_store.adopt(path, digest)
+            now = time.perf_counter()
+            if now >= next_progress:
+                next_progress = now + PROGRESS_INTERVAL
+                logger.info(f"已处理 {files} 个文件（{hashed_bytes / (1024 * 1024):.0f} MB）")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    pruned = pruned_bytes = 0
+    if dry_run:
+        reclaimed = _reclaimed(sizes)
+        unique = len(sizes)
+    else:
+        pruned, pruned_bytes = blob_store.prune()  # 下载目录中的文件被删除后留下的存储项
+        unique = blob_store.stats()["new_blobs"]
+    elapsed = time.perf_counter() - started
+    logger.info(f"去重{'预览' if dry_run else '完成'}：计算了 {files} 个文件的摘要（{hashed_bytes / (1024 * 1024):.1f} MB，"
+                f"{workers} 个进程，用时 {elapsed:.2f} 秒），跳过已在存储中的 {skipped[0]} 个；"
+                f"新内容 {unique} 个，{'可以' if dry_run else '已'}释放 {reclaimed / (1024 * 1024):.1f} MB")
+    if pruned:
+        logger.info(f"删除了 {pruned} 个没有文件引用的存储项，释放 {pruned_bytes / (1024 * 1024):.1f} MB")
+    blob_store.close()
+    return {"files": files, "skipped": skipped[0], "unique": unique, "reclaimed_bytes": reclaimed + pruned_bytes}
+
+
+def _reclaimed(sizes):
+    # 每个内容只保留一份时可以释放的字节数（不考虑已有的硬链接）；存储中已有的内容一份也不用保留
+    reclaimed = 0
+    for digest, group in sizes.items():
+        stored = blob_store.enabled and os.path.exists(blob_store.blob_path(digest))
+        reclaimed += sum(group) - (0 if stored else group[0])
+    return reclaimed
+
+
+def main(argv=None):
+    """main.py dedup 子命令."""
+    from pdi_config import config
+
+    parser = argparse.ArgumentParser(prog="main.py dedup", description="把已有的下载目录转换为去重存储（相同内容只保存一份）")
+    parser.add_argument("path", nargs="?", help="下载目录，默认为配置中的下载路径")
+    parser.add_argument("--workers", type=int, default=0, help="计算摘要的进程数，默认为 CPU 核数")
+    parser.add_argument("--dry-run", action="store_true", help="只统计可以释放的空间，不修改文件")
+    args = parser.parse_args(argv)
+
+    root = args.path or config.down_path
+    if not root or not os.path.isdir(root):
+        logger.error(f"下载目录 ({root}) 无效！")
+        return 1
+    dedup_library(root, os.path.join(root, BLOB_DIR), args.workers, args.dry_run)
+    if not config.dedup and not args.dry_run:
+        logger.info("在 PDI.ini 中设置 dedup = True，之后下载的图片也会写入去重存储")
+    return 0
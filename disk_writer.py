@@ -0,0 +1,478 @@
+# disk_writer.py
+# 写盘阶段：下载线程 / 协程只负责从网络读取数据块，交给独立的写盘线程写入 .part 和续传信息、刷盘和重命名，
+# 慢速磁盘（NAS、机械硬盘）刷盘时网络连接不会闲置，网络并发和写盘并发可以分别调整
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+
+from blob_store import blob_store
+from log_config import logger
+from tracing import tracer
+
+# fsync 策略：none 交给操作系统刷盘；file 每个文件重命名前 fsync；
+# artwork 同一作品的文件写完后保持打开，作品的所有页都结束时一起 fsync、重命名，再 fsync 一次目录
+FSYNC_MODES = ("none", "file", "artwork")
+
+_STOP = object()
+
+
+class WriteJob:
+    """
+    一个文件的写入任务.
+
+    下载端依次调用 write（可多次）、finish 或 abort，文件操作在写盘线程中按提交顺序执行；
+    同一作品目录的任务总是交给同一个写盘线程.
+    """
+
+    def __init__(self, writer, path, offset=0, total=None, meta=None):
+        self.writer = writer
+        self.path = os.fspath(path)
+        self.part_path = f"{self.path}.part"
+        self.directory = os.path.dirname(self.path)
+        self.offset = offset  # 续传的起始位置
+        self.total = total  # 完整文件的预期长度，用于预分配
+        self.meta = meta  # 续传信息，打开文件时写入 .part.json；None 表示不能续传
+        self.queue = writer.queue_for(self.directory)
+        self.tags = tracer.context()  # 被追踪的请求在写盘线程中继续记录 span
+        self.error = None  # 写盘线程中出现的错误
+        self.file = None  # 只在写盘线程中访问
+        self.written = 0
+        self.preallocated = False
+        self.hasher = None  # 启用去重存储时，写入的同时计算内容摘要
+
+    def check(self):
+        """写盘已经失败时抛出该错误，下载端不必再读取剩下的数据。"""
+        if self.error is not None:
+            raise self.error
+
+    def write(self, chunk, release=None):
+        """
+        提交一个数据块，写盘队列满时阻塞（背压）.
+
+        参数:
+            chunk (bytes): 数据块.
+            release (callable): 数据块写入后（或写盘失败后）在写盘线程中调用，用于归还在途字节额度.
+        """
+        self._put("write", (chunk, release))
+
+    def finish(self, on_done):
+        """所有数据已提交：写盘线程关闭文件、按 fsync 策略刷盘并重命名为正式文件，然后调用 on_done(error)。"""
+        self._put("finish", on_done)
+
+    def abort(self):
+        """下载中断：等待已提交的数据块写完并关闭文件，之后 .part 的大小就是下次续传的位置。"""
+        done = threading.Event()
+        self._put("abort", done)
+        done.wait()
+
+    async def async_write(self, chunk, release=None):
+        await self._async_put("write", (chunk, release))
+
+    async def async_finish(self, on_done):
+        await self._async_put("finish", on_done)
+
+    async def async_abort(self):
+        done = threading.Event()
+        await self._async_put("abort", done)
+        while not done.is_set():
+            await asyncio.sleep(0.005)
+
+    def _put(self, op, arg):
+        if self.queue is None:
+            self.writer.handle(self, op, arg)  # 没有写盘线程时在当前线程中直接执行
+            return
+        try:
+            self.queue.put_nowait((self, op, arg))
+        except queue.Full:
+            started = time.perf_counter()
+            self.queue.put((self, op, arg))
+            self.writer.record_wait(started, time.perf_counter())
+
+    async def _async_put(self, op, arg):
+        # 队列满时只挂起当前协程，不阻塞事件循环
+        if self.queue is None:
+            self.writer.handle(self, op, arg)
+            return
+        started = None
+        while True:
+            try:
+                self.queue.put_nowait((self, op, arg))
+                break
+            except queue.Full:
+                started = started or time.perf_counter()
+                await asyncio.sleep(0.005)
+        if started is not None:
+            self.writer.record_wait(started, time.perf_counter())
+
+
+class DiskWriter:
+    """
+    写盘线程池.
+
+    - 每个写盘线程有自己的有界队列，按作品目录分配，同一文件的操作保持顺序；
+    - preallocate 时按 Content-Length 预先分配文件空间，减少慢速磁盘上的碎片；
+    - 记录已经创建过的目录，同一目录只调用一次 os.makedirs；
+    - 启用去重存储时在写入数据块的同时计算摘要，重命名后把文件交给 blob_store，不需要再读一遍；
+    - artwork 策略下由 expect 登记作品要下载的页，所有页写完或放弃后一起刷盘；
+    - workers 为 0 时在下载线程中直接写盘（与以前相同）.
+    """
+
+    def __init__(self):
+        self.workers = 0
+        self.queue_size = 64
+        self.fsync = "none"
+        self.preallocate = False
+        self.queues = []
+        self.threads = []
+        self.created_dirs = set()
+        self.lock = threading.Lock()
+        self.batches = {}  # artwork 策略：目录 -> {"pending": 还没结束的页, "done": [(job, on_done), ...]}
+        self.reset_stats()
+
+    def configure(self, workers=2, queue_size=64, fsync="none", preallocate=False):
+        self.close()
+        self.workers = max(int(workers), 0)
+        self.queue_size = max(int(queue_size), 1)
+        self.fsync = fsync if fsync in FSYNC_MODES else "none"
+        self.preallocate = preallocate
+        self.queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        self.threads = [threading.Thread(target=self._worker, args=(q,), name=f"disk-writer-{index}", daemon=True)
+                        for index, q in enumerate(self.queues)]
+        for thread in self.threads:
+            thread.start()
+
+    def reset_stats(self):
+        with self.lock:
+            self.bytes = 0
+            self.write_seconds = 0.0
+            self.fsyncs = 0
+            self.fsync_seconds = 0.0
+            self.queue_waits = 0
+            self.queue_wait_seconds = 0.0
+
+    def open(self, path, offset=0, total=None, meta=None):
+        """为 path 创建写入任务，文件在第一次写入时才在写盘线程中打开。"""
+        return WriteJob(self, path, offset, total, meta)
+
+    def expect(self, paths):
+        """
+        artwork 策略：登记一个作品要下载的页（最终保存路径），这些页都写完或放弃后才一起刷盘.
+
+        没有登记的文件（例如单独重试的图片）写完后单独刷盘.
+        """
+        if self.fsync != "artwork":
+            return
+        with self.lock:
+            for path in paths:
+                path = os.fspath(path)
+                batch = self.batches.setdefault(os.path.dirname(path), {"pending": set(), "done": []})
+                batch["pending"].add(path)
+
+    def settle(self, path):
+        """artwork 策略：这一页不会再写入（已存在或放弃下载），不再等待它。"""
+        if self.fsync != "artwork":
+            return
+        path = os.fspath(path)
+        directory = os.path.dirname(path)
+        with self.lock:
+            batch = self.batches.get(directory)
+            if batch is None or path not in batch["pending"]:
+                return
+            batch["pending"].discard(path)
+            if batch["pending"]:
+                return
+            del self.batches[directory]
+        self._commit(directory, batch["done"])
+
+    def queue_for(self, directory):
+        if not self.queues:
+            return None
+        return self.queues[hash(directory) % len(self.queues)]
+
+    def ensure_dir(self, path):
+        """创建目录，本次运行中已经创建过的目录直接跳过。"""
+        path = os.fspath(path)
+        if path not in self.created_dirs:
+            os.makedirs(path, exist_ok=True)
+            self.created_dirs.add(path)
+
+    # ---- 写盘线程 ----
+
+    def _worker(self, q):
+        while True:
+            item = q.get()
+            if item is _STOP:
+                return
+            job, op, arg = item
+            try:
+                if job is None:
+                    arg.set()  # flush 标记：之前提交的操作都已完成
+                else:
+                    self.handle(job, op, arg)
+            except Exception as e:
+                logger.error(f"写盘任务出错：{e}")
+
+    def handle(self, job, op, arg):
+        with tracer.attach(job.tags):
+            if op == "write":
+                self._write(job, *arg)
+            elif op == "finish":
+                self._finish(job, arg)
+            else:
+                try:
+                    self._close_quietly(job)
+                finally:
+                    arg.set()
+
+    def _open(self, job):
+        self.ensure_dir(job.directory)
+        try:
+            file = open(job.part_path, "r+b" if job.offset else "wb")
+        except FileNotFoundError:
+            # 目录在本次运行中被移走（例如改名迁移），重新创建
+            self.created_dirs.discard(job.directory)
+            self.ensure_dir(job.directory)
+            file = open(job.part_path, "r+b" if job.offset else "wb")
+        meta_path = f"{job.part_path}.json"
+        if job.meta is not None:
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump(job.meta, f, ensure_ascii=False)
+        elif os.path.exists(meta_path):
+            os.remove(meta_path)  # 没有校验器时无法安全续传
+        if blob_store.enabled:
+            job.hasher = blob_store.hasher()
+            if job.offset:
+                _hash_prefix(file, job.offset, job.hasher)  # 续传时先补上已有部分的摘要
+        if job.offset:
+            file.truncate(job.offset)  # 丢弃上次中断时可能多写的部分
+            file.seek(job.offset)
+        if self.preallocate and job.total and job.total > job.offset:
+            job.preallocated = _preallocate(file, job.total)
+        job.file = file
+
+    def _write(self, job, chunk, release):
+        try:
+            if job.error is None:
+                if job.file is None:
+                    self._open(job)
+                started = time.perf_counter()
+                job.file.write(chunk)
+                if job.hasher is not None:
+                    job.hasher.update(chunk)
+                ended = time.perf_counter()
+                job.written += len(chunk)
+                tracer.add_span("disk_write", started, ended, bytes=len(chunk))
+                with self.lock:
+                    self.bytes += len(chunk)
+                    self.write_seconds += ended - started
+        except OSError as e:
+            job.error = e
+        finally:
+            if release is not None:
+                release()
+
+    def _finish(self, job, on_done):
+        error = job.error
+        if error is None:
+            try:
+                if job.file is None:
+                    self._open(job)  # 空文件
+                if self.fsync == "artwork":
+                    self._flush(job)  # 保持打开，等作品的其他页写完后一起 fsync
+                else:
+                    self._close(job, sync=self.fsync == "file")
+            except OSError as e:
+                error = e
+        if error is not None:
+            self._close_quietly(job)
+            _call(on_done, error)  # 失败的页由 on_done 记录失败时 settle
+            return
+
+        if self.fsync == "artwork":
+            with self.lock:
+                batch = self.batches.get(job.directory)
+                if batch is not None and job.path in batch["pending"]:
+                    batch["pending"].discard(job.path)
+                    batch["done"].append((job, on_done))
+                    if batch["pending"]:
+                        return
+                    del self.batches[job.directory]
+                    done = batch["done"]
+                else:
+                    done = [(job, on_done)]  # 没有登记的文件单独刷盘
+            self._commit(job.directory, done)
+            return
+        try:
+            self._rename(job)
+        except OSError as e:
+            error = e
+        _call(on_done, error)
+
+    def _rename(self, job):
+        with tracer.span("rename"):
+            os.replace(job.part_path, job.path)  # 原子替换，不会留下半截的正式文件
+        if job.hasher is not None:
+            with tracer.span("dedup"):
+                blob_store.adopt(job.path, job.hasher.hexdigest())
+
+    def _flush(self, job):
+        if job.preallocated:
+            job.file.truncate(job.offset + job.written)  # 去掉预分配但没有写入的部分
+            job.preallocated = False
+        job.file.flush()
+
+    def _close(self, job, sync=False):
+        try:
+            self._flush(job)
+            if sync:
+                self._fsync(job.file.fileno())
+        finally:
+            file, job.file = job.file, None
+            file.close()
+
+    def _close_quietly(self, job):
+        if job.file is not None:
+            try:
+                self._close(job)
+            except OSError as e:
+                logger.warning(f"关闭 {job.part_path} 失败：{e}")
+
+    def _fsync(self, fd):
+        started = time.perf_counter()
+        os.fsync(fd)
+        ended = time.perf_counter()
+        tracer.add_span("fsync", started, ended)
+        with self.lock:
+            self.fsyncs += 1
+            self.fsync_seconds += ended - started
+
+    def _commit(self, directory, done):
+        # artwork 策略：作品的文件都已写完并保持打开，依次 fsync 后关闭、重命名，最后 fsync 一次目录
+        results = []
+        for job, on_done in done:
+            with tracer.attach(job.tags):
+                try:
+                    self._close(job, sync=True)
+                    self._rename(job)
+                    results.append((on_done, None))
+                except OSError as e:
+                    self._close_quietly(job)
+                    results.append((on_done, e))
+        _fsync_dir(directory)
+        for on_done, error in results:
+            _call(on_done, error)
+
+    def flush(self):
+        """等待已经提交的写盘操作全部完成（包括完成回调），运行结束输出统计前调用。"""
+        events = []
+        for q in self.queues:
+            event = threading.Event()
+            q.put((None, "flush", event))
+            events.append(event)
+        for event in events:
+            event.wait()
+        with self.lock:
+            batches, self.batches = self.batches, {}
+        for directory, batch in batches.items():
+            # 没有结束的页（例如下载线程异常退出）不再等待，已经写完的文件照常提交
+            if batch["done"]:
+                self._commit(directory, batch["done"])
+
+    def close(self):
+        self.flush()
+        for q in self.queues:
+            q.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        self.queues = []
+        self.threads = []
+
+    def record_wait(self, started, ended):
+        # 写盘队列满，下载端等待的时间
+        tracer.add_span("disk_queue_wait", started, ended)
+        with self.lock:
+            self.queue_waits += 1
+            self.queue_wait_seconds += ended - started
+
+    def depths(self):
+        return {str(index): q.qsize() for index, q in enumerate(self.queues)}
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "fsync": self.fsync,
+                "bytes": self.bytes,
+                "write_seconds": round(self.write_seconds, 3),
+                "fsyncs": self.fsyncs,
+                "fsync_seconds": round(self.fsync_seconds, 3),
+                "queue_waits": self.queue_waits,
+                "queue_wait_seconds": round(self.queue_wait_seconds, 3),
+            }
+
+    def log_stats(self):
+        disk_stats = self.stats()
+        if not disk_stats["bytes"]:
+            return
+        logger.info(f"写盘：{disk_stats['bytes'] / (1024 * 1024):.1f} MB，写入耗时 {disk_stats['write_seconds']:.2f} 秒，"
+                    f"fsync {disk_stats['fsyncs']} 次 {disk_stats['fsync_seconds']:.2f} 秒，"
+                    f"队列满等待 {disk_stats['queue_waits']} 次 {disk_stats['queue_wait_seconds']:.2f} 秒")
+
+
+def _preallocate(file, size):
+    # 按 Content-Length 预先分配空间；没有 posix_fallocate 时（Windows）扩展文件长度，NTFS 会实际分配
+    file.flush()
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(file.fileno(), 0, size)
+            return True
+        except OSError:
+            pass  # 文件系统不支持时退回扩展文件长度
+    try:
+        file.truncate(size)
+    except OSError:
+        return False
+    return True
+
+
+def _hash_prefix(file, length, hasher):
+    # 从头读取续传文件中已有的 length 字节计入摘要，读完后由调用方定位到续传位置
+    file.seek(0)
+    buffer = bytearray(1024 * 1024)
+    view = memoryview(buffer)
+    while length > 0:
+        read = file.readinto(view[:min(length, len(buffer))])
+        if not read:
+            break
+        hasher.update(view[:read])
+        length -= read
+
+
+def _fsync_dir(path):
+    # 让目录中的重命名落盘；Windows 不能打开目录，跳过
+    if os.name == "nt":
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _call(on_done, error):
+    try:
+        on_done(error)
+    except Exception as e:
+        logger.error(f"写盘完成回调出错：{e}")
+
+
+# 全局写盘线程池
+disk_writer = DiskWriter()
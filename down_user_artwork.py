@@ -1,13 +1,14 @@
 # 下载用户的所有作品
 
 from pdi_config import config
-
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from log_config import logger
+from manifest import manifest
+from library_index import library_index
 
 
-def download_user_artworks(user_id, down_path, artwork_threads, img_threads):
-    from user_artworks import fetch_user_artworks
+def download_user_artworks(user_id, pipeline):
+    """获取用户的作品列表，把需要下载的作品提交到下载流水线该用户的子队列（不等待完成）。"""
+    from user_artworks import fetch_artwork_metadata, fetch_user_artworks
     HRADERS = config.HEADERS
     COOKIES = config.COOKIES
     artwork_ids = fetch_user_artworks(user_id, HRADERS, COOKIES)
@@ -16,16 +17,14 @@ def download_user_artworks(user_id, down_path, artwork_threads, img_threads):
         logger.warning(f"用户 {user_id} 没有作品可下载，跳过该用户。")
         return
 
-    logger.info(f"开始下载用户 {user_id} 的 {len(artwork_ids)} 个作品...")
+    # 只为新作品和未完成的作品请求元数据
+    artwork_ids = manifest.pending(artwork_ids, label=f"用户 {user_id}：")
+    artwork_ids = library_index.pending(artwork_ids, label=f"用户 {user_id}：")
+    # 批量获取剩余作品的信息，之后逐个作品的元数据请求大多可以省掉
+    fetch_artwork_metadata(user_id, artwork_ids, HRADERS, COOKIES)
 
-    # 为每个作品 ID 启动下载任务
-    # print("这是art_threads在调用前的类型",type(artwork_threads))
-    with ThreadPoolExecutor(max_workers=artwork_threads) as user_executor:
-        futures = []
-        from artwork_down import download_artwork_images
-        for artwork_id in artwork_ids:
-            futures.append(user_executor.submit(download_artwork_images, artwork_id, user_id, down_path, img_threads))
+    logger.info(f"开始下载用户 {user_id} 的 {len(artwork_ids)} 个作品...")
 
-        # 等待所有作品下载任务完成
-        for future in as_completed(futures):
-            future.result()
+    # 为每个作品 ID 提交下载任务，由流水线统一调度
+    for artwork_id in artwork_ids:
+        pipeline.add_artwork(artwork_id, user_id)
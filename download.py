@@ -1,27 +1,230 @@
 import os
+import functools
+import itertools
 import json
+import time
 import re
+import threading
 import rate_limited_requests as requests
+from rate_limited_requests import _rate_limiter
+from handle_429 import controller
 from pathlib import Path
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from transport import transport
+from retry_policy import retry_policy
+from disk_writer import disk_writer
+from bandwidth import bandwidth
 from urllib3.exceptions import IncompleteRead
 from log_config import logger
+from pdi_config import config
+from manifest import manifest, parse_image_name
+from error_journal import error_journal
+from stats import stats
+from metrics import metrics
+from tracing import tracer
 
 
-# 创建一个会自动重试的 requests session
-def get_session():
-    session = requests.Session()
-    retry = Retry(
-        total=3,  # 设置最大重试次数
-        backoff_factor=1,  # 设置每次重试的等待时间间隔（即 1, 2, 4 秒递增）
-        status_forcelist=[500, 502, 503, 504, 429],  # 针对这些 HTTP 错误进行重试
-        allowed_methods=["GET"],  # 对 GET 请求进行重试（已更新为 allowed_methods）
-    )
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
+class InflightBudget:
+    """
+    全局在途字节预算：所有下载线程读取数据块前先申请额度，写入磁盘后归还，
+    保证同时驻留在内存中的图片数据不超过 max_bytes。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def configure(self, max_bytes):
+        with self.condition:
+            self.max_bytes = max(int(max_bytes), 1)
+            self.condition.notify_all()
+
+    def acquire(self, nbytes):
+        # 单块超过预算时按整个预算计算，避免永远等不到
+        nbytes = min(nbytes, self.max_bytes)
+        with self.condition:
+            while self.in_flight + nbytes > self.max_bytes:
+                self.condition.wait()
+            self.in_flight += nbytes
+        return nbytes
+
+    def release(self, nbytes):
+        with self.condition:
+            self.in_flight -= nbytes
+            self.condition.notify_all()
+
+
+# 全局在途字节预算
+inflight_budget = InflightBudget()
+
+
+def part_path_for(path):
+    # 下载中的临时文件路径，完成后原子重命名为正式文件
+    return f"{path}.part"
+
+
+def resume_meta_path_for(path):
+    # 断点续传信息：总长度和校验器（ETag / Last-Modified）
+    return f"{path}.part.json"
+
+
+def resume_request_headers(save_path_with_ext):
+    """
+    根据已有的 .part 文件生成续传请求头.
+
+    返回:
+        tuple: (额外请求头 dict, 已下载字节数)；不能续传时为 ({}, 0).
+    """
+    part_path = part_path_for(save_path_with_ext)
+    meta_path = resume_meta_path_for(save_path_with_ext)
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        offset = os.path.getsize(part_path)
+    except (OSError, ValueError):
+        return {}, 0
+
+    validator = meta.get("etag") or meta.get("last_modified")
+    total = meta.get("length")
+    if not validator or not offset or (total is not None and offset >= total):
+        return {}, 0
+
+    logger.debug(f"从第 {offset} 字节续传: {save_path_with_ext}")
+    return {"Range": f"bytes={offset}-", "If-Range": validator}, offset
+
+
+def resume_offset(status_code, response_headers, offset):
+    """
+    判断服务器是否接受了 Range 请求.
+
+    返回:
+        int | None: 本次响应体应追加写入的起始位置；服务器忽略 Range（返回 200）时为 0，需要完整下载；
+            206 的 Content-Range 起始位置与请求的不同（或无法解析）时为 None，这段数据不能写入文件，
+            调用方应和 416 一样丢弃 .part，不带 Range 重新请求.
+    """
+    if status_code != 206:
+        return 0
+    match = re.match(r"bytes (\d+)-\d+/(\d+|\*)", response_headers.get("Content-Range", ""))
+    if not match or int(match.group(1)) != offset:
+        return None
+    return offset
+
+
+def expected_total_length(status_code, response_headers, offset):
+    # 完整文件的预期长度：206 从 Content-Range 取，200 从 Content-Length 取
+    if status_code == 206:
+        match = re.match(r"bytes \d+-\d+/(\d+)", response_headers.get("Content-Range", ""))
+        if match:
+            return int(match.group(1))
+    length = response_headers.get("Content-Length")
+    return offset + int(length) if length is not None else None
+
+
+def resume_state(url, response_headers, total):
+    """
+    续传信息，由写盘线程在写入响应体之前保存，进程被杀时也能在下次运行时续传.
+
+    返回:
+        dict | None: 没有 ETag / Last-Modified 时无法安全续传，返回 None.
+    """
+    meta = {
+        "url": url,
+        "length": total,
+        "etag": response_headers.get("ETag"),
+        "last_modified": response_headers.get("Last-Modified"),
+    }
+    if not meta["etag"] and not meta["last_modified"]:
+        return None
+    return meta
+
+
+def clear_resume_state(save_path_with_ext):
+    for path in (resume_meta_path_for(save_path_with_ext), part_path_for(save_path_with_ext)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def stream_to_file(response, save_path_with_ext, chunk_size=None, offset=0, on_done=None):
+    """
+    分块读取响应体，交给写盘线程写入 .part 临时文件，完整后由写盘线程原子重命名为正式文件.
+    中断时如果服务器提供了 ETag / Last-Modified，保留 .part 供下次用 Range 续传.
+
+    参数:
+        response (requests.Response): 以 stream=True 发出的响应.
+        save_path_with_ext (str | Path): 最终保存路径.
+        chunk_size (int): 每次读取的字节数，默认取配置中的 chunk_size.
+        offset (int): 续传的起始位置，0 表示从头下载.
+        on_done (callable): 写盘线程重命名完成（或写盘失败）后调用 on_done(error)，error 为 None 表示成功.
+
+    返回:
+        int: 本次读取的字节数.
+    """
+    chunk_size = chunk_size or config.chunk_size
+    total = expected_total_length(response.status_code, response.headers, offset)
+    meta = resume_state(response.url, response.headers, total)
+    resumable = meta is not None
+    job = disk_writer.open(save_path_with_ext, offset, total, meta)
+    user_id = user_id_for(save_path_with_ext)
+    written = 0
+
+    try:
+        chunks = response.iter_content(chunk_size=chunk_size)
+        while True:
+            job.check()  # 写盘失败时不再继续读取
+            # 额度在写盘线程写入数据块之后才归还，内存中排队的数据不超过 max_inflight_bytes
+            reserved = inflight_budget.acquire(chunk_size)
+            granted = False
+            try:
+                # 读取之前申请带宽，读得慢时 TCP 窗口收缩，实际占用的链路带宽也随之降低
+                acquire_bandwidth(user_id, chunk_size)
+                granted = True
+                chunk = next(chunks, None)
+            except BaseException:
+                inflight_budget.release(reserved)
+                if granted:
+                    bandwidth.refund(user_id, chunk_size)
+                raise
+            bandwidth.refund(user_id, chunk_size - len(chunk or b""))
+            if chunk is None:
+                inflight_budget.release(reserved)
+                break
+            job.write(chunk, functools.partial(inflight_budget.release, reserved))
+            written += len(chunk)
+
+        if total is not None and offset + written != total:
+            raise IncompleteRead(offset + written, total - offset - written)
+    except BaseException:
+        # 等待已提交的数据块写完，可续传时保留 .part 和续传信息，否则删除，避免留下无法校验的半截文件
+        job.abort()
+        if not resumable:
+            clear_resume_state(save_path_with_ext)
+        raise
+    finally:
+        response.close()
+
+    job.finish(on_done or (lambda error: None))
+    return written
+
+
+def acquire_bandwidth(user_id, nbytes):
+    # 带宽整形的等待只在被追踪的请求中记录为 span
+    started = time.perf_counter()
+    waited = bandwidth.acquire(user_id, nbytes)
+    if waited:
+        tracer.add_span("bandwidth_wait", started, started + waited, bytes=nbytes)
+
+
+def image_written(img_url, save_path, save_path_with_ext, error_dict_file="error.json"):
+    """生成写盘完成的回调（在写盘线程中调用），线程版与异步版共用。"""
+    def on_done(error):
+        if error is None:
+            clear_resume_state(save_path_with_ext)
+            record_image_success(save_path, save_path_with_ext)
+        else:
+            # 磁盘写入失败（例如空间不足），重新下载比续传可靠
+            clear_resume_state(save_path_with_ext)
+            record_image_failure(img_url, save_path, save_path_with_ext, error, error_dict_file)
+    return on_done
 
 
 # 清理文件路径中的非法字符
@@ -53,93 +256,154 @@ def clean_path(path):
     return Path(*cleaned_parts)
 
 
-def download_image(
-        img_url, save_path, headers, cookies, user_stats, skipped_stats,
-        error_dict_file="error.json", max_retries=3
-):
-    session = get_session()  # 使用自定义的带有重试机制的 session
-    retry_count = 0  # 记录单图片的重试次数
-    success = False  # 是否成功下载标志
+def image_path_with_ext(save_path, img_url):
+    # 根据图片 URL 推断扩展名，生成清理后的完整保存路径
+    ext = "jpg" if img_url.lower().endswith(".jpg") else "png"
+    return clean_path(f"{save_path}.{ext}")
 
-    # 确保作品名称中的非法字符被清理
-    save_path = clean_path(save_path)
 
-    # 确保目录路径合法并存在
-    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+def record_file_exists(save_path_with_ext):
+    stats.skip("file_exists", save_path_with_ext)  # 计入跳过的总图片数量
+    logger.debug(f"文件已存在，跳过下载: {save_path_with_ext}")
+    manifest.record_page(save_path_with_ext)
+    error_journal.record_image_resolved(str(save_path_with_ext))
+    disk_writer.settle(save_path_with_ext)
 
-    while retry_count < max_retries and not success:
-        try:
-            ext = "jpg" if img_url.lower().endswith(".jpg") else "png"
-            save_path_with_ext = f"{save_path}.{ext}"
-            save_path_with_ext = clean_path(save_path_with_ext)  # 再次清理完整路径
 
-            # 检查文件是否已经存在
-            if os.path.exists(save_path_with_ext):
-                skipped_stats["file_exists"][save_path_with_ext] = skipped_stats["file_exists"].get(save_path_with_ext,
-                                                                                                    0) + 1
-                skipped_stats["skipped_images_count"] += 1  # 跳过的总图片数量
-                logger.debug(f"文件已存在，跳过下载: {save_path_with_ext}")
-                return
+def user_id_for(save_path):
+    # 用户目录为 {用户名}-{用户ID}
+    return Path(save_path).parts[-3].rsplit("-", 1)[-1]
 
-            # 下载图片
-            logger.debug(f"开始下载图片: {img_url} 到 {save_path_with_ext}")
-            response = session.get(img_url, headers=headers, cookies=cookies, timeout=(5, 5))
-            response.raise_for_status()  # 如果状态码不是 200，会抛出异常
 
-            # 保存图片到文件
-            with open(save_path_with_ext, "wb") as file:
-                file.write(response.content)
+def record_image_success(save_path, save_path_with_ext):
+    # 更新统计数据
+    user_id = user_id_for(save_path)  # 提取用户 ID
+    stats.count_user("success", user_id, "images")
+    logger.debug(f"图片已成功保存到: {save_path_with_ext}")
+    manifest.record_page(save_path_with_ext)
+    error_journal.record_image_resolved(str(save_path_with_ext))
 
-            # 更新统计数据
-            user_id = Path(save_path).parts[-2]  # 提取用户 ID
-            if user_id not in user_stats:
-                user_stats[user_id] = {"artworks": 0, "images": 0}
 
-            user_stats[user_id]["images"] += 1
-            logger.debug(f"图片已成功保存到: {save_path_with_ext}")
-            success = True  # 标记为成功下载
+def record_image_failure(img_url, save_path, save_path_with_ext, e, error_dict_file="error.json"):
+    """
+    重试耗尽后记录图片下载失败的信息，线程版与异步版共用.
+    失败记录追加到错误日志，运行结束时由 error_journal.export() 统一导出为 error_dict_file.
+    """
+    try:
+        # 获取路径信息（清理非法字符后的信息）
+        user_name = clean_path(Path(save_path).parts[-3])  # 用户名称
+        artwork_name = clean_path(Path(save_path).parts[-2])  # 作品名称
 
-        except (requests.exceptions.RequestException, IncompleteRead) as e:
-            retry_count += 1
-            logger.warning(f"下载失败，重试 {retry_count}/{max_retries} 次: {img_url}")
+        error_journal.record_image(img_url, save_path, save_path_with_ext, user_name, artwork_name, e)
 
-            # 如果达到最大重试次数，记录错误
-            if retry_count == max_retries:
-                try:
-                    # 获取路径信息（清理非法字符后的信息）
-                    user_name = clean_path(Path(save_path).parts[-3])  # 用户名称
-                    artwork_name = clean_path(Path(save_path).parts[-2])  # 作品名称
-                    artwork_id = Path(save_path).parts[-1]  # 作品 ID
+        # 更新统计数据
+        stats.skip("download_failed", save_path)
 
-                    # 生成图片的唯一键
-                    image_seq = len(skipped_stats["error_dict"].get(user_name, {}).get(artwork_name, {})) + 1
-                    image_key = f"{artwork_name}-{artwork_id}-{image_seq}"
+        logger.error(f"下载图片 {save_path_with_ext} 失败: {e}")
 
-                    # 错误信息
-                    error_info = {
-                        "url": img_url,
-                        "最终保存路径": save_path_with_ext,
-                        "图片错误原因": str(e),
-                    }
+    except Exception as err:
+        logger.error(f"记录错误到 {error_journal.path} 失败: {err}")
+    finally:
+        disk_writer.settle(save_path_with_ext)  # 这一页不会再写入，作品的其他页不必再等它刷盘
 
-                    # 更新错误字典
-                    if user_name not in skipped_stats["error_dict"]:
-                        skipped_stats["error_dict"][user_name] = {}
 
-                    if artwork_name not in skipped_stats["error_dict"][user_name]:
-                        skipped_stats["error_dict"][user_name][artwork_name] = {}
+def download_image(
+        img_url, save_path, headers, cookies, error_dict_file="error.json", max_retries=None, defer=False,
+        deferred_since=None
+):
+    artwork_id, page = parse_image_name(save_path)
+    with tracer.request("download_image", artwork_id=artwork_id, page=page):
+        return _download_image(img_url, save_path, headers, cookies, error_dict_file, max_retries, defer,
+                               deferred_since)
 
-                    skipped_stats["error_dict"][user_name][artwork_name][image_key] = error_info
 
-                    # 更新统计数据
-                    skipped_stats["download_failed"][save_path] = skipped_stats["download_failed"].get(save_path, 0) + 1
-                    skipped_stats["skipped_images_count"] += 1
+def _download_image(img_url, save_path, headers, cookies, error_dict_file="error.json", max_retries=None,
+                    defer=False, deferred_since=None):
+    # max_retries 为单张图片的尝试次数上限，默认使用 retry_policy 的配置；
+    # defer 为 True 时原图主机熔断不在这里等待，抛出 CircuitDeferred 由下载流水线放回队列，
+    # deferred_since 为这张图片第一次被推迟的时间
 
-                    # 确保可以写入错误信息到文件
-                    with open(error_dict_file, "w", encoding="utf-8") as f:
-                        json.dump(skipped_stats["error_dict"], f, ensure_ascii=False, indent=4)
+    # 确保作品名称中的非法字符被清理
+    save_path = clean_path(save_path)
+    save_path_with_ext = image_path_with_ext(save_path, img_url)
 
-                    logger.error(f"下载图片 {save_path_with_ext} 失败: {e}")
+    # 目录由写盘线程在第一次写入时创建
+    for attempt in itertools.count():
+        ticket = None
+        try:
+            # 检查文件是否已经存在
+            if os.path.exists(save_path_with_ext):
+                record_file_exists(save_path_with_ext)
+                return
 
-                except Exception as err:
-                    logger.error(f"记录错误到 {error_dict_file} 失败: {err}")
+            # 下载图片
+            logger.debug(f"开始下载图片: {img_url} 到 {save_path_with_ext}")
+            if defer:
+                ticket = retry_policy.acquire(img_url, "image", deferred_since)
+            else:
+                ticket = retry_policy.wait_acquire(img_url, "image")  # 原图主机熔断时等待探测请求成功
+            with tracer.span("throttle_wait", host="image"):
+                controller.acquire(img_url)  # 等待 Retry-After 窗口结束并占用并发名额
+            status_code = None
+            retry_after = None
+            written = 0
+            started = None
+            try:
+                with tracer.span("rate_limit_wait", host="image"):
+                    _rate_limiter.wait(img_url)  # 原图主机的令牌桶（默认不限速）
+                started = time.perf_counter()
+                while True:
+                    range_headers, offset = resume_request_headers(save_path_with_ext)
+                    with tracer.span("ttfb", url=img_url, attempt=attempt) as span:
+                        # stream=True 时在收到响应头后返回，其中包含建立连接 / TLS 的时间
+                        response = transport.request("GET", img_url, headers={**headers, **range_headers},
+                                                     cookies=cookies, timeout=(5, 5), stream=True)
+                        span.set(status=response.status_code)
+                    if response.status_code == 416:
+                        # 续传范围无效（文件已变化），丢弃 .part 后重新下载
+                        clear_resume_state(save_path_with_ext)
+                    if not response.ok:
+                        status_code = response.status_code
+                        retry_after = response.headers.get("Retry-After")
+                        response.close()
+                    response.raise_for_status()  # 如果状态码不是 200，会抛出异常
+
+                    # 分块流式写入 .part 文件，完成后再重命名；服务器忽略 Range 时从头写
+                    requested = offset
+                    offset = resume_offset(response.status_code, response.headers, offset)
+                    if offset is not None:
+                        break
+                    # 206 的起始位置与续传位置不同：和 416 一样丢弃 .part，不带 Range 重新请求
+                    response.close()
+                    clear_resume_state(save_path_with_ext)
+                    content_range = response.headers.get("Content-Range")
+                    if not requested:
+                        raise requests.exceptions.HTTPError(f"没有请求 Range 却收到 206（{content_range}）",
+                                                            response=response)
+                    logger.warning(f"续传位置 {requested} 与响应的 Content-Range（{content_range}）不符，重新下载: {img_url}")
+                with tracer.span("body", offset=offset) as span:
+                    written = stream_to_file(response, save_path_with_ext, offset=offset,
+                                             on_done=image_written(img_url, save_path, save_path_with_ext,
+                                                                   error_dict_file))
+                    span.set(bytes=written)
+                status_code = response.status_code
+            finally:
+                # 429/503 会让控制器降速并暂停所有线程；传输中断（status_code 为 None）不调整
+                controller.release(img_url, status_code, retry_after)
+                if started is not None:
+                    metrics.observe_request("image", "image", time.perf_counter() - started,
+                                            status_code or "error", written)
+
+            retry_policy.succeeded(img_url, ticket)  # 写盘完成后由 image_written 记录成功
+            return
+
+        except (requests.exceptions.RequestException, IncompleteRead) as e:
+            # 是否重试、等待多久由统一的重试策略决定（退避、预算、熔断器）
+            delay = retry_policy.failed(img_url, "image", attempt, error=e, max_attempts=max_retries, ticket=ticket)
+            if delay is None:
+                logger.warning(f"下载失败，不再重试（已尝试 {attempt + 1} 次）: {img_url}")
+                record_image_failure(img_url, save_path, save_path_with_ext, e, error_dict_file)
+                return
+            logger.warning(f"下载失败，{delay:.1f} 秒后重试（第 {attempt + 1} 次重试）: {img_url}")
+            metrics.count_retry("image")
+            time.sleep(delay)
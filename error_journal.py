@@ -0,0 +1,199 @@
+# error_journal.py
+# 错误日志：失败记录由单独的写线程追加到 JSONL 文件，批量刷盘；运行结束时再导出为 error.json
+import json
+import os
+import queue
+import threading
+import time
+
+from log_config import logger
+
+_STOP = object()
+
+
+class ErrorJournal:
+    """
+    追加写入的错误日志。
+
+    - record_* 只把记录放进队列，由唯一的写线程追加到 path，每 batch_size 条或 flush_interval 秒刷盘一次；
+    - export() 读取日志，生成 error.json（图片失败）和 error_artworks.json（作品失败）；
+    - unresolved() 返回仍未成功的失败记录，供“只重试失败项”模式使用。
+    """
+
+    def __init__(self, path="error_journal.jsonl", batch_size=100, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.writer = None
+        self.lock = threading.Lock()
+        self.failed_paths = set()  # 记录过失败的图片（最终保存路径），成功后追加 resolved 记录
+        self.failed_artworks = set()
+
+    def open(self, path):
+        with self.lock:
+            if self.writer is not None:
+                raise RuntimeError("错误日志已经在写入，不能更换路径")
+            self.path = path
+        # 只加载仍未解决的记录，已经解决过的项再次成功时不会重复写 resolved 记录
+        images, artworks = self.unresolved()
+        with self.lock:
+            self.failed_paths = {record.get("最终保存路径") for record in images}
+            self.failed_artworks = {str(record.get("artwork_id")) for record in artworks}
+
+    def _ensure_writer(self):
+        if self.writer is None:
+            with self.lock:
+                if self.writer is None:
+                    self.writer = threading.Thread(target=self._write_loop, name="error-journal", daemon=True)
+                    self.writer.start()
+
+    def _put(self, record):
+        record.setdefault("time", time.time())
+        self._ensure_writer()
+        self.queue.put(record)
+
+    def record_image(self, img_url, save_path, save_path_with_ext, user_name, artwork_name, error):
+        with self.lock:
+            self.failed_paths.add(str(save_path_with_ext))
+        self._put({
+            "type": "image",
+            "url": img_url,
+            "save_path": str(save_path),
+            "最终保存路径": str(save_path_with_ext),
+            "user_name": str(user_name),
+            "artwork_name": str(artwork_name),
+            "图片错误原因": str(error),
+        })
+
+    def record_artwork(self, artwork_id, user_id, illust_title, error_details):
+        with self.lock:
+            self.failed_artworks.add(str(artwork_id))
+        self._put({
+            "type": "artwork",
+            "artwork_id": str(artwork_id),
+            "user_id": None if user_id is None else str(user_id),
+            "illust_title": illust_title,
+            "details": error_details,
+        })
+
+    def record_image_resolved(self, save_path_with_ext):
+        # 只有之前失败过的图片才需要记录，避免每张成功的图片都写一行；多个下载线程同时调用，检查和删除在锁内完成
+        with self.lock:
+            if save_path_with_ext not in self.failed_paths:
+                return
+            self.failed_paths.discard(save_path_with_ext)
+        self._put({"type": "image_resolved", "最终保存路径": save_path_with_ext})
+
+    def record_artwork_resolved(self, artwork_id):
+        with self.lock:
+            if str(artwork_id) not in self.failed_artworks:
+                return
+            self.failed_artworks.discard(str(artwork_id))
+        self._put({"type": "artwork_resolved", "artwork_id": str(artwork_id)})
+
+    def _write_loop(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                try:
+                    record = self.queue.get(timeout=max(deadline - time.monotonic(), 0.01))
+                except queue.Empty:
+                    record = None
+                if record is not None and record is not _STOP:
+                    batch.append(json.dumps(record, ensure_ascii=False))
+                if batch and (record is _STOP or len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                    f.write("\n".join(batch) + "\n")
+                    f.flush()
+                    batch.clear()
+                if time.monotonic() >= deadline:
+                    deadline = time.monotonic() + self.flush_interval
+                if record is _STOP:
+                    return
+
+    def close(self):
+        """刷出所有排队的记录并停止写线程。"""
+        with self.lock:
+            writer, self.writer = self.writer, None
+        if writer is not None:
+            self.queue.put(_STOP)
+            writer.join()
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning(f"错误日志 {self.path} 中有无法解析的行，已忽略")
+
+    def unresolved(self):
+        """
+        读取日志，返回仍未成功的失败记录（同一图片（按最终保存路径）或作品只保留最后一条）.
+
+        返回:
+            tuple: (图片失败记录列表, 作品失败记录列表).
+        """
+        images, artworks = {}, {}
+        for record in self._read():
+            kind = record.get("type")
+            if kind == "image":
+                images[record["最终保存路径"]] = record
+            elif kind == "image_resolved":
+                images.pop(record["最终保存路径"], None)
+            elif kind == "artwork":
+                artworks[record["artwork_id"]] = record
+            elif kind == "artwork_resolved":
+                artworks.pop(record["artwork_id"], None)
+        return list(images.values()), list(artworks.values())
+
+    def export(self, error_dict_file="error.json", artwork_error_file="error_artworks.json"):
+        """
+        把未解决的失败记录导出为原来的 error.json 格式：
+        {用户名: {作品名: {图片键: {"url", "最终保存路径", "图片错误原因"}}}}，
+        作品级失败导出为 {用户ID: {作品标题: [错误详情, ...]}}.
+        """
+        self.close()
+        images, artworks = self.unresolved()
+
+        error_dict = {}
+        for record in images:
+            artwork_errors_of = error_dict.setdefault(record["user_name"], {}).setdefault(record["artwork_name"], {})
+            # 图片键与原来一致：{作品名}-{图片文件名}-{序号}
+            image_name = os.path.basename(record["save_path"])
+            image_key = f"{record['artwork_name']}-{image_name}-{len(artwork_errors_of) + 1}"
+            artwork_errors_of[image_key] = {
+                "url": record["url"],
+                "最终保存路径": record["最终保存路径"],
+                "图片错误原因": record["图片错误原因"],
+            }
+        artwork_errors = {}
+        for record in artworks:
+            artwork_errors.setdefault(str(record["user_id"]), {}).setdefault(
+                str(record["illust_title"]), []).append(record["details"])
+
+        with open(error_dict_file, "w", encoding="utf-8") as f:
+            json.dump(error_dict, f, ensure_ascii=False, indent=4)
+        with open(artwork_error_file, "w", encoding="utf-8") as f:
+            json.dump(artwork_errors, f, ensure_ascii=False, indent=4)
+        logger.info(f"已导出 {len(images)} 条图片错误到 {error_dict_file}，{len(artworks)} 条作品错误到 {artwork_error_file}")
+
+    def compact(self):
+        """只保留未解决的失败记录，重写日志文件。"""
+        self.close()
+        images, artworks = self.unresolved()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in images + artworks:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+
+
+# 全局错误日志
+error_journal = ErrorJournal()
@@ -1,11 +1,277 @@
-import random
+import collections
+import threading
 import time
+
+from http_pool import host_class
 from log_config import logger
 
+THROTTLE_STATUSES = (429, 503)  # 这些状态码视为被限流
+
+
+class HostState:
+    """单个主机类别（api / image）的自适应状态。"""
+
+    def __init__(self, name, limit, max_limit):
+        self.name = name
+        self.limit = limit  # 当前允许的并发数
+        self.max_limit = max_limit  # 并发上限（线程数）
+        self.in_flight = 0
+        self.successes = 0  # 距离上次加并发的成功次数
+        self.pause_until = 0.0  # Retry-After 窗口结束时间（time.monotonic）
+        self.last_decrease = 0.0
+        self.throttles = 0  # 收到 429/503 的次数
+        self.increases = 0
+        self.decreases = 0
+
+
+class AdaptiveController:
+    """
+    AIMD 自适应控制器：按主机类别管理实际并发数和请求速率。
+
+    - 收到 429/503 时并发数和速率乘性减半，并让该主机的所有线程一起暂停 Retry-After 秒；
+    - 连续成功时并发数和速率加性增长，逐步逼近上限；
+    - 状态变化都会记录到 history，便于查看吞吐量为什么变化。
+    """
+
+    def __init__(self, decrease_factor=0.5, rate_step=0.05, min_rate=0.2, max_rates=None,
+                 default_pause=5, enabled=True):
+        self.decrease_factor = decrease_factor
+        self.rate_step = rate_step  # 每次成功增加的请求速率（次/秒）
+        self.min_rate = min_rate
+        self.max_rates = max_rates or {}  # 主机类别 -> 速率上限
+        self.default_pause = default_pause  # 没有 Retry-After 时的暂停秒数
+        self.enabled = enabled
+        self.rate_limiter = None
+        self.hosts = {}
+        self.history = collections.deque(maxlen=200)
+        self.condition = threading.Condition()
+        self.async_waiters = {}  # 主机类别 -> deque[(事件循环, future)]，名额已满时排队的协程
+
+    def attach(self, rate_limiter):
+        # 绑定令牌桶限速器，由控制器调整其速率
+        self.rate_limiter = rate_limiter
+
+    def configure(self, limits, max_rates, enabled=True):
+        """
+        参数:
+            limits (dict): 主机类别 -> 最大并发数.
+            max_rates (dict): 主机类别 -> 请求速率上限（次/秒）.
+            enabled (bool): 关闭时只统计，不限制并发也不调整速率.
+        """
+        with self.condition:
+            self.enabled = enabled
+            self.max_rates = dict(max_rates)
+            self.hosts = {name: HostState(name, limit, limit) for name, limit in limits.items()}
+            self.condition.notify_all()
+            for waiters in self.async_waiters.values():
+                while waiters:
+                    _wake(*waiters.popleft())
+
+    def _state(self, name):
+        state = self.hosts.get(name)
+        if state is None:
+            state = self.hosts[name] = HostState(name, 1 << 16, 1 << 16)
+        return state
+
+    def pause_remaining(self, url):
+        """返回该主机还需要暂停的秒数（不阻塞）。"""
+        with self.condition:
+            return max(self._state(host_class(url)).pause_until - time.monotonic(), 0.0)
+
+    def acquire(self, url):
+        """阻塞直到暂停窗口结束且有空闲的并发名额。"""
+        with self.condition:
+            state = self._state(host_class(url))
+            while self.enabled:
+                remaining = state.pause_until - time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                elif state.in_flight >= state.limit:
+                    self.condition.wait()
+                else:
+                    break
+            state.in_flight += 1
+
+    async def async_acquire(self, url):
+        """
+        acquire 的协程版本：暂停窗口内只睡一次到窗口结束，名额已满时排队等待 release() 唤醒，不轮询.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        name = host_class(url)
+        while True:
+            with self.condition:
+                state = self._state(name)
+                remaining = state.pause_until - time.monotonic()
+                if not self.enabled or (remaining <= 0 and state.in_flight < state.limit):
+                    state.in_flight += 1
+                    return
+                if remaining <= 0:
+                    waiter = (loop, loop.create_future())
+                    self.async_waiters.setdefault(name, collections.deque()).append(waiter)
+            if remaining > 0:
+                await asyncio.sleep(remaining)  # 窗口可能被延长，醒来后重新检查
+                continue
+            try:
+                await waiter[1]
+            except asyncio.CancelledError:
+                with self.condition:
+                    waiters = self.async_waiters.get(name)
+                    if waiter in waiters:
+                        waiters.remove(waiter)
+                    else:
+                        self._wake_async(self._state(name), 1)  # 已经被唤醒但没有使用，转给下一个
+                raise
+
+    def _wake_async(self, state, count=None):
+        # 唤醒排队的协程，默认按空闲名额数；暂停窗口内也唤醒，由它们自己睡到窗口结束
+        waiters = self.async_waiters.get(state.name)
+        if not waiters:
+            return
+        if count is None:
+            count = len(waiters) if not self.enabled else state.limit - state.in_flight
+        for _ in range(min(count, len(waiters))):
+            _wake(*waiters.popleft())
+
+    def release(self, url, status_code=None, retry_after=None):
+        """
+        归还并发名额，并根据结果调整状态.
+
+        参数:
+            status_code (int | None): 响应状态码，None 表示网络错误（不调整）.
+            retry_after (str | None): 响应中的 Retry-After 头.
+        """
+        with self.condition:
+            state = self._state(host_class(url))
+            state.in_flight = max(state.in_flight - 1, 0)
+            self._observe(state, status_code, retry_after)
+            self.condition.notify_all()
+            self._wake_async(state)
+
+    def observe(self, url, status_code, retry_after=None):
+        """只根据响应结果调整状态，不涉及并发名额。"""
+        with self.condition:
+            state = self._state(host_class(url))
+            self._observe(state, status_code, retry_after)
+            self.condition.notify_all()
+            self._wake_async(state)  # 并发数可能增加
+
+    def _observe(self, state, status_code, retry_after):
+        if status_code in THROTTLE_STATUSES:
+            self._on_throttle(state, status_code, retry_after)
+        elif status_code is not None and status_code < 400:
+            self._on_success(state)
+
+    def _on_success(self, state):
+        if not self.enabled:
+            return
+        state.successes += 1
+        changed = False
+        # 每成功一个并发窗口的请求数，并发数加 1
+        if state.limit < state.max_limit and state.successes >= state.limit:
+            state.successes = 0
+            state.limit += 1
+            changed = True
+
+        bucket = self._bucket(state.name)
+        max_rate = self.max_rates.get(state.name, 0)
+        if bucket is not None and bucket.rate > 0 and bucket.rate < max_rate:
+            bucket.set_rate(min(bucket.rate + self.rate_step, max_rate))
+            changed = changed or bucket.rate == max_rate
+
+        if changed:
+            state.increases += 1
+            self._record(state, "increase", "连续成功")
+
+    def _on_throttle(self, state, status_code, retry_after):
+        state.throttles += 1
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        pause = _parse_retry_after(retry_after, self.default_pause)
+        state.pause_until = max(state.pause_until, now + pause)
+
+        # 同一个暂停窗口内的多次 429 只降一次
+        if now - state.last_decrease < pause:
+            return
+        state.last_decrease = now
+        state.successes = 0
+        state.limit = max(int(state.limit * self.decrease_factor), 1)
+        bucket = self._bucket(state.name)
+        if bucket is not None and bucket.rate > 0:
+            bucket.set_rate(max(bucket.rate * self.decrease_factor, self.min_rate))
+        state.decreases += 1
+        self._record(state, "decrease", f"收到 {status_code}，所有线程暂停 {pause:.1f} 秒")
+
+    def _bucket(self, name):
+        if self.rate_limiter is None:
+            return None
+        return self.rate_limiter.buckets.get(name)
+
+    def _record(self, state, event, reason):
+        bucket = self._bucket(state.name)
+        rate = bucket.rate if bucket is not None else 0
+        self.history.append({
+            "time": time.time(), "host": state.name, "event": event, "reason": reason,
+            "concurrency": state.limit, "rate": round(rate, 3),
+        })
+        log = logger.warning if event == "decrease" else logger.debug
+        log(f"自适应控制 {state.name}: {reason}，并发数 {state.limit}，速率 {rate:.2f} 次/秒")
+
+    def stats(self):
+        with self.condition:
+            result = {}
+            for name, state in self.hosts.items():
+                bucket = self._bucket(name)
+                result[name] = {
+                    "concurrency": state.limit,
+                    "max_concurrency": state.max_limit,
+                    "in_flight": state.in_flight,
+                    "rate": round(bucket.rate, 3) if bucket is not None else 0,
+                    "throttles": state.throttles,
+                    "increases": state.increases,
+                    "decreases": state.decreases,
+                    "paused_for": round(max(state.pause_until - time.monotonic(), 0.0), 3),
+                }
+            return result
+
+    def log_stats(self):
+        for name, host_stats in self.stats().items():
+            logger.info(
+                f"自适应控制 {name}: 当前并发 {host_stats['concurrency']}/{host_stats['max_concurrency']}，"
+                f"速率 {host_stats['rate']} 次/秒，限流 {host_stats['throttles']} 次，"
+                f"降速 {host_stats['decreases']} 次，提速 {host_stats['increases']} 次")
+
+
+def _wake(loop, future):
+    # release() 可能在其他线程中调用，结果交回协程所在的事件循环设置
+    def set_result():
+        if not future.done():
+            future.set_result(None)
+
+    try:
+        loop.call_soon_threadsafe(set_result)
+    except RuntimeError:
+        pass  # 事件循环已经结束
+
+
+def _parse_retry_after(retry_after, default):
+    # Retry-After 可能是秒数，也可能缺失或是 HTTP 日期（按默认值处理）
+    try:
+        return max(float(retry_after), 0.0)
+    except (TypeError, ValueError):
+        return float(default)
+
+
+# 全局自适应控制器
+controller = AdaptiveController()
+
 
 # 增加一个函数处理 429 错误并重试
-def handle_429_error(url, headers, cookies):
-    """处理 429 错误，进行指数退避（Exponential Backoff）"""
-    delay = random.uniform(5, 20)  # 随机延时 5 到 10 秒
+def handle_429_error(url, headers=None, cookies=None, retry_after=None):
+    """处理 429 错误：通知控制器降速，并等待到该主机的暂停窗口结束"""
+    controller.observe(url, 429, retry_after)
+    delay = controller.pause_remaining(url)
     logger.warning(f"遇到 429 错误，等待 {delay:.2f} 秒后重试...")
     time.sleep(delay)  # 等待后重试
@@ -0,0 +1,158 @@
+# http_pool.py
+# 进程级共享的 HTTP 连接池，所有模块通过这里拿到长连接 Session
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from log_config import logger
+from tracing import tracer
+
+API_HOST = "www.pixiv.net"  # ajax 接口
+IMAGE_HOST = "i.pximg.net"  # 原图
+IMAGE_HOSTS = {IMAGE_HOST}  # 按原图策略处理的主机，基准测试的模拟服务器会加入自己的主机名
+
+
+def add_image_host(host):
+    IMAGE_HOSTS.add(host)
+
+
+def host_class(url):
+    # 主机类别：原图为 image，其余（ajax 等）为 api
+    host = urlsplit(url).hostname if "://" in url else url
+    return "image" if host in IMAGE_HOSTS else "api"
+
+
+class _TracedHTTPConnection(HTTPConnection):
+    # 新建连接时记录建立连接的耗时（只在被追踪的请求中记录）
+    def connect(self):
+        with tracer.span("connect", host=self.host):
+            super().connect()
+
+
+class _TracedHTTPSConnection(HTTPSConnection):
+    # HTTPS 的 connect() 包含 TCP 连接和 TLS 握手
+    def connect(self):
+        with tracer.span("connect_tls", host=self.host):
+            super().connect()
+
+
+class _TracedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TracedHTTPConnection
+
+
+class _TracedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TracedHTTPSConnection
+
+
+class HttpPool:
+    """
+    共享连接池：每个主机一个 keep-alive 的 Session，跨线程复用，避免每次请求都重新握手。
+    连接池大小按最大并发数（作品线程、图片线程或异步传输数）设置。
+    """
+
+    def __init__(self, pool_size=6):
+        self.pool_size = pool_size
+        self.sessions = {}  # host -> Session
+        self.adapters = {}  # host -> HTTPAdapter
+        self.lock = threading.Lock()
+
+    def configure(self, pool_size):
+        """设置每个主机的连接池大小，已创建的 Session 会被关闭重建。"""
+        pool_size = max(int(pool_size), 1)
+        with self.lock:
+            self.pool_size = pool_size
+            self._close_locked()
+        logger.debug(f"连接池大小设置为 {pool_size}")
+
+    def get_session(self, url):
+        """
+        获取 url 所在主机的共享 Session.
+
+        参数:
+            url (str): 完整 URL 或主机名.
+
+        返回:
+            requests.Session: 该主机的长连接 Session.
+        """
+        host = urlsplit(url).hostname if "://" in url else url
+        session = self.sessions.get(host)
+        if session is not None:
+            return session
+
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                adapter = HTTPAdapter(
+                    pool_connections=1,  # 每个 Session 只对应一个主机
+                    pool_maxsize=self.pool_size,
+                    max_retries=0,  # 重试统一由 retry_policy 决定，连接池本身不重试
+                )
+                adapter.poolmanager.pool_classes_by_scheme = {
+                    "http": _TracedHTTPConnectionPool,
+                    "https": _TracedHTTPSConnectionPool,
+                }
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.adapters[host] = adapter
+                self.sessions[host] = session
+                logger.debug(f"为主机 {host} 创建连接池，大小 {self.pool_size}")
+        return session
+
+    def stats(self):
+        """
+        返回每个主机的连接池统计.
+
+        返回:
+            dict: host -> {requests, connections_created, reuse_ratio, open_connections, in_use}
+        """
+        result = {}
+        with self.lock:
+            adapters = dict(self.adapters)
+
+        for host, adapter in adapters.items():
+            host_stats = {"requests": 0, "connections_created": 0, "open_connections": 0, "in_use": 0}
+            manager = adapter.poolmanager
+            for key in list(manager.pools.keys()):
+                conn_pool = manager.pools.get(key)
+                if conn_pool is None:
+                    continue
+                host_stats["requests"] += conn_pool.num_requests
+                host_stats["connections_created"] += conn_pool.num_connections
+                idle = [conn for conn in list(conn_pool.pool.queue) if conn is not None]
+                in_use = max(conn_pool.pool.maxsize - conn_pool.pool.qsize(), 0)
+                host_stats["in_use"] += in_use
+                host_stats["open_connections"] += in_use + sum(
+                    1 for conn in idle if getattr(conn, "sock", None) is not None)
+
+            if host_stats["requests"]:
+                host_stats["reuse_ratio"] = round(
+                    1 - host_stats["connections_created"] / host_stats["requests"], 4)
+            else:
+                host_stats["reuse_ratio"] = 0.0
+            result[host] = host_stats
+        return result
+
+    def log_stats(self):
+        for host, host_stats in self.stats().items():
+            logger.info(
+                f"连接池 {host}: 请求 {host_stats['requests']} 次，新建连接 {host_stats['connections_created']} 个，"
+                f"复用率 {host_stats['reuse_ratio']:.2%}，当前打开 {host_stats['open_connections']} 个")
+
+    def close(self):
+        with self.lock:
+            self._close_locked()
+
+    def _close_locked(self):
+        for session in self.sessions.values():
+            session.close()
+        self.sessions.clear()
+        self.adapters.clear()
+
+
+# 全局共享连接池
+pool = HttpPool()
@@ -0,0 +1,303 @@
+# library_index.py
+# 下载目录索引：启动时用 os.scandir 扫描一遍 {用户名}-{用户ID}/{作品标题}-{作品ID}/{作品标题}-{作品ID}-{页码}.{扩展名}，
+# 按作品 ID 记录磁盘上已有的页，已完整的作品在发出任何请求之前就跳过
+import json
+import os
+import shutil
+import threading
+import time
+
+from log_config import logger
+from manifest import manifest
+
+INDEX_VERSION = 1
+
+# 作品或用户改名后的处理方式：move 重命名已有目录，link 硬链接到新目录（保留旧目录），off 不处理
+RENAME_MODES = ("move", "link", "off")
+
+
+def parse_folder_id(name):
+    """从 {名称}-{ID} 形式的目录名解析 ID（名称本身可能包含 '-'），无法解析时返回 None."""
+    tail = name.rsplit("-", 1)[-1]
+    return tail if tail.isdigit() and tail != name else None
+
+
+class LibraryIndex:
+    """
+    下载目录的作品索引。
+
+    - 每个作品记录所在目录、目录的修改时间、已有的页码和已知的总页数；
+    - 总页数来自本次或以前运行获取的分页信息（record_artwork），或下载清单；
+    - 索引可以缓存到 cache_path，下次启动只重新列出修改时间变化了的作品目录；
+    - 作品按 ID 识别，用户名或标题改变后 relocate() 把已有文件移到新路径，而不是重新下载。
+    """
+
+    def __init__(self):
+        self.root = None
+        self.cache_path = None
+        self.rename_mode = "move"
+        self.artworks = {}  # artwork_id -> {"folder", "user_id", "mtime", "pages", "page_count"}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.root is not None
+
+    def open(self, root, cache_path=None, rename_mode="move"):
+        """扫描 root，cache_path 不为空时先读取并在之后写回缓存。"""
+        self.root = os.path.abspath(root)
+        self.cache_path = cache_path
+        self.rename_mode = rename_mode if rename_mode in RENAME_MODES else "move"
+        cached = self._load_cache() if cache_path else {}
+        started = time.perf_counter()
+        listed, reused = self._scan(cached)
+        logger.info(f"已索引下载目录 {self.root}：{len(self.artworks)} 个作品，重新列出 {listed} 个目录，"
+                    f"沿用缓存 {reused} 个，用时 {time.perf_counter() - started:.2f} 秒")
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get("version") != INDEX_VERSION or data.get("root") != self.root:
+            return {}
+        return data.get("artworks", {})
+
+    def _scan(self, cached):
+        artworks = {}
+        listed = reused = 0
+        if not os.path.isdir(self.root):
+            self.artworks = artworks
+            return listed, reused
+
+        with os.scandir(self.root) as user_entries:
+            for user_entry in user_entries:
+                if not user_entry.is_dir() or user_entry.name.startswith("."):
+                    continue
+                user_id = parse_folder_id(user_entry.name)
+                try:
+                    artwork_entries = list(os.scandir(user_entry.path))
+                except OSError:
+                    continue
+                for artwork_entry in artwork_entries:
+                    artwork_id = parse_folder_id(artwork_entry.name)
+                    if artwork_id is None or not artwork_entry.is_dir():
+                        continue
+                    folder = os.path.join(user_entry.name, artwork_entry.name)
+                    mtime = artwork_entry.stat().st_mtime_ns
+                    entry = cached.get(artwork_id)
+                    if entry is not None and entry["folder"] == folder and entry["mtime"] == mtime:
+                        reused += 1
+                    else:
+                        listed += 1
+                        entry = {
+                            "folder": folder,
+                            "user_id": user_id,
+                            "mtime": mtime,
+                            "pages": self._list_pages(artwork_entry.path, artwork_id),
+                            "page_count": entry["page_count"] if entry else None,
+                        }
+                    previous = artworks.get(artwork_id)
+                    # 同一作品出现在多个目录时（例如改名后留下的旧目录），保留页数多的那个
+                    if previous is None or len(entry["pages"]) > len(previous["pages"]):
+                        artworks[artwork_id] = entry
+        self.artworks = artworks
+        return listed, reused
+
+    @staticmethod
+    def _list_pages(path, artwork_id):
+        # 下载先写 .part 再原子重命名，正式文件存在即表示该页已完整
+        pages = []
+        suffix = f"-{artwork_id}"
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if name.endswith((".part", ".json")):
+                        continue
+                    # 与 manifest.parse_image_name 相同的规则，逐个文件调用时省去路径处理
+                    head, _, page = name.rsplit(".", 1)[0].rpartition("-")
+                    if page.isdigit() and head.endswith(suffix):
+                        pages.append(int(page))
+        except OSError:
+            pass
+        return sorted(set(pages))  # 同一页可能同时有 .jpg 和 .png
+
+    def save(self):
+        if not self.enabled or not self.cache_path:
+            return
+        with self.lock:
+            data = {"version": INDEX_VERSION, "root": self.root, "artworks": self.artworks}
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, self.cache_path)
+
+    def record_artwork(self, artwork_id, user_id, folder, page_count):
+        """记录从分页信息得到的总页数，供以后的运行判断作品是否完整。"""
+        if not self.enabled:
+            return
+        folder = os.path.relpath(str(folder), self.root)
+        with self.lock:
+            entry = self.artworks.get(str(artwork_id))
+            if entry is None or entry["folder"] != folder:
+                entry = self.artworks[str(artwork_id)] = {
+                    "folder": folder, "user_id": str(user_id), "mtime": None, "pages": [], "page_count": None}
+            entry["page_count"] = page_count
+
+    def relocate(self, artwork_id, artwork_folder):
+        """
+        作品的目标目录与索引中的目录不同时（用户名或标题改变），把已有的文件移动或硬链接到新目录.
+
+        文件名为 {目录名}-{页码}.{扩展名}，随目录一起改名；下载中的 .part 和续传信息也一并处理.
+        同一用户的整个目录改名时优先直接重命名用户目录.
+
+        返回:
+            int: 迁移到新目录的图片数量.
+        """
+        if not self.enabled or self.rename_mode == "off":
+            return 0
+        artwork_id = str(artwork_id)
+        new_folder = os.path.relpath(str(artwork_folder), self.root)
+        with self.lock:
+            entry = self.artworks.get(artwork_id)
+            if entry is None or entry["folder"] == new_folder or not entry["pages"]:
+                return 0
+            old_folder = entry["folder"]
+            if not os.path.isdir(os.path.join(self.root, old_folder)):
+                return 0
+            try:
+                if self.rename_mode == "move":
+                    old_folder = self._move_user_folder(old_folder, new_folder)
+                self._relocate_files(old_folder, new_folder)
+            except OSError as e:
+                logger.warning(f"作品 {artwork_id} 从 {old_folder} 迁移到 {new_folder} 失败，将重新下载：{e}")
+                return 0
+            entry["folder"] = new_folder
+            entry["mtime"] = None
+            paths = moved_paths(self.root, new_folder, entry["pages"])
+            # 只有真正出现在新目录里的页才算已有，其余的照常下载
+            entry["pages"] = sorted({int(os.path.splitext(path)[0].rsplit("-", 1)[-1]) for path in paths})
+        action = "移动" if self.rename_mode == "move" else "硬链接"
+        logger.info(f"作品 {artwork_id} 的路径已改变，{action} {len(paths)} 个文件：{old_folder} -> {new_folder}")
+        for path in paths:
+            manifest.record_page(path)
+        return len(paths)
+
+    def _move_user_folder(self, old_folder, new_folder):
+        # 用户改名且新用户目录还不存在时，一次重命名整个用户目录，同时更新该用户其他作品的记录
+        old_user, old_name = os.path.split(old_folder)
+        new_user = os.path.dirname(new_folder)
+        new_user_path = os.path.join(self.root, new_user)
+        if old_user == new_user or os.path.exists(new_user_path):
+            return old_folder
+        os.rename(os.path.join(self.root, old_user), new_user_path)
+        prefix = old_user + os.sep
+        for other in self.artworks.values():
+            if other["folder"].startswith(prefix):
+                other["folder"] = new_user + other["folder"][len(old_user):]
+        logger.info(f"用户目录已改名：{old_user} -> {new_user}")
+        return os.path.join(new_user, old_name)
+
+    def _relocate_files(self, old_folder, new_folder):
+        old_path = os.path.join(self.root, old_folder)
+        new_path = os.path.join(self.root, new_folder)
+        old_prefix = os.path.basename(old_folder) + "-"
+        new_prefix = os.path.basename(new_folder) + "-"
+        move = self.rename_mode == "move"
+
+        renamed = move and not os.path.exists(new_path)
+        if renamed:
+            # 新目录还不存在：直接重命名整个作品目录，再逐个改文件名
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.rename(old_path, new_path)
+            source_dir = new_path
+        else:
+            os.makedirs(new_path, exist_ok=True)
+            source_dir = old_path
+
+        for name in os.listdir(source_dir):
+            if not name.startswith(old_prefix):
+                continue
+            if not move and name.endswith((".part", ".json")):
+                continue  # 硬链接只处理已完成的图片，下载中的文件留在原处
+            source = os.path.join(source_dir, name)
+            target = os.path.join(new_path, new_prefix + name[len(old_prefix):])
+            if source == target or os.path.exists(target):
+                continue
+            if move:
+                os.replace(source, target)
+            else:
+                try:
+                    os.link(source, target)
+                except OSError:
+                    shutil.copy2(source, target)  # 文件系统不支持硬链接时复制
+
+        if move:
+            _remove_empty_dirs(os.path.dirname(old_path) if renamed else old_path, self.root)
+
+    def has_page(self, artwork_id, page):
+        entry = self.artworks.get(str(artwork_id))
+        return entry is not None and page in entry["pages"]
+
+    def pending(self, artwork_ids, label=""):
+        """
+        过滤掉磁盘上已经完整的作品（总页数已知，且每一页的文件都存在）.
+
+        返回:
+            list: 仍需获取元数据的作品 ID，保持原顺序.
+        """
+        if not self.enabled or not artwork_ids:
+            return artwork_ids
+        with self.lock:
+            unknown = [str(artwork_id) for artwork_id in artwork_ids
+                       if str(artwork_id) in self.artworks and self.artworks[str(artwork_id)]["page_count"] is None]
+        page_counts = manifest.page_counts(unknown) if unknown else {}
+
+        done = set()
+        with self.lock:
+            for artwork_id in map(str, artwork_ids):
+                entry = self.artworks.get(artwork_id)
+                if entry is None:
+                    continue
+                page_count = entry["page_count"] or page_counts.get(artwork_id)
+                if page_count and len(entry["pages"]) >= page_count and entry["pages"][page_count - 1] == page_count:
+                    done.add(artwork_id)
+        if done:
+            logger.info(f"{label}下载目录中已完整 {len(done)} 个作品，跳过；剩余 {len(artwork_ids) - len(done)} 个")
+        return [artwork_id for artwork_id in artwork_ids if str(artwork_id) not in done]
+
+    def close(self):
+        self.save()
+        self.root = None
+
+
+def moved_paths(root, folder, pages):
+    """迁移后各页图片的新路径，扩展名以磁盘上实际存在的为准。"""
+    path = os.path.join(root, folder)
+    prefix = os.path.basename(folder) + "-"
+    wanted = {str(page) for page in pages}
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return []
+    return [os.path.join(path, name) for name in names
+            if name.startswith(prefix) and not name.endswith((".part", ".json"))
+            and name[len(prefix):].rsplit(".", 1)[0] in wanted]
+
+
+def _remove_empty_dirs(path, root):
+    # 从 path 开始向上删除空目录，到 root 为止
+    root = os.path.abspath(root)
+    path = os.path.abspath(path)
+    while path != root and path.startswith(root + os.sep):
+        try:
+            os.rmdir(path)
+        except OSError:
+            return
+        path = os.path.dirname(path)
+
+
+# 全局下载目录索引
+library_index = LibraryIndex()
@@ -3,9 +3,24 @@ import time
 import sys
 
 from config_loader import load_config, save_config
-from artwork_down import download_artwork_images
 from log_config import setup_logger
 from pdi_config import config
+from transport import transport
+from download import inflight_budget
+from disk_writer import disk_writer
+from bandwidth import bandwidth
+from rate_limited_requests import _rate_limiter
+from handle_429 import controller
+from retry_policy import retry_policy
+from manifest import manifest
+from library_index import library_index
+from blob_store import blob_store, BLOB_DIR
+from metadata_cache import metadata_cache
+from single_flight import single_flight
+from error_journal import error_journal
+from stats import stats
+from metrics import metrics, MetricsReporter
+from tracing import tracer
 
 setup_logger()
 from log_config import logger
@@ -25,6 +40,50 @@ def pdi_config():
         sys.exit(1)  # 如果配置不完整，退出程序
 
     setup_logger(debug=config.debug_mode)
+    apply_config()
+
+
+def apply_config():
+    """按已缓存的配置设置连接池、限速、自适应控制器等全局组件（基准测试等场景也直接调用）。"""
+    # 选择 HTTP 传输后端，并按并发数设置每个主机的连接池大小
+    transport.configure(config.transport, max(config.artwork_threads, config.image_workers, config.async_transfers))
+    inflight_budget.configure(config.max_inflight_bytes)  # 全局在途字节上限
+    # 写盘线程：与下载线程分开调整，慢速磁盘刷盘时不占用网络连接
+    disk_writer.configure(config.disk_writers, config.disk_queue_size, config.fsync, config.preallocate)
+    disk_writer.reset_stats()
+    bandwidth.configure(**config.bandwidth)  # 原图下载的全局、按用户和按时段带宽上限
+    bandwidth.reset_stats()
+    stats.configure(config.stats_detail_limit)  # 按文件统计明细的条数上限
+    tracer.configure(bool(config.trace_file), config.trace_sample_rate)  # 设置了 trace_file 时追踪请求各阶段
+    _rate_limiter.configure(**config.rate_limits)  # 按主机的令牌桶限速
+
+    # 自适应控制器：并发上限取各引擎实际能达到的并发数
+    if config.engine == "async":
+        limits = {"api": config.async_transfers, "image": config.async_transfers}
+    else:
+        limits = {"api": config.artwork_threads, "image": config.image_workers}
+    max_rates = {"api": max(config.api_max_rate, config.rate_limits["api_rate"]),
+                 "image": config.rate_limits["image_rate"]}
+    controller.configure(limits, max_rates, enabled=config.adaptive)
+    retry_policy.configure(**config.retry)  # 重试次数、重试预算和按主机的熔断器
+    retry_policy.reset_stats()
+
+    # 报告时才读取的指标：在途请求数和令牌桶累计等待时间
+    metrics.register_gauge("pdi_in_flight", "Requests currently in flight by host.",
+                           lambda: {name: host_stats["in_flight"] for name, host_stats in controller.stats().items()})
+    metrics.register_gauge("pdi_rate_limit_wait_seconds_total", "Time spent waiting for rate-limit tokens.",
+                           lambda: {name: bucket_stats["total_wait"]
+                                    for name, bucket_stats in _rate_limiter.stats().items()},
+                           metric_type="counter")
+    metrics.register_gauge("pdi_bandwidth_bytes_total", "Image bytes granted by the bandwidth shaper, by user.",
+                           lambda: bandwidth.stats()["bytes"], label="user", metric_type="counter")
+    metrics.register_gauge("pdi_disk_queue_depth", "Chunks waiting in each disk writer queue.",
+                           disk_writer.depths, label="writer")
+    metrics.register_gauge("pdi_attempts_total", "Requests sent including retries, by kind.",
+                           lambda: retry_policy.stats()["attempts"], label="kind", metric_type="counter")
+    metrics.register_gauge("pdi_circuit_open", "Whether the circuit breaker of a host is open.",
+                           lambda: {host: int(breaker_stats["state"] != "closed")
+                                    for host, breaker_stats in retry_policy.stats()["breakers"].items()})
 
 
 def global_exception_handler(exc_type, exc_value, exc_tb):
@@ -100,8 +159,43 @@ def main():
         logger.error(f"保存下路径：{down_path}")
         save_config("down_path", down_path, section="DEFAULT")
 
+    run(USER_IDS, ARTWORK_IDS, down_path)
+
+    # 暂停 5 秒钟，便于查看日志
+    time.sleep(5)
+
+    # 退出程序
+    sys.exit(0)
+
+
+def run(USER_IDS, ARTWORK_IDS, down_path):
+    """下载用户和作品，结束后输出统计并关闭清单和缓存。"""
+    error_journal.open("error_journal.jsonl")  # 读取以前的失败记录，之后成功的项会被标记为已解决
+    image_jobs = []
+    if config.retry_failed:
+        # 只重试错误日志中仍未成功的图片和作品
+        failed_images, failed_artworks = error_journal.unresolved()
+        USER_IDS = []
+        ARTWORK_IDS = [record["artwork_id"] for record in failed_artworks]
+        image_jobs = [(record["url"], record["save_path"]) for record in failed_images]
+        logger.info(f"重试失败项：{len(image_jobs)} 张图片，{len(ARTWORK_IDS)} 个作品")
+
+    if config.manifest:
+        manifest.open(config.manifest_path or os.path.join(down_path, ".pdi_manifest.sqlite3"))
+        ARTWORK_IDS = manifest.pending(ARTWORK_IDS, label="单独作品：")
+    if config.library_index:
+        library_index.open(down_path, os.path.join(down_path, ".pdi_index.json") if config.library_index_cache else None,
+                           rename_mode=config.rename_sync)
+        ARTWORK_IDS = library_index.pending(ARTWORK_IDS, label="单独作品：")
+    if config.dedup:
+        blob_store.open(os.path.join(down_path, BLOB_DIR))
+        blob_store.reset_stats()
+    if config.metadata_cache["enabled"]:
+        metadata_cache.open(os.path.join(down_path, ".pdi_cache.sqlite3"), ttl=config.metadata_cache["ttl"],
+                            max_bytes=config.metadata_cache["max_bytes"], bypass=config.metadata_cache["bypass"])
+
     HEADERS, COOKIES = config.HEADERS, config.COOKIES
-    user_stats, skipped_stats, error_dict = config.user_stats, config.skipped_stats, config.error_dict
+    error_dict = config.error_dict
     img_threads = config.img_threads
     artwork_threads = config.artwork_threads
 
@@ -111,8 +205,6 @@ def main():
     logger.info(f"down_path: {down_path}")
     logger.debug(f"HEADERS: {HEADERS}")
     logger.debug(f"COOKIES: {COOKIES}")
-    logger.debug(f"user_stats: {user_stats}")
-    logger.debug(f"skipped_stats: {skipped_stats}")
     logger.debug(f"error_dict: {error_dict}")
     logger.debug(f"img_threads: {img_threads}")
     logger.debug(f"img_threads类型: {type(img_threads)}")
@@ -120,41 +212,79 @@ def main():
     logger.debug(f"artwork_threads类型: {artwork_threads}")
 
     # 导入需要的模块
-    from artwork_details import fetch_artwork_info
-    from down_user_artwork import download_user_artworks
-
-    # 检查 USER_IDS 是否为空，若不为空则下载用户作品
-    if USER_IDS:
-        for user_id in USER_IDS:
-            logger.info(f"准备下载用户 {user_id}")
-            download_user_artworks(user_id, down_path, artwork_threads, img_threads)
-    else:
-        logger.warning("USER_IDS 为空，跳过用户下载")
+    from pipeline import DownloadPipeline
 
-    # 检查 ARTWORK_IDS 是否为空，若不为空则下载单独作品
-    if ARTWORK_IDS:
-        for artwork_id in ARTWORK_IDS:
-            logger.info(f"准备下载单独作品 {artwork_id}")
+    reporter = MetricsReporter(metrics, config.metrics_interval, config.metrics_textfile)
+    reporter.start()
 
-            user_id, user_name, artwork_name = fetch_artwork_info(artwork_id, HEADERS, COOKIES)
-            logger.debug(f"作品信息: user_id={user_id}, user_name={user_name}, artwork_name={artwork_name}")
-            logger.debug(f"图片线程main,{type(img_threads)}")
-            download_artwork_images(artwork_id, user_id, down_path, img_threads)
+    if config.engine == "async":
+        from async_engine import run_async_engine
+        use_threads = not run_async_engine(USER_IDS, ARTWORK_IDS, down_path, image_jobs)
     else:
-        logger.warning("ARTWORK_IDS 为空，跳过作品下载")
+        use_threads = True
+
+    if use_threads:
+        # 所有用户和单独作品共用一条下载流水线
+        pipeline = DownloadPipeline(down_path, artwork_threads, config.image_workers, config.image_queue_size,
+                                    config.max_concurrency)
+
+        # 检查 USER_IDS 是否为空，若不为空则下载用户作品；所有用户同时排队，按用户轮转调度
+        if USER_IDS:
+            for user_id in USER_IDS:
+                logger.info(f"准备下载用户 {user_id}")
+                pipeline.add_user(user_id)
+        else:
+            logger.warning("USER_IDS 为空，跳过用户下载")
 
-    # 打印下载统计信息
-    from print_stats import print_stats
-    print_stats(user_stats, skipped_stats, error_dict)
+        # 检查 ARTWORK_IDS 是否为空，若不为空则下载单独作品
+        if ARTWORK_IDS:
+            for artwork_id in ARTWORK_IDS:
+                logger.info(f"准备下载单独作品 {artwork_id}")
+                pipeline.add_artwork(artwork_id)
+        else:
+            logger.warning("ARTWORK_IDS 为空，跳过作品下载")
 
-    # 暂停 5 秒钟，便于查看日志
-    time.sleep(5)
+        for img_url, save_path in image_jobs:
+            pipeline.add_image(img_url, save_path)
 
-    # 退出程序
-    sys.exit(0)
+        pipeline.join()
+
+    disk_writer.flush()  # 等待写盘线程写完并记录最后一批图片
+    reporter.stop()
+    if config.trace_file:
+        tracer.write(config.trace_file)
+
+    # 打印下载统计信息
+    from print_stats import print_stats
+    print_stats(stats.user_stats(), stats.skipped_stats(), error_dict)
+    error_journal.compact()  # error.json 已导出，日志只保留仍未解决的记录，不随运行次数增长
+    stats.log_stats()
+    transport.log_stats()
+    _rate_limiter.log_stats()
+    controller.log_stats()
+    retry_policy.log_stats()
+    disk_writer.log_stats()
+    bandwidth.log_stats()
+    blob_store.log_stats()
+    metadata_cache.log_stats()
+    single_flight.log_stats()
+    manifest.close()
+    metadata_cache.close()
+    library_index.close()
+    blob_store.close()
 
 
 # 运行程序
 if __name__ == "__main__":
     sys.excepthook = global_exception_handler
+    if sys.argv[1:2] == ["verify"]:
+        # python main.py verify [目录]：检查已下载图片的完整性
+        pdi_config()
+        from verify import main as verify_main
+        sys.exit(verify_main(sys.argv[2:]))
+    if sys.argv[1:2] == ["dedup"]:
+        # python main.py dedup [目录]：把已有的下载目录转换为去重存储
+        pdi_config()
+        from dedup import main as dedup_main
+        sys.exit(dedup_main(sys.argv[2:]))
     main()
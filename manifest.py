@@ -0,0 +1,226 @@
+# manifest.py
+# 下载清单：用 SQLite（WAL 模式）按作品 ID 记录页数、文件路径、大小和完成状态，增量同步时跳过已完成的作品
+import os
+import sqlite3
+import threading
+import time
+
+from log_config import logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artworks (
+    artwork_id TEXT PRIMARY KEY,
+    user_id TEXT,
+    user_name TEXT,
+    title TEXT,
+    folder TEXT,
+    page_count INTEGER NOT NULL DEFAULT 0,
+    complete INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    artwork_id TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    url TEXT,
+    path TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (artwork_id, page)
+);
+CREATE INDEX IF NOT EXISTS artworks_user ON artworks (user_id);
+"""
+
+
+def parse_image_name(path):
+    """
+    从 {作品标题}-{作品ID}-{页码} 形式的文件名中解析作品 ID 和页码（标题本身可能包含 '-'）.
+
+    返回:
+        tuple: (artwork_id, page)，无法解析时为 (None, None).
+    """
+    stem = os.path.splitext(os.path.basename(str(path)))[0]
+    parts = stem.rsplit("-", 2)
+    if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit():
+        return None, None
+    return parts[1], int(parts[2])
+
+
+class Manifest:
+    """
+    下载清单。未调用 open() 时所有方法都是空操作，便于在关闭清单时保持调用方代码不变。
+    """
+
+    def __init__(self):
+        self.conn = None
+        self.path = None
+        self.lock = threading.Lock()
+
+    def open(self, path):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(SCHEMA)
+            self.conn.commit()
+            self.path = path
+        logger.info(f"已打开下载清单 {path}")
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    @property
+    def enabled(self):
+        return self.conn is not None
+
+    def record_artwork(self, artwork_id, user_id, user_name, title, folder, img_urls):
+        """记录作品的元数据和每一页的 URL，已完成的页保持不变。"""
+        if self.conn is None:
+            return
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO artworks (artwork_id, user_id, user_name, title, folder, page_count, complete, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, 0, ?)"
+                " ON CONFLICT(artwork_id) DO UPDATE SET user_id=excluded.user_id, user_name=excluded.user_name,"
+                " title=excluded.title, folder=excluded.folder, page_count=excluded.page_count,"
+                " updated_at=excluded.updated_at",
+                (str(artwork_id), str(user_id), user_name, title, str(folder), len(img_urls), time.time()))
+            self.conn.executemany(
+                "INSERT INTO pages (artwork_id, page, url) VALUES (?, ?, ?)"
+                " ON CONFLICT(artwork_id, page) DO UPDATE SET url=excluded.url",
+                [(str(artwork_id), index, url) for index, url in enumerate(img_urls, start=1)])
+            self._refresh_complete(str(artwork_id))
+            self.conn.commit()
+
+    def record_page(self, path, size=None):
+        """
+        记录一页已经落盘（下载完成或文件已存在）.
+
+        参数:
+            path (str | Path): 图片的最终保存路径.
+            size (int): 文件大小，默认读取磁盘上的大小.
+        """
+        if self.conn is None:
+            return
+        artwork_id, page = parse_image_name(path)
+        if artwork_id is None:
+            return
+        if size is None:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO pages (artwork_id, page, path, size) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(artwork_id, page) DO UPDATE SET path=excluded.path, size=excluded.size",
+                (artwork_id, page, str(path), size))
+            self._refresh_complete(artwork_id)
+            self.conn.commit()
+
+    def invalidate_page(self, path):
+        """文件被发现损坏并移走后，清除该页的落盘记录，作品回到未完成状态。"""
+        if self.conn is None:
+            return
+        artwork_id, page = parse_image_name(path)
+        if artwork_id is None:
+            return
+        with self.lock:
+            self.conn.execute("UPDATE pages SET path = NULL, size = 0 WHERE artwork_id = ? AND page = ?",
+                              (artwork_id, page))
+            self._refresh_complete(artwork_id)
+            self.conn.commit()
+
+    def page_records(self):
+        """
+        返回清单中所有的页 {(artwork_id, page): (size, url)}，供完整性检查比较文件大小和重新下载.
+
+        下载时记录的 size 是实际写入的字节数，与响应的 Content-Length 一致；未落盘的页为 0.
+        """
+        if self.conn is None:
+            return {}
+        with self.lock:
+            rows = self.conn.execute("SELECT artwork_id, page, size, url FROM pages WHERE size > 0 OR url IS NOT NULL").fetchall()
+        return {(artwork_id, page): (size, url) for artwork_id, page, size, url in rows}
+
+    def _refresh_complete(self, artwork_id):
+        # 所有页都有非空文件时标记作品完成
+        self.conn.execute(
+            "UPDATE artworks SET complete = (page_count > 0 AND page_count <= "
+            " (SELECT COUNT(*) FROM pages WHERE pages.artwork_id = artworks.artwork_id AND size > 0)),"
+            " updated_at = ? WHERE artwork_id = ?",
+            (time.time(), artwork_id))
+
+    def completed(self, artwork_ids):
+        """返回 artwork_ids 中已经完整下载的作品 ID 集合。"""
+        if self.conn is None or not artwork_ids:
+            return set()
+        ids = [str(artwork_id) for artwork_id in artwork_ids]
+        done = set()
+        with self.lock:
+            # SQLite 单条语句的参数个数有限，分批查询
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT artwork_id FROM artworks WHERE complete = 1 AND artwork_id IN "
+                    f"({','.join('?' * len(batch))})", batch)
+                done.update(row[0] for row in rows)
+        return done
+
+    def page_counts(self, artwork_ids):
+        """返回 artwork_ids 中清单已知的总页数 {artwork_id: page_count}。"""
+        if self.conn is None or not artwork_ids:
+            return {}
+        ids = [str(artwork_id) for artwork_id in artwork_ids]
+        counts = {}
+        with self.lock:
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT artwork_id, page_count FROM artworks WHERE page_count > 0 AND artwork_id IN "
+                    f"({','.join('?' * len(batch))})", batch)
+                counts.update(rows)
+        return counts
+
+    def image_urls(self, artwork_ids):
+        """
+        返回 artwork_ids 中清单记录了全部页 URL 的作品 {artwork_id: (page_count, [url, ...])}.
+
+        批量获取作品信息后，总页数没有变化的作品可以直接使用这里的 URL，不再请求分页接口.
+        """
+        if self.conn is None or not artwork_ids:
+            return {}
+        ids = [str(artwork_id) for artwork_id in artwork_ids]
+        pages = {}
+        with self.lock:
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT artworks.artwork_id, page_count, page, url FROM artworks"
+                    f" JOIN pages ON pages.artwork_id = artworks.artwork_id"
+                    f" WHERE page_count > 0 AND page <= page_count AND url IS NOT NULL AND artworks.artwork_id IN "
+                    f"({','.join('?' * len(batch))}) ORDER BY artworks.artwork_id, page", batch)
+                for artwork_id, page_count, page, url in rows:
+                    pages.setdefault(artwork_id, (page_count, []))[1].append(url)
+        return {artwork_id: (page_count, urls) for artwork_id, (page_count, urls) in pages.items()
+                if len(urls) == page_count}
+
+    def pending(self, artwork_ids, label=""):
+        """
+        过滤掉已完成的作品，只保留新作品和未完成的作品.
+
+        返回:
+            list: 需要获取元数据并下载的作品 ID，保持原顺序.
+        """
+        done = self.completed(artwork_ids)
+        if done:
+            logger.info(f"{label}清单中已完成 {len(done)} 个作品，跳过；剩余 {len(artwork_ids) - len(done)} 个")
+        return [artwork_id for artwork_id in artwork_ids if str(artwork_id) not in done]
+
+
+# 全局下载清单
+manifest = Manifest()
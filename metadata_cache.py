@@ -0,0 +1,177 @@
+# metadata_cache.py
+# 作品元数据缓存：把 /ajax/illust/{id} 和 /ajax/illust/{id}/pages 的响应存到磁盘（SQLite），
+# 带 TTL、按大小的 LRU 淘汰，以及基于 ETag / Last-Modified 的条件请求
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from log_config import logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    body TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at);
+"""
+
+# 只缓存作品详情和分页 URL，用户作品列表每次都要请求才能发现新作品
+CACHEABLE_URL = re.compile(r"/ajax/illust/\d+(/pages)?$")
+
+
+class MetadataCache:
+    """
+    元数据缓存。未调用 open() 时不缓存任何内容。
+
+    bypass 为 True 时不读取缓存（仍会写入新响应），用于强制刷新。
+    """
+
+    def __init__(self, ttl=24 * 3600, max_bytes=64 * 1024 * 1024, bypass=False):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.conn = None
+        self.lock = threading.Lock()
+        self.total_size = 0
+        # 计数器
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0  # 304 命中
+        self.stores = 0
+        self.evictions = 0
+
+    def open(self, path, ttl=None, max_bytes=None, bypass=None):
+        with self.lock:
+            if ttl is not None:
+                self.ttl = ttl
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            if bypass is not None:
+                self.bypass = bypass
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(SCHEMA)
+            self.total_size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            self.conn.commit()
+        logger.info(f"已打开元数据缓存 {path}，TTL {self.ttl} 秒，上限 {self.max_bytes // (1024 * 1024)} MB")
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def cacheable(self, url):
+        return self.conn is not None and CACHEABLE_URL.search(url.split("?")[0]) is not None
+
+    def get_fresh(self, url):
+        """
+        返回未过期的缓存数据，过期或没有缓存时返回 None.
+        """
+        if not self.cacheable(url):
+            return None
+        with self.lock:
+            row = None if self.bypass else self.conn.execute(
+                "SELECT body, fetched_at FROM responses WHERE url = ?", (url,)).fetchone()
+            if row is None or time.time() - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET accessed_at = ? WHERE url = ?", (time.time(), url))
+            self.conn.commit()
+        logger.debug(f"元数据缓存命中: {url}")
+        return json.loads(row[0])
+
+    def conditional_headers(self, url):
+        """为过期的缓存生成 If-None-Match / If-Modified-Since 请求头。"""
+        if not self.cacheable(url) or self.bypass:
+            return {}
+        with self.lock:
+            row = self.conn.execute("SELECT etag, last_modified FROM responses WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return {}
+        headers = {}
+        if row[0]:
+            headers["If-None-Match"] = row[0]
+        if row[1]:
+            headers["If-Modified-Since"] = row[1]
+        return headers
+
+    def revalidate(self, url):
+        """服务器返回 304 时刷新缓存时间并返回缓存数据。"""
+        with self.lock:
+            row = self.conn.execute("SELECT body FROM responses WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            self.conn.execute("UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE url = ?", (now, now, url))
+            self.conn.commit()
+            self.revalidated += 1
+        logger.debug(f"元数据缓存经 304 确认有效: {url}")
+        return json.loads(row[0])
+
+    def put(self, url, data, response_headers=None):
+        """保存成功的响应（error 为 False），并按 LRU 淘汰超出上限的条目。"""
+        if not self.cacheable(url) or not isinstance(data, dict) or data.get("error") is not False:
+            return
+        response_headers = response_headers or {}
+        body = json.dumps(data, ensure_ascii=False)
+        size = len(body.encode("utf-8"))
+        now = time.time()
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (url, body, etag, last_modified, fetched_at, accessed_at, size)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, body, response_headers.get("ETag"), response_headers.get("Last-Modified"), now, now, size))
+            self.total_size += size - (old[0] if old else 0)
+            self.stores += 1
+            self._evict_locked()
+            self.conn.commit()
+
+    def _evict_locked(self):
+        while self.total_size > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT url, size FROM responses ORDER BY accessed_at LIMIT 100").fetchall()
+            if not rows:
+                self.total_size = 0
+                break
+            for url, size in rows:
+                self.conn.execute("DELETE FROM responses WHERE url = ?", (url,))
+                self.total_size -= size
+                self.evictions += 1
+                if self.total_size <= self.max_bytes:
+                    break
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "size": self.total_size,
+        }
+
+    def log_stats(self):
+        if self.conn is None:
+            return
+        cache_stats = self.stats()
+        logger.info(
+            f"元数据缓存: 命中 {cache_stats['hits']} 次，未命中 {cache_stats['misses']} 次，"
+            f"304 确认 {cache_stats['revalidated']} 次，淘汰 {cache_stats['evictions']} 条，"
+            f"占用 {cache_stats['size'] / (1024 * 1024):.1f} MB")
+
+
+# 全局元数据缓存
+metadata_cache = MetadataCache()
@@ -0,0 +1,225 @@
+# metrics.py
+# 运行指标：请求数、字节数、重试、429、请求耗时分布，定期输出一行进度并写 Prometheus textfile
+import os
+import threading
+import time
+
+from log_config import logger
+from stats import ShardedCounter
+
+# 请求耗时直方图的上界（秒），与 Prometheus histogram 的 le 标签一致
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float("inf"))
+
+
+def _bucket_index(seconds):
+    for index, bound in enumerate(LATENCY_BUCKETS):
+        if seconds <= bound:
+            return index
+    return len(LATENCY_BUCKETS) - 1
+
+
+def _host_total(snap, name, host):
+    # requests 的键为 (主机, 状态码)，其他计数的键为主机
+    return sum(value for key, value in snap.get(name, {}).items()
+               if (key[0] if isinstance(key, tuple) else key) == host)
+
+
+def _format_le(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+class Metrics:
+    """
+    进程内指标。热路径只做几次分片计数（不加锁），读取和导出都在报告线程里完成。
+
+    - 计数器：按主机类别（api / image）和状态码统计请求数、字节数、重试和限流次数；
+    - 直方图：metadata 和 image 两类请求的耗时，用于估算 p50 / p95；
+    - 仪表：由其他模块通过 register_gauge() 注册回调，报告时才读取（在途请求、队列深度、限速等待）。
+    """
+
+    def __init__(self):
+        self.counter = ShardedCounter()
+        self.gauges = {}  # name -> (help, type, label, fn)
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+
+    def observe_request(self, host, kind, seconds, status, nbytes=0):
+        """
+        记录一次请求.
+
+        参数:
+            host (str): 主机类别，api 或 image.
+            kind (str): 请求类型，metadata 或 image.
+            seconds (float): 耗时（图片为整个传输的耗时）.
+            status: 状态码，异常时为 "error".
+            nbytes (int): 收到的字节数.
+        """
+        add = self.counter.add
+        add(("requests", host, str(status)))
+        add(("latency", kind, _bucket_index(seconds)))
+        add(("latency_sum", kind), seconds)
+        if nbytes:
+            add(("bytes", host), nbytes)
+        if status == 429:
+            add(("throttled", host))
+
+    def count_retry(self, kind):
+        self.counter.add(("retries", kind))
+
+    def register_gauge(self, name, help_text, fn, label="host", metric_type="gauge"):
+        """注册在报告时读取的指标，fn 返回 {标签值: 数值}。"""
+        with self.lock:
+            self.gauges[name] = (help_text, metric_type, label, fn)
+
+    def snapshot(self):
+        """合并所有分片，返回按类别整理的计数。"""
+        result = {"requests": {}, "bytes": {}, "throttled": {}, "retries": {}, "latency": {}, "latency_sum": {}}
+        for key, value in self.counter.snapshot().items():
+            name = key[0]
+            if name == "requests":
+                result["requests"][(key[1], key[2])] = value
+            elif name == "latency":
+                result["latency"].setdefault(key[1], [0] * len(LATENCY_BUCKETS))[key[2]] += value
+            else:
+                result[name][key[1]] = value
+        return result
+
+    def read_gauges(self):
+        with self.lock:
+            gauges = dict(self.gauges)
+        values = {}
+        for name, (help_text, metric_type, label, fn) in gauges.items():
+            try:
+                values[name] = (help_text, metric_type, label, fn())
+            except Exception as e:
+                logger.debug(f"读取指标 {name} 失败：{e}")
+        return values
+
+    @staticmethod
+    def quantile(buckets, q):
+        """按直方图估算分位数，返回所在桶的上界（秒）。"""
+        total = sum(buckets)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(buckets):
+            seen += count
+            if seen >= rank:
+                bound = LATENCY_BUCKETS[index]
+                return bound if bound != float("inf") else LATENCY_BUCKETS[-2]
+        return LATENCY_BUCKETS[-2]
+
+    def prometheus_text(self):
+        """生成 Prometheus 文本格式（textfile collector 可直接读取）。"""
+        snap = self.snapshot()
+        lines = []
+
+        def metric(name, help_text, metric_type, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{val}"' for key, val in labels)
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        metric("pdi_requests_total", "HTTP requests by host and status.", "counter",
+               [((("host", host), ("status", status)), value)
+                for (host, status), value in sorted(snap["requests"].items())])
+        metric("pdi_bytes_total", "Response bytes received by host.", "counter",
+               [((("host", host),), value) for host, value in sorted(snap["bytes"].items())])
+        metric("pdi_throttled_total", "HTTP 429 responses by host.", "counter",
+               [((("host", host),), value) for host, value in sorted(snap["throttled"].items())])
+        metric("pdi_retries_total", "Retried requests by kind.", "counter",
+               [((("kind", kind),), value) for kind, value in sorted(snap["retries"].items())])
+
+        samples = []
+        for kind, buckets in sorted(snap["latency"].items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, buckets):
+                cumulative += count
+                samples.append(((("kind", kind), ("le", _format_le(bound))), cumulative))
+        lines.append("# HELP pdi_request_duration_seconds Request duration by kind.")
+        lines.append("# TYPE pdi_request_duration_seconds histogram")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{val}"' for key, val in labels)
+            lines.append(f"pdi_request_duration_seconds_bucket{{{label_text}}} {value}")
+        for kind, buckets in sorted(snap["latency"].items()):
+            lines.append(f'pdi_request_duration_seconds_sum{{kind="{kind}"}} {snap["latency_sum"].get(kind, 0):.6f}')
+            lines.append(f'pdi_request_duration_seconds_count{{kind="{kind}"}} {sum(buckets)}')
+
+        for name, (help_text, metric_type, label, values) in sorted(self.read_gauges().items()):
+            metric(name, help_text, metric_type, [(((label, key),), value) for key, value in sorted(values.items())])
+
+        metric("pdi_uptime_seconds", "Seconds since the run started.", "gauge",
+               [((), round(time.monotonic() - self.started_at, 3))])
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """原子写入 textfile，避免采集方读到半个文件。"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+
+class MetricsReporter:
+    """每 interval 秒输出一行进度，并在设置了 textfile 路径时写 Prometheus 文件。"""
+
+    def __init__(self, metrics, interval=10, textfile=""):
+        self.metrics = metrics
+        self.interval = interval
+        self.textfile = textfile
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.last = None  # (时间, 快照)，用于计算速率
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        self.last = (time.monotonic(), self.metrics.snapshot())
+        self.thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.report()
+
+    def report(self):
+        now, snap = time.monotonic(), self.metrics.snapshot()
+        then, previous = self.last or (self.metrics.started_at, {})
+        self.last = (now, snap)
+        elapsed = max(now - then, 1e-6)
+
+        def delta(name, host):
+            return _host_total(snap, name, host) - _host_total(previous, name, host)
+
+        gauges = {name: values for name, (_, _, _, values) in self.metrics.read_gauges().items()}
+        in_flight = sum(gauges.get("pdi_in_flight", {}).values())
+        queued = sum(gauges.get("pdi_queue_depth", {}).values())
+        latency = snap["latency"]
+        logger.info(
+            f"进度: ajax {delta('requests', 'api') / elapsed:.1f} 次/秒，图片 {delta('requests', 'image') / elapsed:.1f} 张/秒，"
+            f"{delta('bytes', 'image') / elapsed / (1024 * 1024):.2f} MB/秒，进行中 {in_flight}，排队 {queued}，"
+            f"429 共 {sum(snap['throttled'].values())} 次，重试 {sum(snap['retries'].values())} 次，"
+            f"元数据 p50/p95 {Metrics.quantile(latency.get('metadata', []), 0.5)}/"
+            f"{Metrics.quantile(latency.get('metadata', []), 0.95)} 秒，"
+            f"图片 p50/p95 {Metrics.quantile(latency.get('image', []), 0.5)}/"
+            f"{Metrics.quantile(latency.get('image', []), 0.95)} 秒")
+        if self.textfile:
+            try:
+                self.metrics.write_textfile(self.textfile)
+            except OSError as e:
+                logger.warning(f"写入指标文件 {self.textfile} 失败：{e}")
+
+    def stop(self):
+        """停止报告线程，并输出最后一次进度和指标文件。"""
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.report()
+
+
+# 全局指标
+metrics = Metrics()
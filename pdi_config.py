@@ -14,16 +14,44 @@ class Config:
         self.debug_mode = False
         self.HEADERS = {}
         self.COOKIES = {}
-        self.user_stats = {
-            "download_failed": {},  # 初始为空字典
-            "success": {},
-            "file_exists": {},
-        }
-        self.skipped_stats = {"skipped_images_count": 0, 'file_exists': {}, 'error_dict': {}}
         self.error_dict = {}
         self.img_threads = 3
         self.artwork_threads = 2
+        self.image_workers = 6  # 流水线图片下载线程数
+        self.image_queue_size = 12  # 流水线图片任务队列容量
+        self.max_concurrency = 0  # 所有用户共用的总并发上限，0 为不额外限制
         self.down_path = ""
+        self.chunk_size = 256 * 1024  # 流式下载每块字节数
+        self.max_inflight_bytes = 64 * 1024 * 1024  # 全局在途字节上限
+        self.disk_writers = 2  # 写盘线程数，0 为在下载线程中直接写盘
+        self.disk_queue_size = 64  # 每个写盘线程的队列容量
+        self.fsync = "none"  # 刷盘策略：none、file 或 artwork
+        self.preallocate = False  # 按 Content-Length 预先分配文件空间
+        self.dedup = False  # 去重存储：相同内容只保存一份，下载目录中为硬链接
+        # 原图下载的带宽整形：全局上限、按用户上限和按时段上限（字节/秒，0 为不限）
+        self.bandwidth = {"rate": 0, "user_rates": {}, "schedule": []}
+        self.engine = "thread"  # 下载引擎：thread 或 async
+        self.async_transfers = 64  # 异步引擎同时传输的图片数
+        self.rate_limits = {"api_rate": 1.5, "api_burst": 2, "image_rate": 0, "image_burst": 10}  # 令牌桶限速
+        self.adaptive = True  # 是否根据 429/503 自动调整并发数和速率
+        self.api_max_rate = 3  # 自适应提速时 ajax 接口速率上限
+        self.manifest = True  # 是否使用下载清单做增量同步
+        self.manifest_path = ""  # 清单文件路径，留空为 下载路径/.pdi_manifest.sqlite3
+        self.metadata_cache = {"enabled": True, "ttl": 24 * 3600, "max_bytes": 64 * 1024 * 1024, "bypass": False}
+        self.retry_failed = False  # 只重试错误日志中未成功的图片和作品
+        self.stats_detail_limit = 0  # 按文件记录统计明细的最大条数，0 为只保留聚合计数
+        self.metrics_interval = 10  # 进度输出和指标文件写入间隔（秒），0 为关闭
+        self.metrics_textfile = ""  # Prometheus textfile 路径，留空不写
+        self.api_base = "https://www.pixiv.net"  # ajax 接口地址，基准测试时指向本地模拟服务器
+        self.trace_file = ""  # Chrome trace 输出路径，留空不追踪
+        self.trace_sample_rate = 1.0  # 被追踪请求的采样比例
+        self.library_index = True  # 启动时扫描下载目录，跳过磁盘上已完整的作品
+        self.library_index_cache = True  # 把索引缓存到 下载路径/.pdi_index.json
+        self.profile_batch_size = 48  # 批量获取作品信息时每次请求的作品数，0 为逐个请求
+        self.transport = "requests"  # HTTP 传输后端：requests 或 http2
+        self.rename_sync = "move"  # 用户名或标题改变时：move 移动已有目录，link 硬链接，off 重新下载
+        # 重试策略：每个请求的尝试次数、重试预算（占请求数的比例）、熔断阈值和冷却时间
+        self.retry = {"max_attempts": 3, "budget_ratio": 0.2, "failure_threshold": 5, "cooldown": 30.0}
 
     def store_config(self, config_data):
         """
@@ -41,7 +69,39 @@ class Config:
         self.logger = logger
         self.img_threads = config_data.get("img_threads", 3)
         self.artwork_threads = config_data.get("artwork_threads", 2)
+        self.image_workers = config_data.get("image_workers", self.artwork_threads * self.img_threads)
+        self.image_queue_size = config_data.get("image_queue_size", self.image_workers * 2)
+        self.max_concurrency = config_data.get("max_concurrency", 0)
         self.down_path = config_data.get("down_path", "")
+        self.chunk_size = config_data.get("chunk_size", 256 * 1024)
+        self.max_inflight_bytes = config_data.get("max_inflight_bytes", 64 * 1024 * 1024)
+        self.disk_writers = config_data.get("disk_writers", 2)
+        self.disk_queue_size = config_data.get("disk_queue_size", 64)
+        self.fsync = config_data.get("fsync", "none")
+        self.preallocate = config_data.get("preallocate", False)
+        self.dedup = config_data.get("dedup", False)
+        self.bandwidth = config_data.get("bandwidth", self.bandwidth)
+        self.engine = config_data.get("engine", "thread")
+        self.async_transfers = config_data.get("async_transfers", 64)
+        self.rate_limits = config_data.get("rate_limits", self.rate_limits)
+        self.adaptive = config_data.get("adaptive", True)
+        self.api_max_rate = config_data.get("api_max_rate", 3)
+        self.manifest = config_data.get("manifest", True)
+        self.manifest_path = config_data.get("manifest_path", "")
+        self.metadata_cache = config_data.get("metadata_cache", self.metadata_cache)
+        self.retry_failed = config_data.get("retry_failed", False)
+        self.stats_detail_limit = config_data.get("stats_detail_limit", 0)
+        self.metrics_interval = config_data.get("metrics_interval", 10)
+        self.metrics_textfile = config_data.get("metrics_textfile", "")
+        self.api_base = config_data.get("api_base", "https://www.pixiv.net").rstrip("/")
+        self.trace_file = config_data.get("trace_file", "")
+        self.trace_sample_rate = config_data.get("trace_sample_rate", 1.0)
+        self.library_index = config_data.get("library_index", True)
+        self.library_index_cache = config_data.get("library_index_cache", True)
+        self.rename_sync = config_data.get("rename_sync", "move")
+        self.profile_batch_size = config_data.get("profile_batch_size", 48)
+        self.transport = config_data.get("transport", "requests")
+        self.retry = config_data.get("retry", self.retry)
 
         # 日志记录
         self.logger.info(
@@ -49,7 +109,7 @@ class Config:
 
         # 设置请求头和 cookies
         self.HEADERS = {
-            "Referer": "https://www.pixiv.net/",
+            "Referer": f"{self.api_base}/",
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
         }
 
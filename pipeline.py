@@ -0,0 +1,233 @@
+# pipeline.py
+# 两级下载流水线：元数据线程把图片任务放进有界队列，固定数量的图片线程从队列中取任务下载。
+# 两个阶段都按用户轮转取任务，多个用户的作品交错进行，一个用户不会拖住其他用户。
+import collections
+import contextlib
+import heapq
+import itertools
+import threading
+import time
+
+from log_config import logger
+from pdi_config import config
+from metrics import metrics
+from retry_policy import CircuitDeferred
+
+_STOP = object()  # 队列关闭且为空时返回的结束标记
+ARTWORKS_KEY = "作品"  # ARTWORK_IDS 中单独作品的公平队列键
+
+
+class FairQueue:
+    """
+    按键轮转（round-robin）的公平队列：每个键（用户）有自己的子队列，get() 依次从各个键取一个任务，
+    并优先取正在处理（已取出、尚未 task_done）的任务最少的键，处理慢的键（例如被限速的用户）不会占满所有线程。
+    maxsize 为所有子队列的总容量，0 表示不限；队列满时，已占到平均份额（maxsize / 键数）的键 put() 阻塞，
+    其他键仍可放入，总数最多超出 maxsize 键数个，避免一个处理慢的键占满队列使其他键的生产者也无法放入。
+    put_later() 放入的任务到时间后才能取出，在此之前 get() 先返回其他任务。
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.queues = collections.OrderedDict()  # key -> deque，顺序即轮转顺序
+        self.size = 0
+        self.closed = False
+        self.active = collections.Counter()  # key -> 已取出、尚未 task_done 的任务数
+        self.delayed = []  # 堆：(可以取出的时间, 序号, key, 任务)
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    def put(self, key, item):
+        with self.condition:
+            while self.maxsize and self.size >= self.maxsize and self._over_share(key):
+                self.condition.wait()
+            self.queues.setdefault(key, collections.deque()).append(item)
+            self.size += 1
+            self.condition.notify_all()
+
+    def put_later(self, key, item, delay):
+        """delay 秒后再放入 key 的子队列；由取出任务的线程调用，不受容量限制，不会阻塞。"""
+        with self.condition:
+            heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.sequence), key, item))
+            self.condition.notify_all()
+
+    def _promote(self):
+        # 把已经到时间的推迟任务放回各自键的子队列末尾
+        now = time.monotonic()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, _, key, item = heapq.heappop(self.delayed)
+            self.queues.setdefault(key, collections.deque()).append(item)
+            self.size += 1
+
+    def _over_share(self, key):
+        items = self.queues.get(key)
+        return items is not None and len(items) * len(self.queues) >= self.maxsize
+
+    def get(self):
+        """
+        取出正在处理的任务最少的键的下一个任务，同样少时按轮转顺序.
+
+        返回:
+            tuple: (键, 任务)；队列关闭且为空时为 (None, _STOP)。处理完后调用 task_done(键).
+        """
+        with self.condition:
+            while True:
+                self._promote()
+                if self.size or (self.closed and not self.delayed):
+                    break
+                self.condition.wait(self.delayed[0][0] - time.monotonic() if self.delayed else None)
+            if not self.size:
+                return None, _STOP
+            key = min(self.queues, key=lambda k: self.active[k])  # min 返回第一个最小值，即轮转顺序靠前的键
+            items = self.queues[key]
+            item = items.popleft()
+            if items:
+                self.queues.move_to_end(key)  # 轮到下一个键
+            else:
+                del self.queues[key]
+            self.size -= 1
+            self.active[key] += 1
+            self.condition.notify_all()
+            return key, item
+
+    def task_done(self, key):
+        with self.condition:
+            self.active[key] -= 1
+            if not self.active[key]:
+                del self.active[key]
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def depths(self):
+        with self.condition:
+            return {key: len(items) for key, items in self.queues.items()}
+
+
+class DownloadPipeline:
+    """
+    线程引擎的全局下载调度器。
+
+    - 元数据阶段：metadata_workers 个线程获取用户作品列表、作品信息和图片 URL，生成图片任务；
+    - 图片阶段：image_workers 个常驻线程消费任务并下载；
+    - 两个阶段都使用按用户轮转的 FairQueue；图片队列容量为 queue_size，满时元数据线程阻塞，
+      对所有用户和作品统一施加背压；
+    - max_concurrency 大于 0 时，两个阶段同时执行的任务总数不超过这个值。
+    """
+
+    def __init__(self, down_path, metadata_workers, image_workers, queue_size, max_concurrency=0):
+        self.down_path = down_path
+        self.metadata_queue = FairQueue()  # 任务只有 ID，不限容量，避免元数据线程互相等待
+        self.image_queue = FairQueue(maxsize=max(queue_size, 1))
+        self.slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency > 0 else None
+        self.pending = 0  # 尚未完成的元数据任务数
+        self.seen = set()  # 已提交的作品，USER_IDS 与 ARTWORK_IDS 重叠时只下载一次
+        self.condition = threading.Condition()
+        self.workers = [
+            threading.Thread(target=self._metadata_worker, name=f"metadata-{index}", daemon=True)
+            for index in range(metadata_workers)
+        ]
+        self.image_workers = [
+            threading.Thread(target=self._image_worker, name=f"image-{index}", daemon=True)
+            for index in range(image_workers)
+        ]
+        for worker in self.workers + self.image_workers:
+            worker.start()
+        metrics.register_gauge("pdi_queue_depth", "Tasks waiting in the download pipeline queues.",
+                               lambda: {"metadata": self.metadata_queue.size, "image": self.image_queue.size},
+                               label="queue")
+        logger.info(f"下载流水线：元数据线程 {metadata_workers} 个，图片线程 {image_workers} 个，"
+                    f"队列容量 {queue_size}，总并发上限 {max_concurrency or '不限'}")
+
+    def _submit(self, key, task):
+        with self.condition:
+            self.pending += 1
+        self.metadata_queue.put(key, task)
+
+    def add_user(self, user_id):
+        """提交一个用户：在元数据线程中获取作品列表，再把作品逐个加入该用户的子队列。"""
+        self._submit(str(user_id), ("user", user_id))
+
+    def add_artwork(self, artwork_id, user_id=None, key=None):
+        """提交一个作品：在元数据线程中获取信息，再把每张图片放进图片队列。"""
+        with self.condition:
+            if str(artwork_id) in self.seen:
+                logger.debug(f"作品 {artwork_id} 已提交过，跳过重复项")
+                return
+            self.seen.add(str(artwork_id))
+        key = key or (str(user_id) if user_id else ARTWORKS_KEY)
+        self._submit(key, ("artwork", artwork_id, user_id, key))
+
+    def add_image(self, img_url, save_path, key=ARTWORKS_KEY):
+        """直接提交一张图片（例如重试错误日志中的失败项），不经过元数据阶段。"""
+        self.image_queue.put(key, (img_url, save_path, None))
+
+    def _metadata_worker(self):
+        while True:
+            # 优先处理没有其他元数据线程在处理的用户，避免所有线程都阻塞在同一个下载慢的用户上
+            key, task = self.metadata_queue.get()
+            if task is _STOP:
+                return
+            try:
+                if task[0] == "user":
+                    from down_user_artwork import download_user_artworks
+                    with self._slot():
+                        download_user_artworks(task[1], self)
+                else:
+                    self._produce_artwork(*task[1:])
+            except Exception as e:
+                logger.error(f"元数据任务出错：{e}")
+            finally:
+                self.metadata_queue.task_done(key)
+                with self.condition:
+                    self.pending -= 1
+                    self.condition.notify_all()
+
+    def _produce_artwork(self, artwork_id, user_id, key):
+        from artwork_down import prepare_artwork_images
+
+        with self._slot():
+            jobs = prepare_artwork_images(artwork_id, user_id, self.down_path)
+        # 放入队列时不占用并发名额，避免队列满时与图片线程互相等待
+        for img_url, save_path in jobs:
+            self.image_queue.put(key, (img_url, save_path, None))  # 队列满时阻塞，形成背压
+
+    def _image_worker(self):
+        from download import download_image
+
+        while True:
+            # 按用户正在下载的图片数分配线程，下载慢的用户不会占住所有图片线程
+            key, job = self.image_queue.get()
+            if job is _STOP:
+                return
+            img_url, save_path, deferred_since = job
+            try:
+                with self._slot():
+                    download_image(img_url, save_path, config.HEADERS, config.COOKIES, defer=True,
+                                   deferred_since=deferred_since)
+            except CircuitDeferred as e:
+                # 原图主机熔断：放回队列，到时间后再下载，这个线程先去处理其他任务
+                self.image_queue.put_later(key, (img_url, save_path, deferred_since or time.monotonic()), e.delay)
+            except Exception as e:
+                logger.error(f"图片任务出错：{e}")
+            finally:
+                self.image_queue.task_done(key)
+
+    def _slot(self):
+        return self.slots if self.slots is not None else contextlib.nullcontext()
+
+    def queue_depths(self):
+        return {"metadata": self.metadata_queue.depths(), "image": self.image_queue.depths()}
+
+    def join(self):
+        """等待所有已提交的用户、作品和图片下载完成，然后停止所有线程。"""
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+        self.metadata_queue.close()
+        for worker in self.workers:
+            worker.join()
+        self.image_queue.close()  # 图片线程取完剩余任务后退出
+        for worker in self.image_workers:
+            worker.join()
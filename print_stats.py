@@ -1,5 +1,4 @@
-import json
-
+from error_journal import error_journal
 from log_config import logger
 
 
@@ -15,8 +14,12 @@ def print_stats(user_stats, skipped_stats, error_dict):
     if skipped_stats.get("download_failed"):
         for file_path, fail_count in skipped_stats["download_failed"].items():
             logger.info(f"文件 {file_path} 下载失败，跳过了 {fail_count} 张图。")
+        if skipped_stats.get("download_failed_dropped"):
+            logger.info(f"另有 {skipped_stats['download_failed_dropped']} 次失败超出明细上限，未逐个列出。")
+    elif skipped_stats.get("download_failed_count"):
+        logger.info(f"下载失败 {skipped_stats['download_failed_count']} 张图（详情见 error.json）。")
 
     logger.info(f"总共跳过了 {skipped_stats['skipped_images_count']} 张图片。")
 
-    with open("error.json", "w", encoding="utf-8") as f:
-        json.dump(error_dict, f, ensure_ascii=False, indent=4)
+    # 从错误日志导出 error.json（图片失败）和 error_artworks.json（作品失败）
+    error_journal.export()
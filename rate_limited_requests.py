@@ -1,33 +1,136 @@
+import itertools
 import time
 import threading
-import random
+
 import requests
 
+from handle_429 import controller, THROTTLE_STATUSES
+from http_pool import pool, API_HOST, host_class
+from log_config import logger
+from metrics import metrics
+from tracing import tracer
+from transport import transport
+from retry_policy import retry_policy, RETRY_STATUSES
 
-class RateLimiter:
+# 暴露 requests 的异常和其他属性（调用方使用 requests.exceptions.RequestException 等），
+# 请求方法由本模块下面的函数提供，不再修改全局的 requests 模块
+globals().update({k: getattr(requests, k) for k in dir(requests) if not k.startswith("_")})
+
+
+class TokenBucket:
     """
-    频率限制器：控制请求频率，确保最小请求间隔，并加入随机等待时间
+    令牌桶频率限制器：按 rate 个/秒补充令牌，最多积攒 burst 个。
+    reserve() 只在锁内计算并预约时间点，立刻返回需要等待的秒数；
+    调用方在锁外睡眠，多个等待者之间互不阻塞。
     """
 
-    def __init__(self, min_requests_per_second=1, max_requests_per_second=2):
-        self.min_interval = 1 / max_requests_per_second
-        self.max_interval = 1 / min_requests_per_second
-        self.last_request_time = 0
+    def __init__(self, name, rate, burst=1):
+        self.name = name
         self.lock = threading.Lock()
-
-    def wait(self):
+        self.configure(rate, burst)
+        # 计数器
+        self.requests = 0  # 预约次数
+        self.delayed = 0  # 需要等待的次数
+        self.total_wait = 0.0  # 累计等待秒数
+        self.max_wait = 0.0  # 单次最长等待秒数
+
+    def configure(self, rate, burst=1):
         with self.lock:
-            current_time = time.time()
-            elapsed = current_time - self.last_request_time
-            # 随机时间间隔
-            sleep_time = random.uniform(self.min_interval, self.max_interval)
-            if elapsed < sleep_time:
-                time.sleep(sleep_time - elapsed)
-            self.last_request_time = time.time()
+            self.rate = float(rate)  # 0 表示不限速
+            self.capacity = max(float(burst), 1.0)
+            self.tokens = self.capacity
+            self.updated = time.monotonic()
+
+    def reserve(self, tokens=1):
+        """
+        预约令牌，不睡眠.
+
+        返回:
+            float: 调用方还需要等待的秒数，0 表示可以立即发出请求.
+        """
+        with self.lock:
+            self.requests += 1
+            if self.rate <= 0:
+                return 0.0
+
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # 令牌允许透支为负数，后来的调用方会被排到更晚的时间点
+            self.tokens -= tokens
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+            if delay > 0:
+                self.delayed += 1
+                self.total_wait += delay
+                self.max_wait = max(self.max_wait, delay)
+            return delay
+
+    def set_rate(self, rate):
+        # 只调整速率，保留当前令牌（供自适应控制器使用）
+        with self.lock:
+            now = time.monotonic()
+            if self.rate > 0:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = float(rate)
+
+    def wait(self, tokens=1):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)  # 在锁外睡眠
+        return delay
+
+    def stats(self):
+        with self.lock:
+            return {
+                "rate": self.rate,
+                "burst": self.capacity,
+                "requests": self.requests,
+                "delayed": self.delayed,
+                "total_wait": round(self.total_wait, 3),
+                "max_wait": round(self.max_wait, 3),
+            }
+
+
+class RateLimiter:
+    """
+    按主机分类的频率限制器：ajax 接口（www.pixiv.net）和原图（i.pximg.net）各用一个令牌桶，
+    其他主机归入 ajax 类。
+    """
+
+    def __init__(self, api_rate=1.5, api_burst=2, image_rate=0, image_burst=10):
+        self.buckets = {
+            "api": TokenBucket("api", api_rate, api_burst),
+            "image": TokenBucket("image", image_rate, image_burst),
+        }
+
+    def configure(self, api_rate, api_burst, image_rate, image_burst):
+        self.buckets["api"].configure(api_rate, api_burst)
+        self.buckets["image"].configure(image_rate, image_burst)
+
+    def bucket_for(self, url):
+        return self.buckets[host_class(url)]
+
+    def reserve(self, url):
+        return self.bucket_for(url).reserve()
 
+    def wait(self, url):
+        return self.bucket_for(url).wait()
 
-# 初始化全局频率限制器
-_rate_limiter = RateLimiter(min_requests_per_second=1, max_requests_per_second=2)
+    def stats(self):
+        return {name: bucket.stats() for name, bucket in self.buckets.items()}
+
+    def log_stats(self):
+        for name, bucket_stats in self.stats().items():
+            logger.info(
+                f"频率限制 {name}: 请求 {bucket_stats['requests']} 次，等待 {bucket_stats['delayed']} 次，"
+                f"累计等待 {bucket_stats['total_wait']} 秒，最长 {bucket_stats['max_wait']} 秒")
+
+
+# 初始化全局频率限制器，并交给自适应控制器调整速率
+_rate_limiter = RateLimiter()
+controller.attach(_rate_limiter)
 
 # 配置请求头，模拟真实浏览器
 headers = {
@@ -38,55 +141,92 @@ headers = {
 }
 
 # 重试机制设置，包括对 429 的处理
-from requests.adapters import HTTPAdapter
-
-
 def get_retry_session():
-    session = requests.Session()
-    from urllib3 import Retry
-    retry = Retry(
-        total=5,  # 总共尝试次数
-        backoff_factor=1,  # 重试间隔时间指数倍数
-        status_forcelist=[500, 502, 503, 504, 429],  # 遇到这些错误重试
-        allowed_methods=["GET", "POST", "PUT", "DELETE", "HEAD", "OPTIONS", "PATCH"],  # 新版使用 allowed_methods
-        raise_on_status=False  # 不抛出异常，便于捕获和重试
-    )
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount("http://", adapter)
-    session.mount("https://", adapter)
-    return session
+    # 返回 ajax 主机的共享长连接 Session（重试策略由 http_pool 统一配置）
+    return pool.get_session(API_HOST)
 
 
 # 创建一个带有频率限制和重试的 request 方法
 def _rate_limited_request(method, url, **kwargs):
-    _rate_limiter.wait()  # 频率限制等待
-    session = get_retry_session()  # 获取带有重试机制的 session
     kwargs["headers"] = kwargs.get("headers", headers)  # 默认使用自定义请求头
-    response = session.request(method, url, **kwargs)
-
-    # 如果是 429 状态码，可以添加处理逻辑，比如等待
-    if response.status_code == 429:
-        retry_after = response.headers.get('Retry-After')
-        if retry_after:
-            wait_time = int(retry_after)  # 如果有 Retry-After 头部，使用其值
-            print(f"Too many requests, waiting for {wait_time} seconds...")
-            time.sleep(wait_time)
-        else:
-            # 默认等待 1 秒后重试
-            print("Too many requests, waiting for 1 second...")
-            time.sleep(1)
-    return response
-
-
-# 替换 requests 的方法
-requests.request = _rate_limited_request
-requests.get = lambda url, **kwargs: _rate_limited_request("GET", url, **kwargs)
-requests.post = lambda url, **kwargs: _rate_limited_request("POST", url, **kwargs)
-requests.put = lambda url, **kwargs: _rate_limited_request("PUT", url, **kwargs)
-requests.delete = lambda url, **kwargs: _rate_limited_request("DELETE", url, **kwargs)
-requests.head = lambda url, **kwargs: _rate_limited_request("HEAD", url, **kwargs)
-requests.options = lambda url, **kwargs: _rate_limited_request("OPTIONS", url, **kwargs)
-requests.patch = lambda url, **kwargs: _rate_limited_request("PATCH", url, **kwargs)
-
-# 将原始 requests 的其他属性暴露
-globals().update({k: getattr(requests, k) for k in dir(requests) if not k.startswith("_")})
+    host = host_class(url)
+    kind = "metadata" if host == "api" else "image"
+
+    for attempt in itertools.count():
+        ticket = retry_policy.wait_acquire(url, kind)  # 该主机熔断时等待探测请求成功
+        with tracer.span("throttle_wait", host=host):
+            controller.acquire(url)  # 等待 Retry-After 窗口结束并占用并发名额
+        status_code = None
+        retry_after = None
+        started = None
+        response = None
+        try:
+            with tracer.span("rate_limit_wait", host=host):
+                _rate_limiter.wait(url)  # 按主机的令牌桶等待（锁外睡眠）
+            started = time.perf_counter()
+            with tracer.span("http", url=url, attempt=attempt) as span:
+                response = transport.request(method, url, **kwargs)  # 当前的传输后端（见 transport.py）
+                span.set(status=response.status_code)
+                if tracer.active:
+                    # response.elapsed 为发出请求到解析完响应头的时间（含建立连接），其后为读取响应体
+                    headers_at = started + response.elapsed.total_seconds()
+                    tracer.add_span("ttfb", started, headers_at)
+                    tracer.add_span("body", headers_at, time.perf_counter())
+            status_code = response.status_code
+            retry_after = response.headers.get("Retry-After")
+        except requests.exceptions.RequestException as e:
+            delay = retry_policy.failed(url, kind, attempt, error=e, ticket=ticket)
+            if delay is None:
+                raise
+            logger.warning(f"请求 {url} 出错：{e}，{delay:.1f} 秒后重试（第 {attempt + 1} 次重试）")
+            metrics.count_retry(kind)
+        finally:
+            controller.release(url, status_code, retry_after)
+            if started is not None:
+                metrics.observe_request(host, kind, time.perf_counter() - started, status_code or "error",
+                                        int(response.headers.get("Content-Length") or 0) if response is not None else 0)
+
+        if response is not None:
+            if status_code not in THROTTLE_STATUSES and status_code not in RETRY_STATUSES:
+                retry_policy.succeeded(url, ticket)
+                return response
+            # 429/503：控制器已让该主机的所有线程一起暂停并降速，这里重新排队；5xx 按退避时间重试
+            delay = retry_policy.failed(url, kind, attempt, status=status_code, ticket=ticket)
+            if delay is None:
+                return response  # 由调用方 raise_for_status() 处理
+            logger.warning(f"请求 {url} 返回 {status_code}，{delay:.1f} 秒后重试（第 {attempt + 1} 次重试）")
+            metrics.count_retry(kind)
+            response.close()
+        time.sleep(delay)
+
+
+# 与 requests 同名的请求方法，调用方 import rate_limited_requests as requests 后直接使用
+request = _rate_limited_request
+
+
+def get(url, **kwargs):
+    return _rate_limited_request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return _rate_limited_request("POST", url, **kwargs)
+
+
+def put(url, **kwargs):
+    return _rate_limited_request("PUT", url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return _rate_limited_request("DELETE", url, **kwargs)
+
+
+def head(url, **kwargs):
+    return _rate_limited_request("HEAD", url, **kwargs)
+
+
+def options(url, **kwargs):
+    return _rate_limited_request("OPTIONS", url, **kwargs)
+
+
+def patch(url, **kwargs):
+    return _rate_limited_request("PATCH", url, **kwargs)
@@ -0,0 +1,311 @@
+# retry_policy.py
+# 统一的重试策略：指数退避加随机抖动、按本次运行请求数比例计算的重试预算、按主机的熔断器。
+# 连接池和传输层本身不再重试，ajax 请求和原图下载（线程版与异步版）都由这里决定是否重试、等待多久
+import asyncio
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+from handle_429 import THROTTLE_STATUSES
+from log_config import logger
+
+RETRY_STATUSES = (500, 502, 504)  # 服务器错误：可以重试，并计入熔断器（429/503 交给自适应控制器处理）
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """主机的熔断器处于打开状态，等待超时后请求没有发出。"""
+
+
+class CircuitDeferred(Exception):
+    """主机的熔断器处于打开状态，请求暂时不能发出：delay 秒后再试，调用方可以先处理其他任务。"""
+
+    def __init__(self, host, delay):
+        super().__init__(f"主机 {host} 已熔断，{delay:.1f} 秒后再试")
+        self.host = host
+        self.delay = delay
+
+
+class Breaker:
+    """单个主机的熔断器状态：closed（正常）、open（拒绝请求）、half_open（放行一个探测请求）。"""
+
+    def __init__(self, host):
+        self.host = host
+        self.state = "closed"
+        self.failures = 0  # 连续失败次数
+        self.cooldown = 0.0  # 本次打开的时长，探测失败时加倍
+        self.open_until = 0.0  # time.monotonic
+        self.probe_started = None  # 半开状态下探测请求的开始时间
+        self.probe_ticket = None  # 探测请求的许可编号，只有它的结果能关闭或重新打开熔断器
+        self.opens = 0  # 打开次数
+        self.short_circuits = 0  # 因熔断而等待的请求次数
+
+
+def _host(url):
+    return urlsplit(url).hostname or url
+
+
+class RetryPolicy:
+    """
+    重试策略.
+
+    - 每个请求最多尝试 max_attempts 次，失败后等待 min(max_delay, base_delay * 2^n) 以内的随机时间（full jitter）；
+    - 重试预算：本次运行的重试次数不超过 min_retries + 请求次数 * budget_ratio，故障时不会放大请求量；
+    - 熔断器：同一主机连续失败 failure_threshold 次后打开，cooldown 秒内该主机的请求等待（其他主机照常进行），
+      之后放行一个探测请求，成功则关闭，失败则再打开并加倍等待时间；等待时间加倍到 max_cooldown 后
+      该主机的请求不再等待而是直接失败（记入 error.json，可以用 retry_failed 重试），只保留定期探测；
+    - 404 等客户端错误不重试；429/503 由自适应控制器暂停并降速，这里只限制次数，不计入预算和熔断器.
+    """
+
+    def __init__(self, max_attempts=3, base_delay=1.0, max_delay=30.0, budget_ratio=0.2, min_retries=10,
+                 failure_threshold=5, cooldown=30.0, max_cooldown=300.0, max_throttle_attempts=6):
+        self.lock = threading.Lock()
+        self.random = random.Random()
+        self.breakers = {}  # host -> Breaker
+        self.tickets = 0  # 已发放的许可编号
+        self.configure(max_attempts, base_delay, max_delay, budget_ratio, min_retries, failure_threshold, cooldown,
+                       max_cooldown, max_throttle_attempts)
+        self.reset_stats()
+
+    def configure(self, max_attempts=3, base_delay=1.0, max_delay=30.0, budget_ratio=0.2, min_retries=10,
+                  failure_threshold=5, cooldown=30.0, max_cooldown=300.0, max_throttle_attempts=6):
+        with self.lock:
+            self.max_attempts = max(int(max_attempts), 1)
+            self.base_delay = base_delay
+            self.max_delay = max_delay
+            self.budget_ratio = budget_ratio
+            self.min_retries = min_retries
+            self.failure_threshold = failure_threshold  # 0 为关闭熔断器
+            self.cooldown = cooldown
+            self.max_cooldown = max(max_cooldown, cooldown)
+            self.max_throttle_attempts = max_throttle_attempts
+            self.breakers.clear()
+
+    def reset_stats(self):
+        with self.lock:
+            self.attempts = {}  # kind -> 实际发出的请求次数（含重试）
+            self.retries = {}  # kind -> 重试次数（计入重试预算）
+            self.requeues = {}  # kind -> 因 429/503 或 416 重新排队的次数（不计入重试预算）
+            self.gave_up = {}  # kind -> 放弃的请求数
+            self.budget_exhausted = 0  # 因预算用完而放弃的次数
+            self.requests = 0
+
+    # ---- 熔断器 ----
+
+    def _breaker(self, host):
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            breaker = self.breakers[host] = Breaker(host)
+        return breaker
+
+    def _check(self, url, kind, waited):
+        """
+        非阻塞检查熔断器，允许时登记一次尝试.
+
+        返回:
+            tuple: (delay, ticket)；delay 为 0 表示可以发出请求，否则为建议等待的秒数，None 表示不再等待，直接失败；
+                ticket 为允许发出的请求的许可编号，其余情况为 None.
+        """
+        with self.lock:
+            breaker = self._breaker(_host(url))
+            now = time.monotonic()
+            if breaker.state == "open" and now >= breaker.open_until:
+                breaker.state = "half_open"
+                breaker.probe_started = None
+            self.tickets += 1
+            if breaker.state == "half_open":
+                # 只放行一个探测请求；探测请求异常退出没有记录结果时，超过 cooldown 后再放行一个
+                if breaker.probe_started is None or now - breaker.probe_started > max(breaker.cooldown, 1.0):
+                    breaker.probe_started = now
+                    breaker.probe_ticket = self.tickets
+                else:
+                    if not waited:
+                        breaker.short_circuits += 1
+                    return 0.5, None
+            elif breaker.state == "open":
+                if not waited:
+                    breaker.short_circuits += 1
+                if breaker.cooldown >= self.max_cooldown:
+                    return None, None  # 冷却时间已加倍到上限，主机基本不可用，其余请求直接失败，只保留定期探测
+                return breaker.open_until - now, None
+            self.requests += 1
+            self.attempts[kind] = self.attempts.get(kind, 0) + 1
+            return 0.0, self.tickets
+
+    def _wait_limit(self):
+        # 等待（或推迟）熔断器的上限：超过后这次请求按失败处理，留给下次运行（retry_failed）重试
+        return self.max_cooldown + self.cooldown
+
+    def acquire(self, url, kind, deferred_since=None):
+        """
+        在发出请求前调用，不阻塞：熔断器打开时抛出 CircuitDeferred，由调用方稍后再试（例如放回队列）.
+
+        参数:
+            deferred_since (float | None): 这个请求第一次被推迟的时间（time.monotonic()），
+                推迟超过上限时抛出 CircuitOpenError，按失败处理.
+
+        返回:
+            int: 许可编号，请求结束后传给 succeeded / failed，用来区分半开状态下的探测请求.
+        """
+        delay, ticket = self._check(url, kind, deferred_since is not None)
+        if delay == 0:
+            return ticket
+        if delay is None or (deferred_since is not None and time.monotonic() - deferred_since >= self._wait_limit()):
+            raise CircuitOpenError(f"主机 {_host(url)} 持续失败，熔断器处于打开状态")
+        if deferred_since is None:
+            logger.debug(f"主机 {_host(url)} 已熔断，{delay:.1f} 秒后再试")
+        raise CircuitDeferred(_host(url), delay)
+
+    def wait_acquire(self, url, kind):
+        """acquire 的阻塞版本：熔断器打开时在当前线程中等待，超过上限时抛出 CircuitOpenError。"""
+        deferred_since = None
+        while True:
+            try:
+                return self.acquire(url, kind, deferred_since)
+            except CircuitDeferred as e:
+                deferred_since = deferred_since or time.monotonic()
+                time.sleep(min(e.delay, 1.0))
+
+    async def async_acquire(self, url, kind):
+        """acquire 的协程版本，等待时只挂起当前协程。"""
+        deferred_since = None
+        while True:
+            try:
+                return self.acquire(url, kind, deferred_since)
+            except CircuitDeferred as e:
+                deferred_since = deferred_since or time.monotonic()
+                await asyncio.sleep(min(e.delay, 1.0))
+
+    def succeeded(self, url, ticket=None):
+        """
+        请求成功（包括 4xx 等不需要重试的结果）.
+
+        熔断器关闭时清零连续失败次数；半开状态下只有探测请求（许可编号为 ticket）的成功才关闭熔断器，
+        熔断之前发出、熔断期间才结束的请求不说明主机已经恢复，忽略其结果.
+        """
+        with self.lock:
+            self._record_success(url, ticket)
+
+    def _record_success(self, url, ticket):
+        breaker = self._breaker(_host(url))
+        if breaker.state == "closed":
+            breaker.failures = 0
+        elif breaker.state == "half_open" and ticket is not None and ticket == breaker.probe_ticket:
+            logger.info(f"主机 {breaker.host} 探测请求成功，熔断器关闭")
+            breaker.state = "closed"
+            breaker.failures = 0
+            breaker.probe_started = None
+            breaker.probe_ticket = None
+
+    def _record_failure(self, url, ticket):
+        breaker = self._breaker(_host(url))
+        if breaker.state == "half_open" and (ticket is None or ticket != breaker.probe_ticket):
+            return  # 熔断之前发出的请求，只有探测请求的失败才重新打开熔断器
+        breaker.failures += 1
+        if breaker.state == "half_open":
+            breaker.cooldown = min(breaker.cooldown * 2, self.max_cooldown)
+        elif breaker.state == "closed" and self.failure_threshold and breaker.failures >= self.failure_threshold:
+            breaker.cooldown = self.cooldown
+        else:
+            return
+        breaker.state = "open"
+        breaker.open_until = time.monotonic() + breaker.cooldown
+        breaker.probe_started = None
+        breaker.probe_ticket = None
+        breaker.opens += 1
+        logger.warning(f"主机 {breaker.host} 连续失败 {breaker.failures} 次，熔断 {breaker.cooldown:.0f} 秒，"
+                       f"期间先处理其他主机的请求")
+
+    # ---- 重试决策 ----
+
+    def failed(self, url, kind, attempt, status=None, error=None, max_attempts=None, ticket=None):
+        """
+        记录一次失败的尝试，并决定是否重试.
+
+        参数:
+            url (str): 请求的 URL.
+            kind (str): 请求类型，metadata 或 image.
+            attempt (int): 已失败的尝试序号，从 0 开始.
+            status (int | None): 响应状态码；为 None 时从 error.response 中读取.
+            error (Exception | None): 网络错误、内容不完整等异常.
+            max_attempts (int | None): 本次请求的尝试次数上限，默认为配置的 max_attempts.
+            ticket (int | None): 这次尝试的许可编号（acquire 的返回值）.
+
+        返回:
+            float | None: 重试前应等待的秒数；None 表示不再重试.
+        """
+        if status is None and getattr(error, "response", None) is not None:
+            status = getattr(error.response, "status_code", None) or getattr(error.response, "status", None)
+
+        max_attempts = max_attempts or self.max_attempts
+        requeue = False
+        with self.lock:
+            if isinstance(error, CircuitOpenError):
+                delay = None  # 已经等待过熔断器，不再重试
+            elif status in THROTTLE_STATUSES:
+                # 自适应控制器已经让该主机暂停并降速，重新排队即可；不计入重试预算
+                delay = 0.0 if attempt + 1 < self.max_throttle_attempts else None
+                requeue = True
+            elif status == 416:
+                # 续传范围无效，调用方已丢弃 .part，立即从头下载；不计入重试预算
+                delay = 0.0 if attempt + 1 < max_attempts else None
+                requeue = True
+            elif status is not None and 400 <= status < 500 and status != 408:
+                self._record_success(url, ticket)  # 主机正常，只是这个请求本身无效
+                delay = None
+            else:
+                self._record_failure(url, ticket)
+                if attempt + 1 >= max_attempts:
+                    delay = None
+                elif self.retries_total() >= self.min_retries + self.requests * self.budget_ratio:
+                    self.budget_exhausted += 1
+                    if self.budget_exhausted == 1:
+                        logger.warning(f"重试预算已用完（{self.retries_total()} 次重试 / {self.requests} 次请求），"
+                                       f"之后失败的请求不再重试")
+                    delay = None
+                else:
+                    delay = self.random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+            if delay is None:
+                self.gave_up[kind] = self.gave_up.get(kind, 0) + 1
+            elif requeue:
+                self.requeues[kind] = self.requeues.get(kind, 0) + 1
+            else:
+                self.retries[kind] = self.retries.get(kind, 0) + 1
+        return delay
+
+    def retries_total(self):
+        # 重试预算只统计失败后的重试，限流和续传范围无效后的重新排队不算
+        return sum(self.retries.values())
+
+    def stats(self):
+        with self.lock:
+            return {
+                "attempts": dict(self.attempts),
+                "retries": dict(self.retries),
+                "requeues": dict(self.requeues),
+                "gave_up": dict(self.gave_up),
+                "budget_exhausted": self.budget_exhausted,
+                "breakers": {host: {"state": breaker.state, "opens": breaker.opens,
+                                    "short_circuits": breaker.short_circuits}
+                             for host, breaker in self.breakers.items()},
+            }
+
+    def log_stats(self):
+        retry_stats = self.stats()
+        for kind, attempts in sorted(retry_stats["attempts"].items()):
+            logger.info(f"重试 {kind}: 尝试 {attempts} 次，重试 {retry_stats['retries'].get(kind, 0)} 次，"
+                        f"限流后重新排队 {retry_stats['requeues'].get(kind, 0)} 次，"
+                        f"放弃 {retry_stats['gave_up'].get(kind, 0)} 个请求")
+        if retry_stats["budget_exhausted"]:
+            logger.info(f"重试预算用完后放弃 {retry_stats['budget_exhausted']} 次重试")
+        for host, breaker_stats in retry_stats["breakers"].items():
+            if breaker_stats["opens"]:
+                logger.info(f"熔断器 {host}: 打开 {breaker_stats['opens']} 次，"
+                            f"等待中的请求 {breaker_stats['short_circuits']} 次，当前状态 {breaker_stats['state']}")
+
+
+# 全局重试策略
+retry_policy = RetryPolicy()
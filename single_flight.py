@@ -0,0 +1,117 @@
+# single_flight.py
+# 请求合并：同一个元数据键在一次运行中只请求一次，并发或重复的调用共享同一个结果
+import asyncio
+import threading
+
+from log_config import logger
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    进程内的 single-flight 层。
+
+    - 同一个键正在请求时，其他调用方等待并共享这次请求的结果；
+    - 成功的结果（keep 返回 True）会保留到本次运行结束，后续调用直接返回；
+    - 失败的结果不保留，之后的调用会重新请求。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}  # 本次运行中已完成的结果
+        self.calls = {}  # 正在进行的线程调用
+        self.async_calls = {}  # 正在进行的协程调用
+        self.requests = 0  # 实际执行的次数
+        self.saved = 0  # 被合并掉的次数
+
+    def do(self, key, fn, keep=bool):
+        """
+        参数:
+            key: 元数据键，例如 ("info", artwork_id).
+            fn (callable): 实际执行请求的函数.
+            keep (callable): 判断结果是否可以保留复用.
+        """
+        with self.lock:
+            if key in self.results:
+                self.saved += 1
+                return self.results[key]
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+                self.requests += 1
+            else:
+                self.saved += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                if call.error is None and keep(call.result):
+                    self.results[key] = call.result
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+    async def async_do(self, key, coro_fn, keep=bool):
+        """协程版本，与线程版共用已完成的结果。"""
+        with self.lock:
+            if key in self.results:
+                self.saved += 1
+                return self.results[key]
+            waiter = self.async_calls.get(key)
+            if waiter is None:
+                future = self.async_calls[key] = asyncio.get_running_loop().create_future()
+                self.requests += 1
+            else:
+                self.saved += 1
+
+        if waiter is not None:
+            return await asyncio.shield(waiter)
+
+        try:
+            result = await coro_fn()
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # 标记异常已读取，避免没有等待者时出现警告
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self.lock:
+                if not future.cancelled() and future.exception() is None and keep(future.result()):
+                    self.results[key] = future.result()
+                del self.async_calls[key]
+        return result
+
+    def prime(self, key, result):
+        """预先放入已知的结果（例如批量接口返回的作品信息），之后对该键的调用不再请求。"""
+        with self.lock:
+            self.results.setdefault(key, result)
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "saved": self.saved, "cached": len(self.results)}
+
+    def log_stats(self):
+        flight_stats = self.stats()
+        logger.info(f"请求合并: 实际请求 {flight_stats['requests']} 次，节省 {flight_stats['saved']} 次重复的元数据请求")
+
+
+# 全局 single-flight 层
+single_flight = SingleFlight()
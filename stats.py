@@ -0,0 +1,119 @@
+# stats.py
+# 下载统计：每个线程写自己的计数分片，读取时合并，避免多线程 += 丢失更新；
+# 默认只保存聚合计数，按文件的明细可选并有条数上限
+import threading
+
+from log_config import logger
+
+USER_GROUPS = ("success", "download_failed", "file_exists")
+SKIP_KINDS = ("file_exists", "download_failed")
+
+
+class ShardedCounter:
+    """
+    分片计数器：每个线程只写自己的字典，不需要加锁；读取时把所有分片相加。
+    线程结束后分片仍然保留，计数不会丢失。
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()  # 只保护分片列表
+
+    def _shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def add(self, key, n=1):
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + n  # 分片只有当前线程写入
+
+    def snapshot(self):
+        with self.lock:
+            shards = list(self.shards)
+        total = {}
+        for shard in shards:
+            for key, value in shard.copy().items():  # dict.copy() 在 GIL 下一次完成，不会与写入冲突
+                total[key] = total.get(key, 0) + value
+        return total
+
+
+class FileDetails:
+    """按文件路径的明细计数，最多保留 limit 条，超出部分只计入 dropped。"""
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.items = {}
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def add(self, path):
+        if self.limit <= 0:
+            return
+        path = str(path)
+        with self.lock:
+            if path in self.items:
+                self.items[path] += 1
+            elif len(self.items) < self.limit:
+                self.items[path] = 1
+            else:
+                self.dropped += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.items)
+
+
+class DownloadStats:
+    """
+    全局下载统计。
+
+    - count_user(group, user_id, field) 对应原来的 user_stats[group][user_id][field] += 1；
+    - skip(kind, path) 对应原来的 skipped_stats[kind][path] += 1 和 skipped_images_count += 1；
+    - user_stats() / skipped_stats() 返回与原来结构相同的字典，供 print_stats 使用。
+    """
+
+    def __init__(self, detail_limit=0):
+        self.counter = ShardedCounter()
+        self.details = {kind: FileDetails(detail_limit) for kind in SKIP_KINDS}
+
+    def configure(self, detail_limit):
+        """detail_limit 为每类按文件明细的最大条数，0 表示只保留聚合计数。"""
+        for details in self.details.values():
+            details.limit = detail_limit
+
+    def count_user(self, group, user_id, field, n=1):
+        self.counter.add((group, str(user_id), field), n)
+
+    def skip(self, kind, path):
+        self.counter.add(("skipped", kind), 1)
+        self.details[kind].add(path)
+
+    def user_stats(self):
+        result = {group: {} for group in USER_GROUPS}
+        for key, value in self.counter.snapshot().items():
+            if key[0] in result:
+                group, user_id, field = key
+                result[group].setdefault(user_id, {"artworks": 0, "images": 0})[field] += value
+        return result
+
+    def skipped_stats(self):
+        counts = self.counter.snapshot()
+        result = {kind: self.details[kind].snapshot() for kind in SKIP_KINDS}
+        for kind in SKIP_KINDS:
+            result[f"{kind}_count"] = counts.get(("skipped", kind), 0)
+            result[f"{kind}_dropped"] = self.details[kind].dropped
+        result["skipped_images_count"] = sum(result[f"{kind}_count"] for kind in SKIP_KINDS)
+        return result
+
+    def log_stats(self):
+        skipped = self.skipped_stats()
+        logger.info(f"已存在跳过 {skipped['file_exists_count']} 张，下载失败 {skipped['download_failed_count']} 张")
+
+
+# 全局下载统计
+stats = DownloadStats()
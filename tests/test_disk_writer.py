@@ -0,0 +1,85 @@
+# 写盘线程的 fsync 策略：多页作品在 none / file / artwork 下的 fsync 次数，以及 artwork 策略等作品的所有页结束后才一起提交
+import os
+
+import pytest
+
+PAGES = 3
+
+
+@pytest.fixture
+def writer():
+    """返回 writer(fsync, workers)：按给定策略重新配置全局写盘线程池，测试结束后恢复默认。"""
+    from disk_writer import disk_writer
+
+    def configure(fsync, workers=0):
+        disk_writer.configure(workers=workers, fsync=fsync)
+        disk_writer.reset_stats()
+        return disk_writer
+
+    yield configure
+    disk_writer.configure(workers=0, fsync="none")
+    disk_writer.reset_stats()
+
+
+def page_paths(tmp_path):
+    folder = tmp_path / "用户-1" / "作品-100001"
+    return [os.fspath(folder / f"作品-100001-{index}.jpg") for index in range(1, PAGES + 1)]
+
+
+def write_page(disk_writer, path, results):
+    job = disk_writer.open(path)
+    job.write(os.path.basename(path).encode())
+    job.finish(lambda error: results.append((path, error)))
+
+
+@pytest.mark.parametrize("fsync, expected", [("none", 0), ("file", PAGES), ("artwork", PAGES)])
+@pytest.mark.parametrize("workers", [0, 2])
+def test_fsync_count_for_multi_page_artwork(tmp_path, writer, fsync, expected, workers):
+    disk_writer = writer(fsync, workers)
+    paths = page_paths(tmp_path)
+    disk_writer.expect(paths)
+    results = []
+    for path in paths:
+        write_page(disk_writer, path, results)
+    disk_writer.flush()
+
+    assert disk_writer.stats()["fsyncs"] == expected
+    assert sorted(results) == [(path, None) for path in paths]
+    for path in paths:
+        with open(path, "rb") as f:
+            assert f.read() == os.path.basename(path).encode()
+        assert not os.path.exists(f"{path}.part")
+
+
+def test_artwork_batch_commits_when_last_page_finishes(tmp_path, writer):
+    disk_writer = writer("artwork")
+    paths = page_paths(tmp_path)
+    disk_writer.expect(paths)
+    results = []
+
+    for path in paths[:-1]:
+        write_page(disk_writer, path, results)
+    # 作品还有一页没写完：已完成的文件保持打开，既不 fsync 也不重命名，完成回调也不调用
+    assert disk_writer.stats()["fsyncs"] == 0
+    assert results == []
+    assert not any(os.path.exists(path) for path in paths)
+
+    write_page(disk_writer, paths[-1], results)
+    assert disk_writer.stats()["fsyncs"] == PAGES
+    assert [path for path, _ in results] == paths
+    assert all(os.path.exists(path) for path in paths)
+
+
+def test_artwork_batch_does_not_wait_for_settled_page(tmp_path, writer):
+    disk_writer = writer("artwork")
+    paths = page_paths(tmp_path)
+    disk_writer.expect(paths)
+    results = []
+
+    for path in paths[:-1]:
+        write_page(disk_writer, path, results)
+    disk_writer.settle(paths[-1])  # 最后一页放弃下载
+
+    assert disk_writer.stats()["fsyncs"] == PAGES - 1
+    assert [path for path, _ in results] == paths[:-1]
+    assert disk_writer.batches == {}
@@ -0,0 +1,17 @@
+from download import resume_offset
+
+
+def test_resume_offset_accepts_matching_range():
+    headers = {"Content-Range": "bytes 1000-4095/4096"}
+    assert resume_offset(206, headers, 1000) == 1000
+
+
+def test_resume_offset_restarts_when_range_ignored():
+    assert resume_offset(200, {"Content-Length": "4096"}, 1000) == 0
+
+
+def test_resume_offset_rejects_mismatched_range():
+    # 206 的数据不是从请求的位置开始，既不能追加也不能从文件开头写
+    assert resume_offset(206, {"Content-Range": "bytes 0-4095/4096"}, 1000) is None
+    assert resume_offset(206, {"Content-Range": "bytes 2000-4095/4096"}, 1000) is None
+    assert resume_offset(206, {}, 1000) is None
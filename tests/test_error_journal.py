@@ -0,0 +1,89 @@
+import json
+import threading
+
+from error_journal import ErrorJournal
+
+
+def read_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_compact_keeps_only_unresolved_records(tmp_path):
+    path = tmp_path / "error_journal.jsonl"
+    journal = ErrorJournal(flush_interval=0.01)
+    journal.open(str(path))
+    for index in range(3):
+        for page in range(1, 4):
+            journal.record_image(f"https://i.pximg.net/{index}_p{page}.jpg", f"a-{index}-{page}",
+                                 f"a-{index}-{page}.jpg", "用户", f"作品{index}", "超时")
+    journal.record_image_resolved("a-0-1.jpg")
+    journal.record_image_resolved("a-0-2.jpg")
+    journal.record_image("https://i.pximg.net/1_p1.jpg", "a-1-1", "a-1-1.jpg", "用户", "作品1", "500")  # 再次失败
+    journal.record_artwork(7, 1, "作品7", {"error": "404"})
+    journal.record_artwork(8, 1, "作品8", {"error": "500"})
+    journal.record_artwork_resolved(8)
+    journal.export(str(tmp_path / "error.json"), str(tmp_path / "error_artworks.json"))
+    before = journal.unresolved()
+    assert len(read_lines(path)) == 15
+
+    journal.compact()
+    records = read_lines(path)
+    assert len(records) == 8  # 7 张图片和 1 个作品
+    assert {record["type"] for record in records} == {"image", "artwork"}
+    assert journal.unresolved() == before
+    assert [record for record in before[0] if record["最终保存路径"] == "a-1-1.jpg"][0]["图片错误原因"] == "500"
+
+    # 压缩后重新打开，继续追加和解决
+    reopened = ErrorJournal(flush_interval=0.01)
+    reopened.open(str(path))
+    reopened.record_image_resolved("a-2-3.jpg")
+    reopened.close()
+    images, artworks = reopened.unresolved()
+    assert len(images) == 6
+    assert [record["artwork_id"] for record in artworks] == ["7"]
+
+
+def test_resolved_records_are_not_written_again_after_reopen(tmp_path):
+    path = tmp_path / "error_journal.jsonl"
+    journal = ErrorJournal(flush_interval=0.01)
+    journal.open(str(path))
+    journal.record_image("https://i.pximg.net/1_p0.jpg", "a-1-1", "a-1-1.jpg", "用户", "作品1", "超时")
+    journal.record_artwork(7, 1, "作品7", {"error": "404"})
+    journal.record_image_resolved("a-1-1.jpg")
+    journal.record_artwork_resolved(7)
+    journal.close()
+    assert len(read_lines(path)) == 4
+
+    for _ in range(2):
+        # 以后每次运行都成功：已经解决的项不再追加 resolved 记录
+        reopened = ErrorJournal(flush_interval=0.01)
+        reopened.open(str(path))
+        reopened.record_image_resolved("a-1-1.jpg")
+        reopened.record_artwork_resolved(7)
+        reopened.close()
+    assert len(read_lines(path)) == 4
+
+
+def test_concurrent_resolve_writes_one_record(tmp_path):
+    path = tmp_path / "error_journal.jsonl"
+    journal = ErrorJournal(flush_interval=0.01)
+    journal.open(str(path))
+    for index in range(200):
+        journal.record_image(f"https://i.pximg.net/{index}_p0.jpg", f"a-{index}-1", f"a-{index}-1.jpg", "用户",
+                             f"作品{index}", "超时")
+    barrier = threading.Barrier(8)
+
+    def resolve():
+        barrier.wait()
+        for index in range(200):
+            journal.record_image_resolved(f"a-{index}-1.jpg")
+
+    threads = [threading.Thread(target=resolve) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    journal.close()
+    resolved = [record for record in read_lines(path) if record["type"] == "image_resolved"]
+    assert len(resolved) == 200
@@ -0,0 +1,96 @@
+# 用 transport.FakeTransport 代替网络：作品信息请求、用户主页批量接口和原图的重试 / 续传
+import requests
+
+import pytest
+
+API = "https://www.pixiv.net"
+IMAGE_URL = "https://i.pximg.net/img-original/img/2024/01/01/00/00/00/1001_p0.jpg"
+IMAGE_BODY = bytes(range(256)) * 64
+
+
+def illust(user_id, user_name, title):
+    return {"error": False, "body": {"userId": user_id, "userName": user_name, "illustTitle": title}}
+
+
+@pytest.fixture
+def fake(tmp_path, monkeypatch):
+    """返回已经通过 transport.use() 启用的 FakeTransport，测试结束后换回 requests 后端。"""
+    from pdi_config import config
+    from retry_policy import retry_policy
+    from single_flight import single_flight
+    from transport import FakeTransport, transport
+    import main
+
+    monkeypatch.chdir(tmp_path)
+    config.store_config({"PHPSESSID": "x", "down_path": str(tmp_path), "api_base": API, "metrics_interval": 0,
+                         "manifest": False, "library_index": False, "disk_writers": 0, "profile_batch_size": 2,
+                         "rate_limits": {"api_rate": 0, "api_burst": 2, "image_rate": 0, "image_burst": 10}})
+    main.apply_config()
+    retry_policy.configure(max_attempts=3, base_delay=0.01, max_delay=0.05, failure_threshold=0)
+    monkeypatch.setattr(single_flight, "results", {})  # 作品信息不沿用其他测试的结果
+
+    fake = FakeTransport()
+    transport.use(fake)
+    yield fake
+    transport.configure("requests", 1)
+
+
+def test_fetch_artwork_info_retries_connection_error(fake):
+    from artwork_details import fetch_artwork_info
+    from pdi_config import config
+
+    url = f"{API}/ajax/illust/1001"
+    fake.add_error(url, requests.exceptions.ConnectionError("reset"))
+    fake.add(url, body=illust("7", "画师", "标题"))
+
+    assert fetch_artwork_info("1001", config.HEADERS, config.COOKIES) == ("7", "画师", "标题")
+    # 同一作品在一次运行中只请求一次
+    assert fetch_artwork_info("1001", config.HEADERS, config.COOKIES) == ("7", "画师", "标题")
+    assert [url for _, url, _ in fake.calls] == [url, url]
+
+
+def test_profile_batches_prime_artwork_info(fake):
+    from artwork_details import fetch_artwork_info
+    from pdi_config import config
+    from user_artworks import fetch_artwork_metadata, profile_illusts_urls
+
+    first, second = profile_illusts_urls("7", ["11", "12", "13"], 2)
+    fake.add(first, body={"error": False, "body": {"works": {
+        "11": {"userId": "7", "userName": "画师", "title": "一", "pageCount": 1},
+        "12": {"userId": "7", "userName": "画师", "title": "二", "pageCount": 2},
+    }}})
+    fake.add(second, status_code=500)  # 这一批失败，其中的作品改为逐个请求
+    fake.add(f"{API}/ajax/illust/13", body=illust("7", "画师", "三"))
+
+    fetch_artwork_metadata("7", ["11", "12", "13"], config.HEADERS, config.COOKIES)
+    batch_calls = len(fake.calls)
+    assert [url for _, url, _ in fake.calls] == [first] + [second] * (batch_calls - 1)
+
+    assert fetch_artwork_info("11", config.HEADERS, config.COOKIES) == ("7", "画师", "一")
+    assert fetch_artwork_info("12", config.HEADERS, config.COOKIES) == ("7", "画师", "二")
+    assert len(fake.calls) == batch_calls  # 批量接口返回的作品不再请求详情
+    assert fetch_artwork_info("13", config.HEADERS, config.COOKIES) == ("7", "画师", "三")
+    assert fake.calls[-1][1] == f"{API}/ajax/illust/13"
+
+
+def test_download_image_retries_and_resumes(fake, tmp_path):
+    from download import download_image
+    from pdi_config import config
+
+    half = len(IMAGE_BODY) // 2
+    fake.add_error(IMAGE_URL, requests.exceptions.ConnectionError("reset"))
+    # 连接在传输一半时断开：声明的长度是完整文件，.part 保留已收到的部分
+    fake.add(IMAGE_URL, body=IMAGE_BODY[:half],
+             headers={"Content-Length": str(len(IMAGE_BODY)), "ETag": '"v1"'})
+    fake.add(IMAGE_URL, status_code=206, body=IMAGE_BODY[half:],
+             headers={"Content-Range": f"bytes {half}-{len(IMAGE_BODY) - 1}/{len(IMAGE_BODY)}", "ETag": '"v1"'})
+
+    save_path = tmp_path / "画师-7" / "标题-1001" / "标题-1001-1"
+    download_image(IMAGE_URL, save_path, config.HEADERS, config.COOKIES, str(tmp_path / "error.json"))
+
+    with open(f"{save_path}.jpg", "rb") as f:
+        assert f.read() == IMAGE_BODY
+    assert len(fake.calls) == 3
+    assert "Range" not in fake.calls[1][2]
+    assert fake.calls[2][2]["Range"] == f"bytes={half}-"
+    assert fake.calls[2][2]["If-Range"] == '"v1"'
@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+from handle_429 import AdaptiveController
+
+URL = "https://i.pximg.net/img-original/img/1_p0.png"
+
+
+def make_controller(limit=2):
+    controller = AdaptiveController()
+    controller.configure({"api": limit, "image": limit}, {}, enabled=True)
+    return controller
+
+
+def test_async_acquire_queues_instead_of_polling():
+    controller = make_controller(limit=2)
+    running = []
+    peak = [0]
+
+    async def transfer():
+        await controller.async_acquire(URL)
+        running.append(1)
+        peak[0] = max(peak[0], len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+        controller.release(URL, 500)  # 不改变并发数
+
+    async def main():
+        await asyncio.gather(*(transfer() for _ in range(40)))
+
+    started = time.perf_counter()
+    asyncio.run(main())
+    assert peak[0] == 2
+    assert controller.stats()["image"]["in_flight"] == 0
+    # 每个名额依次传递 20 次，排队的协程不轮询，总时间接近 20 * 10 毫秒
+    assert time.perf_counter() - started < 1.0
+    assert not controller.async_waiters["image"]
+
+
+def test_async_acquire_waits_for_pause_window():
+    controller = make_controller()
+    controller.observe(URL, 429, "0.2")
+
+    async def main():
+        started = time.perf_counter()
+        await controller.async_acquire(URL)
+        return time.perf_counter() - started
+
+    assert asyncio.run(main()) >= 0.19
+    assert controller.stats()["image"]["in_flight"] == 1
+
+
+def test_cancelled_waiter_passes_wakeup_on():
+    controller = make_controller(limit=1)
+
+    async def main():
+        await controller.async_acquire(URL)
+        first = asyncio.create_task(controller.async_acquire(URL))
+        second = asyncio.create_task(controller.async_acquire(URL))
+        await asyncio.sleep(0)
+        controller.release(URL, 500)  # 唤醒 first
+        first.cancel()  # first 被取消前还没有运行，名额转给 second
+        await asyncio.wait_for(second, 1.0)
+
+    asyncio.run(main())
+    assert controller.stats()["image"]["in_flight"] == 1
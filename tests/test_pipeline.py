@@ -0,0 +1,30 @@
+# 公平队列：推迟的任务到时间前不占用取任务的线程
+import threading
+import time
+
+from pipeline import FairQueue, _STOP
+
+
+def test_deferred_item_waits_while_other_items_are_served():
+    q = FairQueue(maxsize=1)
+    q.put("a", 1)
+    key, item = q.get()
+    q.put_later(key, item, 0.1)  # 例如原图主机熔断：放回队列，稍后再取
+    q.task_done(key)
+    q.put("b", 2)  # 推迟的任务不占容量，不会阻塞
+
+    assert q.get() == ("b", 2)
+    started = time.monotonic()
+    assert q.get() == ("a", 1)
+    assert time.monotonic() - started >= 0.05
+
+
+def test_close_waits_for_deferred_items():
+    q = FairQueue()
+    q.put_later("a", 1, 0.05)
+    q.close()
+    results = []
+    worker = threading.Thread(target=lambda: results.extend([q.get(), q.get()]))
+    worker.start()
+    worker.join(timeout=2)
+    assert results == [("a", 1), (None, _STOP)]
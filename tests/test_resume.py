@@ -0,0 +1,85 @@
+# 用 benchmark 的模拟服务器驱动 download_image：在不同位置断开原图传输，续传后的文件必须与原图逐字节相同
+import os
+
+import pytest
+
+from benchmark.mock_server import MockServer, MockSettings, image_body
+
+CHUNK_SIZE = 64 * 1024
+IMAGE_SIZE = 200 * 1024  # 3 个完整的数据块加一个不完整的数据块
+ARTWORK_ID = "100001"
+
+
+@pytest.fixture
+def download(tmp_path, monkeypatch):
+    """返回 download(reset_offsets, range_skew=0)：从新的模拟服务器下载一张原图，返回 (文件内容, 服务器计数)。"""
+    from disk_writer import disk_writer
+    from download import download_image
+    from http_pool import add_image_host
+    from pdi_config import config
+    from retry_policy import retry_policy
+    import main
+
+    monkeypatch.chdir(tmp_path)
+    add_image_host("localhost")
+    servers = []
+
+    def run(reset_offsets, range_skew=0):
+        settings = MockSettings(users=1, artworks=1, pages=1, size_kb=IMAGE_SIZE // 1024, latency_ms=0,
+                                image_latency_ms=0, reset_offsets=reset_offsets, range_skew=range_skew)
+        server = MockServer(settings).start()
+        servers.append(server)
+        config.store_config({"PHPSESSID": "x", "down_path": str(tmp_path), "api_base": server.api_base,
+                             "chunk_size": CHUNK_SIZE, "metrics_interval": 0, "manifest": False,
+                             "library_index": False})
+        main.apply_config()
+        retry_policy.configure(max_attempts=len(reset_offsets) + 2, base_delay=0.01, max_delay=0.05,
+                               failure_threshold=0)
+
+        img_url = f"http://localhost:{server.image_port}/img-original/img/{ARTWORK_ID}_p0.jpg"
+        save_path = tmp_path / f"作品-{ARTWORK_ID}-1"
+        download_image(img_url, save_path, config.HEADERS, config.COOKIES, str(tmp_path / "error.json"))
+        disk_writer.flush()
+
+        save_path_with_ext = f"{save_path}.jpg"
+        assert not os.path.exists(f"{save_path_with_ext}.part")
+        with open(save_path_with_ext, "rb") as f:
+            return f.read(), dict(server.counts)
+
+    yield run
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def expected_body():
+    return image_body(ARTWORK_ID, 0, IMAGE_SIZE)
+
+
+@pytest.mark.parametrize("offset", [
+    0,  # 还没有收到任何数据
+    1000,  # 第一个数据块中间
+    CHUNK_SIZE,  # 数据块边界
+    2 * CHUNK_SIZE + 123,  # 后面的数据块中间
+    IMAGE_SIZE - 1,  # 只差最后一个字节
+])
+def test_resume_after_reset(download, offset):
+    body, counts = download([offset])
+    assert counts["reset"] == 1
+    assert body == expected_body()
+    if offset >= CHUNK_SIZE:
+        assert counts.get("image_resumed", 0) == 1
+
+
+def test_resume_after_repeated_resets(download):
+    # 每次续传都再次中断，最后一次请求完整结束
+    body, counts = download([1000, CHUNK_SIZE, 2 * CHUNK_SIZE + 123, IMAGE_SIZE - 1])
+    assert counts["reset"] == 4
+    assert body == expected_body()
+
+
+def test_misaligned_range_restarts_download(download):
+    # 续传响应的 Content-Range 起始位置与请求的不同：丢弃 .part，不带 Range 完整下载一次
+    body, counts = download([2 * CHUNK_SIZE + 123], range_skew=4096)
+    assert body == expected_body()
+    assert counts["image"] == 3
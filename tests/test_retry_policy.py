@@ -0,0 +1,115 @@
+import time
+
+import pytest
+
+from retry_policy import CircuitDeferred, CircuitOpenError, RetryPolicy
+
+URL = "https://i.pximg.net/img-original/img/1_p0.png"
+
+
+def open_breaker(policy, tickets):
+    # 连续失败到阈值，熔断器打开
+    for ticket in tickets:
+        policy.failed(URL, "image", 0, status=500, ticket=ticket)
+    return policy.breakers["i.pximg.net"]
+
+
+def make_policy():
+    return RetryPolicy(max_attempts=3, failure_threshold=2, cooldown=0.05, max_cooldown=1.0, min_retries=100)
+
+
+def test_stale_success_does_not_close_open_breaker():
+    policy = make_policy()
+    in_flight = policy.acquire(URL, "image")  # 熔断之前发出的请求
+    breaker = open_breaker(policy, [policy.acquire(URL, "image"), policy.acquire(URL, "image")])
+    assert breaker.state == "open"
+
+    policy.succeeded(URL, in_flight)
+    assert breaker.state == "open"
+    assert breaker.failures == 2
+
+
+def test_only_probe_success_closes_half_open_breaker():
+    policy = make_policy()
+    in_flight = policy.acquire(URL, "image")
+    breaker = open_breaker(policy, [policy.acquire(URL, "image"), policy.acquire(URL, "image")])
+    time.sleep(0.06)
+    probe = policy.acquire(URL, "image")
+    assert breaker.state == "half_open"
+
+    policy.succeeded(URL, in_flight)  # 熔断之前发出的请求在半开状态下才结束
+    policy.succeeded(URL)
+    assert breaker.state == "half_open"
+
+    policy.succeeded(URL, probe)
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+
+
+def test_stale_failure_does_not_reopen_half_open_breaker():
+    policy = make_policy()
+    in_flight = policy.acquire(URL, "image")
+    breaker = open_breaker(policy, [policy.acquire(URL, "image"), policy.acquire(URL, "image")])
+    time.sleep(0.06)
+    probe = policy.acquire(URL, "image")
+
+    policy.failed(URL, "image", 0, status=500, ticket=in_flight)
+    assert breaker.state == "half_open"
+    assert breaker.opens == 1
+
+    policy.failed(URL, "image", 0, status=500, ticket=probe)
+    assert breaker.state == "open"
+    assert breaker.cooldown == 0.1
+
+
+def test_client_error_does_not_reset_failures_while_open():
+    policy = make_policy()
+    in_flight = policy.acquire(URL, "image")
+    breaker = open_breaker(policy, [policy.acquire(URL, "image"), policy.acquire(URL, "image")])
+
+    policy.failed(URL, "image", 0, status=404, ticket=in_flight)
+    assert breaker.state == "open"
+    assert breaker.failures == 2
+
+
+def test_throttle_requeues_do_not_use_retry_budget():
+    policy = RetryPolicy(max_attempts=3, budget_ratio=0.2, min_retries=10, failure_threshold=0)
+    for index in range(20):
+        url = f"https://www.pixiv.net/ajax/illust/{index}"
+        for attempt in range(3):
+            ticket = policy.acquire(url, "metadata")
+            assert policy.failed(url, "metadata", attempt, status=429, ticket=ticket) == 0.0
+        policy.succeeded(url, policy.acquire(url, "metadata"))
+    assert policy.retries_total() == 0
+    assert policy.stats()["requeues"] == {"metadata": 60}
+
+    url = "https://www.pixiv.net/ajax/illust/20"
+    ticket = policy.acquire(url, "metadata")
+    assert policy.failed(url, "metadata", 0, status=502, ticket=ticket) is not None
+    assert policy.budget_exhausted == 0
+
+
+def test_range_requeue_does_not_use_retry_budget():
+    policy = RetryPolicy(min_retries=0, budget_ratio=0.0, failure_threshold=0)
+    ticket = policy.acquire(URL, "image")
+    assert policy.failed(URL, "image", 0, status=416, ticket=ticket) == 0.0
+    assert policy.retries_total() == 0
+
+
+def test_acquire_defers_instead_of_blocking_while_open():
+    policy = make_policy()
+    breaker = open_breaker(policy, [policy.acquire(URL, "image"), policy.acquire(URL, "image")])
+
+    started = time.monotonic()
+    with pytest.raises(CircuitDeferred) as deferred:
+        policy.acquire(URL, "image")
+    assert time.monotonic() - started < 0.05
+    assert 0 < deferred.value.delay <= 0.05
+    assert breaker.short_circuits == 1
+
+    # 推迟超过上限（max_cooldown + cooldown）后按失败处理
+    with pytest.raises(CircuitOpenError):
+        policy.acquire(URL, "image", deferred_since=time.monotonic() - 2)
+
+    time.sleep(0.06)
+    assert policy.acquire(URL, "image", deferred_since=started) == breaker.probe_ticket
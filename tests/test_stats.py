@@ -0,0 +1,70 @@
+import threading
+
+from stats import DownloadStats, ShardedCounter
+
+THREADS = 32
+ROUNDS = 5000
+
+
+def hammer(target):
+    # 所有线程同时开始，尽量让写入交错
+    barrier = threading.Barrier(THREADS)
+
+    def worker(index):
+        barrier.wait()
+        for round_index in range(ROUNDS):
+            target(index, round_index)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_sharded_counter_exact_totals():
+    counter = ShardedCounter()
+    snapshots = []
+
+    def add(index, round_index):
+        counter.add("shared")
+        counter.add(index % 4, 2)
+        if round_index % 1000 == 0:
+            snapshots.append(counter.snapshot().get("shared", 0))  # 并发读取不影响写入
+
+    hammer(add)
+    total = counter.snapshot()
+    assert total["shared"] == THREADS * ROUNDS
+    assert all(total[key] == THREADS // 4 * ROUNDS * 2 for key in range(4))
+    assert all(value <= THREADS * ROUNDS for value in snapshots)
+    assert len(counter.shards) == THREADS  # 线程结束后分片仍然保留
+
+
+def test_download_stats_exact_totals():
+    stats = DownloadStats(detail_limit=100)
+
+    def record(index, round_index):
+        user_id = index % 3
+        stats.count_user("success", user_id, "images")
+        if round_index % 10 == 0:
+            stats.count_user("success", user_id, "artworks")
+            stats.count_user("download_failed", user_id, "images")
+        stats.skip("file_exists", f"{index}-{round_index}.jpg")
+        if round_index % 5 == 0:
+            stats.skip("download_failed", f"{index}.jpg")
+
+    hammer(record)
+    user_stats = stats.user_stats()
+    threads_per_user = {user_id: sum(1 for index in range(THREADS) if index % 3 == user_id) for user_id in range(3)}
+    for user_id, threads in threads_per_user.items():
+        assert user_stats["success"][str(user_id)] == {"artworks": threads * ROUNDS // 10, "images": threads * ROUNDS}
+        assert user_stats["download_failed"][str(user_id)] == {"artworks": 0, "images": threads * ROUNDS // 10}
+
+    skipped = stats.skipped_stats()
+    assert skipped["file_exists_count"] == THREADS * ROUNDS
+    assert skipped["download_failed_count"] == THREADS * ROUNDS // 5
+    assert skipped["skipped_images_count"] == THREADS * ROUNDS + THREADS * ROUNDS // 5
+    # 明细有条数上限：保留的条目和超出上限的次数加起来等于总次数
+    assert len(skipped["file_exists"]) == 100
+    assert sum(skipped["file_exists"].values()) + skipped["file_exists_dropped"] == THREADS * ROUNDS
+    assert skipped["download_failed"] == {f"{index}.jpg": ROUNDS // 5 for index in range(THREADS)}
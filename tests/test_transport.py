@@ -0,0 +1,72 @@
+import sys
+import types
+
+import pytest
+
+from transport import TransportSwitch, RequestsTransport
+
+
+def test_http2_falls_back_without_h2(monkeypatch):
+    # 只安装了 httpx 而没有 h2 时，配置阶段就回退到 requests，而不是每次请求原图时出错
+    monkeypatch.setitem(sys.modules, "httpx", types.ModuleType("httpx"))
+    monkeypatch.setitem(sys.modules, "h2", None)
+    switch = TransportSwitch()
+    switch.configure("http2", 4)
+    assert isinstance(switch.backend, RequestsTransport)
+    switch.close()
+
+
+def test_http2_falls_back_without_httpx(monkeypatch):
+    monkeypatch.setitem(sys.modules, "httpx", None)
+    switch = TransportSwitch()
+    switch.configure("http2", 4)
+    assert switch.name == "requests"
+    switch.close()
+
+
+class RecordingClient:
+    # 代替 httpx.Client，记录 build_request / send 收到的参数
+    def __init__(self):
+        self.built = None
+        self.sent = None
+
+    def build_request(self, method, url, **kwargs):
+        self.built = (method, url, kwargs)
+        return self.built
+
+    def send(self, request, **kwargs):
+        self.sent = kwargs
+        return types.SimpleNamespace(status_code=200, headers={}, url=request[1], http_version="HTTP/2")
+
+
+def http2_transport(monkeypatch):
+    from transport import Http2Transport
+
+    monkeypatch.setitem(sys.modules, "httpx", types.ModuleType("httpx"))
+    monkeypatch.setitem(sys.modules, "h2", types.ModuleType("h2"))
+    backend = Http2Transport()
+    client = RecordingClient()
+    backend.clients["i.pximg.net"] = client
+    backend.counts["i.pximg.net"] = {"requests": 0, "connections_created": 0, "http2": 0}
+    return backend, client
+
+
+def test_http2_forwards_supported_arguments(monkeypatch):
+    backend, client = http2_transport(monkeypatch)
+    backend.request("GET", "https://i.pximg.net/img-original/img/1_p0.png", params={"a": "1"}, data=b"x",
+                    allow_redirects=False, stream=True)
+    _, _, built = client.built
+    assert built["params"] == {"a": "1"}
+    assert built["content"] == b"x"
+    assert client.sent == {"stream": True, "follow_redirects": False}
+
+    backend.request("GET", "https://i.pximg.net/img-original/img/1_p0.png", data={"k": "v"}, stream=True)
+    assert client.built[2]["data"] == {"k": "v"}
+    assert client.sent["follow_redirects"] is True
+
+
+def test_http2_rejects_unsupported_arguments(monkeypatch):
+    backend, client = http2_transport(monkeypatch)
+    with pytest.raises(TypeError, match="proxies"):
+        backend.request("GET", "https://i.pximg.net/img-original/img/1_p0.png", proxies={}, stream=True)
+    assert client.built is None
@@ -0,0 +1,149 @@
+# tracing.py
+# 按请求的阶段追踪：记录限速等待、建立连接/TLS、首字节、传输和写盘的耗时，导出为 Chrome / Perfetto trace JSON
+import contextlib
+import json
+import os
+import random
+import threading
+import time
+
+from log_config import logger
+
+
+class _NullSpan:
+    # 未开启追踪或请求未被采样时使用，进入和退出都不做任何事
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, tracer, name, args, root=False):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.root = root
+        self.start = None
+        self.previous = None
+
+    def __enter__(self):
+        local = self.tracer.local
+        if self.root:
+            # 根 span：决定本次请求是否采样，并把标签传给内部的阶段 span
+            self.previous = getattr(local, "tags", None)
+            local.tags = self.args
+        self.start = time.perf_counter()
+        return self
+
+    def set(self, **args):
+        """补充标签，例如请求完成后的状态码。"""
+        self.args.update(args)
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        args = self.args
+        if exc_type is not None:
+            args = {**args, "error": exc_type.__name__}
+        self.tracer.add_span(self.name, self.start, end, **args)
+        if self.root:
+            self.tracer.local.tags = self.previous
+        return False
+
+
+class Tracer:
+    """
+    可选的请求追踪，默认关闭。
+
+    - request(name, **tags) 开始一次被追踪的请求（如 download_image），按 sample_rate 采样；
+    - span(name) 记录请求内部的阶段，只有当前线程的请求被采样时才记录，并自动带上请求的标签；
+    - write(path) 输出 Chrome trace 格式（chrome://tracing 或 ui.perfetto.dev 可以直接打开）。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 1.0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.events = []
+        self.threads = {}  # tid -> 线程名
+        self.origin = time.perf_counter()
+        self.random = random.Random()
+
+    def configure(self, enabled, sample_rate=1.0):
+        self.enabled = enabled
+        self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+
+    @property
+    def active(self):
+        """当前线程是否处在一个被采样的请求中。"""
+        return self.enabled and getattr(self.local, "tags", None) is not None
+
+    def request(self, name, **tags):
+        if not self.enabled or self.active or self.random.random() >= self.sample_rate:
+            # 已在被采样的请求中时（例如 single-flight 内部）作为普通 span 记录
+            return self.span(name, **tags)
+        return _Span(self, name, tags, root=True)
+
+    def span(self, name, **args):
+        if not self.active:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def context(self):
+        """当前线程被采样请求的标签，交给其他线程（如写盘线程）用 attach 继续记录；未采样时为 None。"""
+        return self.local.tags if self.active else None
+
+    @contextlib.contextmanager
+    def attach(self, tags):
+        """在当前线程中临时进入另一个线程的请求，之后的 span 带上该请求的标签。"""
+        if tags is None:
+            yield
+            return
+        previous = getattr(self.local, "tags", None)
+        self.local.tags = tags
+        try:
+            yield
+        finally:
+            self.local.tags = previous
+
+    def add_span(self, name, start, end, **args):
+        """记录一个已知起止时间（perf_counter 秒）的 span，例如由 response.elapsed 推算的首字节时间。"""
+        if not self.active:
+            return
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": round((start - self.origin) * 1e6, 1),
+            "dur": round((end - start) * 1e6, 1),
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": {**self.local.tags, **args},
+        }
+        with self.lock:
+            self.events.append(event)
+            self.threads.setdefault(thread.ident, thread.name)
+
+    def write(self, path):
+        if not self.enabled:
+            return
+        with self.lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                    for tid, name in threads.items()]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        logger.info(f"已写入追踪文件 {path}（{len(events)} 个 span），可在 chrome://tracing 或 ui.perfetto.dev 打开")
+
+
+# 全局追踪器
+tracer = Tracer()
@@ -0,0 +1,409 @@
+# transport.py
+# HTTP 传输层：所有请求（ajax 和原图）都通过 transport.request() 发出，后端可以切换：
+#   requests —— 默认，基于 http_pool 的 urllib3 长连接池（HTTP/1.1）
+#   http2    —— 原图主机使用 httpx 的 HTTP/2 多路复用（需要 pip install "httpx[http2]"），其他主机仍用 requests
+#   FakeTransport —— 内存中的假后端，按 URL 返回预设的响应，用于测试
+import datetime
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from http_pool import pool, IMAGE_HOSTS
+from log_config import logger
+from tracing import tracer
+
+
+class Transport:
+    """
+    传输后端接口。request() 的参数与 requests.Session.request 相同，返回的响应对象至少提供
+    status_code、ok、url、headers、elapsed、content、json()、iter_content()、raise_for_status() 和 close()，
+    出错时抛出 requests.exceptions 中的异常，调用方不需要关心具体后端。
+    """
+
+    name = "base"
+
+    def configure(self, pool_size):
+        pass
+
+    def request(self, method, url, **kwargs):
+        raise NotImplementedError
+
+    def stats(self):
+        """返回每个主机的连接统计 {host: {...}}。"""
+        return {}
+
+    def log_stats(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class RequestsTransport(Transport):
+    """默认后端：每个主机一个共享的 requests.Session（见 http_pool）。"""
+
+    name = "requests"
+
+    def configure(self, pool_size):
+        pool.configure(pool_size)
+
+    def request(self, method, url, **kwargs):
+        return pool.get_session(url).request(method, url, **kwargs)
+
+    def stats(self):
+        return pool.stats()
+
+    def log_stats(self):
+        pool.log_stats()
+
+    def close(self):
+        pool.close()
+
+
+class _HttpxResponse:
+    # 把 httpx.Response 包装成调用方使用的 requests 风格接口
+    def __init__(self, response, elapsed):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers  # httpx.Headers 的 get() 不区分大小写
+        self.url = str(response.url)
+        self.elapsed = datetime.timedelta(seconds=elapsed)
+        self.http_version = response.http_version
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def content(self):
+        import httpx
+
+        try:
+            return self._response.read()
+        except httpx.HTTPError as e:
+            raise _convert_error(e) from e
+
+    @property
+    def text(self):
+        return self.content.decode(self._response.encoding or "utf-8", errors="replace")
+
+    def json(self, **kwargs):
+        return json.loads(self.content, **kwargs)
+
+    def iter_content(self, chunk_size=None):
+        import httpx
+
+        try:
+            yield from self._response.iter_bytes(chunk_size)
+        except httpx.HTTPError as e:
+            raise _convert_error(e) from e
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            kind = "Client" if self.status_code < 500 else "Server"
+            raise requests.exceptions.HTTPError(
+                f"{self.status_code} {kind} Error: {self._response.reason_phrase} for url: {self.url}", response=self)
+
+    def close(self):
+        self._response.close()
+
+
+def _convert_error(error):
+    # 转换为 requests 的异常类型，调用方的 except requests.exceptions.RequestException 照常生效
+    import httpx
+
+    if isinstance(error, httpx.TimeoutException):
+        return requests.exceptions.Timeout(str(error))
+    if isinstance(error, (httpx.RemoteProtocolError, httpx.ReadError)):
+        return requests.exceptions.ChunkedEncodingError(str(error))
+    return requests.exceptions.ConnectionError(str(error))
+
+
+class Http2Transport(Transport):
+    """
+    HTTP/2 后端：原图主机的所有并发传输复用少量连接（多路复用），ajax 等其他主机交给 fallback 后端.
+
+    https 地址通过 ALPN 协商 HTTP/2；明文 http 地址（本地模拟服务器）使用 h2c prior knowledge.
+    """
+
+    name = "http2"
+
+    def __init__(self, fallback=None):
+        # 未安装时抛出 ImportError，由 transport.configure 回退；只装了 httpx 而没有 h2 时，
+        # httpx.HTTPTransport(http2=True) 要到第一次请求原图时才报错，所以两个都在这里检查
+        import httpx  # noqa: F401
+        import h2  # noqa: F401
+
+        self.fallback = fallback or RequestsTransport()
+        self.pool_size = 6
+        self.clients = {}  # host -> httpx.Client
+        self.counts = {}  # host -> {"requests", "connections_created", "http2"}
+        self.lock = threading.Lock()
+
+    def configure(self, pool_size):
+        self.fallback.configure(pool_size)
+        with self.lock:
+            self.pool_size = max(int(pool_size), 1)
+            self._close_locked()
+
+    def _client(self, url):
+        import httpx
+
+        parts = urlsplit(url)
+        host = parts.hostname
+        client = self.clients.get(host)
+        if client is not None:
+            return host, client
+        with self.lock:
+            client = self.clients.get(host)
+            if client is None:
+                # 多路复用下连接数只是上限，实际通常只有一两个连接
+                limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+                client = httpx.Client(transport=httpx.HTTPTransport(
+                    http1=parts.scheme == "https", http2=True, limits=limits, retries=0))
+                self.clients[host] = client
+                self.counts[host] = {"requests": 0, "connections_created": 0, "http2": 0}
+                logger.debug(f"为主机 {host} 创建 HTTP/2 客户端，最多 {self.pool_size} 个连接")
+        return host, client
+
+    def _trace(self, host):
+        # httpcore 的 trace 扩展：统计新建连接，并在被追踪的请求中记录建立连接 / TLS 的耗时
+        started = {}
+
+        def callback(event_name, info):
+            name, _, phase = event_name.rpartition(".")
+            if phase == "started":
+                started[name] = time.perf_counter()
+            elif phase == "complete":
+                if name == "connection.connect_tcp":
+                    with self.lock:
+                        self.counts[host]["connections_created"] += 1
+                if name in ("connection.connect_tcp", "connection.start_tls") and name in started:
+                    tracer.add_span("connect" if name.endswith("tcp") else "tls", started[name], time.perf_counter(),
+                                    host=host)
+
+        return callback
+
+    def request(self, method, url, headers=None, cookies=None, timeout=None, stream=False, params=None, data=None,
+                json=None, allow_redirects=True, **kwargs):
+        import httpx
+
+        if host_of(url) not in IMAGE_HOSTS:
+            return self.fallback.request(method, url, headers=headers, cookies=cookies, timeout=timeout,
+                                         stream=stream, params=params, data=data, json=json,
+                                         allow_redirects=allow_redirects, **kwargs)
+        if kwargs:
+            # 其余 requests 参数（files、auth、proxies 等）httpx 后端没有对应实现，不能悄悄忽略
+            raise TypeError(f"HTTP/2 传输后端不支持参数：{', '.join(sorted(kwargs))}")
+
+        host, client = self._client(url)
+        headers = dict(headers or {})
+        headers.pop("Connection", None)  # HTTP/2 不允许逐跳头
+        if cookies:
+            headers["Cookie"] = "; ".join(f"{key}={value}" for key, value in cookies.items())
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+
+        body = {"content": data} if isinstance(data, (bytes, str)) else {"data": data}  # requests 的 data 两种都接受
+        request = client.build_request(method, url, headers=headers, params=params, json=json, timeout=timeout,
+                                       extensions={"trace": self._trace(host)}, **body)
+        started = time.perf_counter()
+        try:
+            # 重试由调用方按 retry_policy 处理；与 requests 一样默认跟随重定向
+            response = client.send(request, stream=True, follow_redirects=allow_redirects)
+        except httpx.HTTPError as e:
+            raise _convert_error(e) from e
+
+        wrapped = _HttpxResponse(response, time.perf_counter() - started)
+        with self.lock:
+            self.counts[host]["requests"] += 1
+            self.counts[host]["http2"] += response.http_version == "HTTP/2"
+        if not stream:
+            wrapped.content  # 非流式请求读完响应体后返回，与 requests 一致
+        return wrapped
+
+    def stats(self):
+        result = self.fallback.stats()
+        with self.lock:
+            for host, counts in self.counts.items():
+                host_stats = dict(counts)
+                host_stats["reuse_ratio"] = round(
+                    1 - counts["connections_created"] / counts["requests"], 4) if counts["requests"] else 0.0
+                result[host] = host_stats
+        return result
+
+    def log_stats(self):
+        self.fallback.log_stats()
+        with self.lock:
+            counts = {host: dict(host_counts) for host, host_counts in self.counts.items()}
+        for host, host_counts in counts.items():
+            logger.info(f"HTTP/2 {host}: 请求 {host_counts['requests']} 次（其中 HTTP/2 {host_counts['http2']} 次），"
+                        f"新建连接 {host_counts['connections_created']} 个")
+
+    def close(self):
+        self.fallback.close()
+        with self.lock:
+            self._close_locked()
+
+    def _close_locked(self):
+        for client in self.clients.values():
+            client.close()
+        self.clients.clear()
+
+
+class FakeResponse:
+    """FakeTransport 返回的响应，接口与 requests.Response 的常用部分一致。"""
+
+    def __init__(self, status_code=200, body=b"", headers=None, url=""):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode() if not isinstance(body, str) else body.encode()
+        self.status_code = status_code
+        self.content = body
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.headers.setdefault("Content-Length", str(len(body)))
+        self.url = url
+        self.elapsed = datetime.timedelta(0)
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self, **kwargs):
+        return json.loads(self.content, **kwargs)
+
+    def iter_content(self, chunk_size=None):
+        chunk_size = chunk_size or len(self.content) or 1
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+    def close(self):
+        pass
+
+
+class FakeTransport(Transport):
+    """
+    内存中的假后端：用 add() 按 URL（不含查询参数时也匹配带参数的请求）登记响应，或用 add_handler() 登记函数.
+    所有请求记录在 calls 中，未登记的 URL 返回 404.
+
+    用法:
+        fake = FakeTransport()
+        fake.add("https://www.pixiv.net/ajax/illust/1", body={"error": False, "body": {...}})
+        transport.use(fake)
+    """
+
+    name = "fake"
+
+    def __init__(self):
+        self.routes = {}  # url -> [FakeResponse 或 Exception, ...]，按顺序返回，最后一个重复使用
+        self.handlers = []
+        self.calls = []  # [(method, url, headers)]
+        self.lock = threading.Lock()
+
+    def add(self, url, status_code=200, body=b"", headers=None):
+        """登记 url 的响应；body 为 dict/list 时按 JSON 编码。同一 url 多次登记时依次返回。"""
+        with self.lock:
+            self.routes.setdefault(url, []).append(FakeResponse(status_code, body, headers, url))
+
+    def add_error(self, url, error):
+        """登记 url 的请求抛出 error（例如 requests.exceptions.ConnectionError()）。"""
+        with self.lock:
+            self.routes.setdefault(url, []).append(error)
+
+    def add_handler(self, handler):
+        """登记函数 handler(method, url, headers)，返回 FakeResponse 或 None（交给下一个匹配方式）。"""
+        self.handlers.append(handler)
+
+    def request(self, method, url, headers=None, **kwargs):
+        with self.lock:
+            self.calls.append((method, url, dict(headers or {})))
+            queue = self.routes.get(url) or self.routes.get(url.split("?")[0])
+            result = (queue.pop(0) if len(queue) > 1 else queue[0]) if queue else None
+        if result is None:
+            for handler in self.handlers:
+                result = handler(method, url, headers or {})
+                if result is not None:
+                    break
+        if result is None:
+            result = FakeResponse(404, b"{}", url=url)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    def stats(self):
+        with self.lock:
+            hosts = {}
+            for _, url, _ in self.calls:
+                host_stats = hosts.setdefault(host_of(url), {"requests": 0})
+                host_stats["requests"] += 1
+        return hosts
+
+
+def host_of(url):
+    return urlsplit(url).hostname
+
+
+class TransportSwitch:
+    """
+    当前使用的传输后端。调用方只使用 transport.request()，由 configure() 或 use() 决定实际的后端。
+    """
+
+    def __init__(self):
+        self.backend = RequestsTransport()
+
+    def configure(self, name, pool_size):
+        """
+        按配置选择后端.
+
+        参数:
+            name (str): requests 或 http2；http2 所需的 httpx 或 h2 未安装时回退到 requests.
+            pool_size (int): 每个主机的连接池大小.
+        """
+        if name == "http2":
+            try:
+                backend = Http2Transport()
+            except ImportError as e:
+                logger.error(f'transport = http2 需要安装 httpx 和 h2（pip install "httpx[http2]"）：{e}，将使用 requests。')
+                backend = RequestsTransport()
+        else:
+            backend = RequestsTransport()
+        self.use(backend)
+        backend.configure(pool_size)
+
+    def use(self, backend):
+        """直接替换后端，例如在测试中使用 FakeTransport。"""
+        if backend is not self.backend:
+            self.backend.close()
+            self.backend = backend
+        logger.debug(f"HTTP 传输后端：{backend.name}")
+
+    @property
+    def name(self):
+        return self.backend.name
+
+    def request(self, method, url, **kwargs):
+        return self.backend.request(method, url, **kwargs)
+
+    def stats(self):
+        return self.backend.stats()
+
+    def log_stats(self):
+        self.backend.log_stats()
+
+    def close(self):
+        self.backend.close()
+
+
+# 全局传输层
+transport = TransportSwitch()
@@ -1,8 +1,17 @@
 import rate_limited_requests as requests
 from log_config import logger
+from manifest import manifest
+from pdi_config import config
+from single_flight import single_flight
+from tracing import tracer
 
 
 def fetch_user_artworks(user_id, headers, cookies):
+    with tracer.request("fetch_user_artworks", user_id=str(user_id)):
+        return _fetch_user_artworks(user_id, headers, cookies)
+
+
+def _fetch_user_artworks(user_id, headers, cookies):
     logger.debug("fetch_user_artworks函数被调用")
     logger.debug(f"传入信息: user_id={user_id}, headers={headers}, cookies={cookies}")
     """
@@ -17,7 +26,7 @@ def fetch_user_artworks(user_id, headers, cookies):
     返回:
         list: 用户的作品 ID 列表。如果没有作品，则返回空列表。
     """
-    url = f"https://www.pixiv.net/ajax/user/{user_id}/profile/all"
+    url = f"{config.api_base}/ajax/user/{user_id}/profile/all"
     # 使用 logger 记录正在请求的日志
     logger.info(f"正在请求用户 {user_id} 的作品信息...")
 
@@ -31,29 +40,102 @@ def fetch_user_artworks(user_id, headers, cookies):
         logger.info(f"完整url:{url}")
         logger.debug(f"返回的数据: {data}")  # 打印完整的返回数据用于调试
 
-        if data.get("error") is False:  # 如果请求没有错误
-            illusts = data["body"].get("illusts", {})
+        return parse_user_artworks(user_id, data)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"请求错误: {e}")
+        return []  # 请求失败时返回空列表
 
-            # 如果作品是字典格式
-            if isinstance(illusts, dict):
-                # 直接返回字典的所有键（作品 ID）
-                illust_ids = list(illusts.keys())  # 获取作品 ID 列表
 
-                if illust_ids:
-                    logger.info(f"成功获取 {user_id} 的 {len(illust_ids)} 个作品 ID。")
-                else:
-                    logger.warning(f"用户 {user_id} 没有作品。")
+def parse_user_artworks(user_id, data):
+    """
+    解析 /ajax/user/{id}/profile/all 的响应数据，线程版与异步版共用.
 
-                return illust_ids  # 返回作品 ID 列表
+    返回:
+        list: 用户的作品 ID 列表。
+    """
+    if data.get("error") is False:  # 如果请求没有错误
+        illusts = data["body"].get("illusts", {})
 
+        # 如果作品是字典格式
+        if isinstance(illusts, dict):
+            # 直接返回字典的所有键（作品 ID）
+            illust_ids = list(illusts.keys())  # 获取作品 ID 列表
+
+            if illust_ids:
+                logger.info(f"成功获取 {user_id} 的 {len(illust_ids)} 个作品 ID。")
             else:
-                logger.warning(f"警告：作品数据结构不符合预期，无法解析作品 ID。")
-                return []  # 返回空列表
+                logger.warning(f"用户 {user_id} 没有作品。")
+
+            return illust_ids  # 返回作品 ID 列表
 
         else:
-            logger.error(f"错误：未能正确获取用户 {user_id} 的作品信息。")
-            return []  # 如果请求发生错误，返回空列表
+            logger.warning(f"警告：作品数据结构不符合预期，无法解析作品 ID。")
+            return []  # 返回空列表
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"请求错误: {e}")
-        return []  # 请求失败时返回空列表
+    else:
+        logger.error(f"错误：未能正确获取用户 {user_id} 的作品信息。")
+        return []  # 如果请求发生错误，返回空列表
+
+
+def profile_illusts_urls(user_id, artwork_ids, batch_size):
+    """按 batch_size 个作品一组，生成 /ajax/user/{id}/profile/illusts 批量接口的 URL."""
+    if batch_size <= 0:
+        return []
+    ids = [str(artwork_id) for artwork_id in artwork_ids]
+    return [f"{config.api_base}/ajax/user/{user_id}/profile/illusts?"
+            + "&".join(f"ids[]={artwork_id}" for artwork_id in ids[start:start + batch_size])
+            + "&work_category=illustManga&is_first_page=0"
+            for start in range(0, len(ids), batch_size)]
+
+
+def parse_profile_illusts(user_id, data):
+    """
+    解析 /ajax/user/{id}/profile/illusts 的响应数据，线程版与异步版共用.
+
+    返回:
+        dict: {作品 ID: 作品信息}，作品信息包含 title、userId、userName、pageCount.
+    """
+    if data.get("error") is not False:
+        logger.warning(f"批量获取用户 {user_id} 的作品信息失败，错误信息：{data.get('message', '无详细错误信息')}")
+        return {}
+    works = data["body"].get("works", {})
+    return {str(artwork_id): work for artwork_id, work in works.items()
+            if work.get("userId") and work.get("userName") and work.get("title")}
+
+
+def prime_artwork_metadata(user_id, works, total):
+    """
+    把批量接口返回的作品信息放入 single_flight，之后 fetch_artwork_info 不再逐个请求.
+
+    批量接口不返回原图的扩展名，图片 URL 无法可靠地推算；总页数与下载清单记录一致的作品沿用清单中的 URL，
+    其余作品仍然请求分页接口.
+    """
+    known_urls = manifest.image_urls(list(works))
+    reused = 0
+    for artwork_id, work in works.items():
+        single_flight.prime(("info", artwork_id), (work["userId"], work["userName"], work["title"]))
+        page_count, urls = known_urls.get(artwork_id, (None, None))
+        if urls and page_count == work.get("pageCount"):
+            single_flight.prime(("pages", artwork_id), urls)
+            reused += 1
+    logger.info(f"批量获取用户 {user_id} 的作品信息：{len(works)}/{total} 个作品，"
+                f"{reused} 个沿用清单中的图片 URL，其余作品请求分页接口")
+
+
+def fetch_artwork_metadata(user_id, artwork_ids, headers, cookies):
+    """
+    用用户主页的批量接口一次获取多个作品的标题、用户名和页数，失败的批次回退到逐个请求.
+    """
+    urls = profile_illusts_urls(user_id, artwork_ids, config.profile_batch_size)
+    if not urls:
+        return
+    works = {}
+    with tracer.request("fetch_artwork_metadata", user_id=str(user_id), artworks=len(artwork_ids)):
+        for url in urls:
+            try:
+                response = requests.get(url, headers=headers, cookies=cookies)
+                response.raise_for_status()
+                works.update(parse_profile_illusts(user_id, response.json()))
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.warning(f"批量获取用户 {user_id} 的作品信息失败，这一批作品改为逐个请求：{e}")
+    prime_artwork_metadata(user_id, works, len(artwork_ids))
@@ -0,0 +1,227 @@
+# verify.py
+# 下载目录的完整性检查：用进程池并行扫描已下载的图片，内存映射文件后检查结构（JPEG EOI、PNG 数据块和 CRC、GIF 结尾），
+# 并与清单记录的大小比较；损坏的页改名为 .corrupt，并交给下一次下载重新获取
+import argparse
+import itertools
+import mmap
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from error_journal import error_journal
+from log_config import logger
+from manifest import manifest, parse_image_name
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
+BATCH_SIZE = 256  # 每个进程任务检查的文件数，减少进程间通信次数
+TAIL_BYTES = 4096  # JPEG / GIF 只在文件末尾这么多字节中查找结束标记
+PROGRESS_INTERVAL = 10.0
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def check_image(path, expected_size=None, crc=True):
+    """
+    检查一张图片是否完整.
+
+    参数:
+        path (str): 图片路径.
+        expected_size (int): 已知的完整大小（清单中记录的下载字节数，即响应的 Content-Length），未知时为 None.
+        crc (bool): 是否校验 PNG 每个数据块的 CRC（需要读完整个文件）；关闭时只读取块头.
+
+    返回:
+        tuple: (文件大小, 损坏原因)，完整时原因为 None.
+    """
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if expected_size and size != expected_size:
+                return size, f"大小与清单不符（{size} / {expected_size} 字节）"
+            if size < 8:
+                return size, "文件过小"
+            # 只映射不复制：结构检查只会读到文件头、文件尾和 PNG 的块头
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return size, _check_structure(mm, size, crc)
+    except OSError as e:
+        return 0, f"无法读取：{e}"
+
+
+def _check_structure(mm, size, crc):
+    # 按文件头判断格式，扩展名不可靠（例如保存下来的错误页面）
+    if mm[:2] == b"\xff\xd8":
+        tail = mm[max(size - TAIL_BYTES, 2):].rstrip(b"\x00")
+        # 结尾可能带有相机等写入的附加数据，末尾附近出现 EOI 即可
+        return None if tail.endswith(b"\xff\xd9") or b"\xff\xd9" in tail else "JPEG 缺少结束标记（EOI）"
+    if mm[:8] == PNG_SIGNATURE:
+        return _check_png(mm, size, crc)
+    if mm[:6] in (b"GIF87a", b"GIF89a"):
+        return None if mm[max(size - TAIL_BYTES, 6):].rstrip(b"\x00").endswith(b";") else "GIF 缺少结束标记"
+    return "无法识别的图片格式"
+
+
+def _check_png(mm, size, crc):
+    position = len(PNG_SIGNATURE)
+    with memoryview(mm) as view:
+        while position + 12 <= size:
+            length = int.from_bytes(view[position:position + 4], "big")
+            chunk_type = bytes(view[position + 4:position + 8])
+            end = position + 12 + length
+            if end > size:
+                return f"PNG 数据块 {chunk_type.decode('latin-1')} 被截断"
+            if crc and zlib.crc32(view[position + 4:end - 4]) != int.from_bytes(view[end - 4:end], "big"):
+                return f"PNG 数据块 {chunk_type.decode('latin-1')} CRC 校验失败"
+            if chunk_type == b"IEND":
+                return None
+            position = end
+    return "PNG 缺少 IEND"
+
+
+def check_batch(batch, crc=True):
+    """
+    在工作进程中检查一批文件.
+
+    返回:
+        tuple: (文件数, 字节数, [(路径, 损坏原因), ...]).
+    """
+    checked_bytes = 0
+    corrupt = []
+    for path, expected_size in batch:
+        size, reason = check_image(path, expected_size, crc)
+        checked_bytes += size
+        if reason is not None:
+            corrupt.append((path, reason))
+    return len(batch), checked_bytes, corrupt
+
+
+def iter_images(root):
+    """用 os.scandir 递归列出 root 下的图片，跳过以 . 开头的文件和目录以及下载中的 .part 文件。"""
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield entry.path
+        except OSError as e:
+            logger.warning(f"无法列出目录：{e}")
+
+
+def _batches(root, known_pages):
+    batch = []
+    for path in iter_images(root):
+        record = known_pages.get(parse_image_name(path))
+        batch.append((path, record[0] if record else None))
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def verify_library(root, workers=0, crc=True, requeue=True):
+    """
+    扫描 root 下所有图片，返回损坏的文件列表；requeue 为 True 时把损坏的页交给下一次下载.
+
+    参数:
+        root (str): 下载目录.
+        workers (int): 检查进程数，0 为 CPU 核数，1 时在当前进程中检查.
+        crc (bool): 是否校验 PNG 数据块的 CRC.
+        requeue (bool): 是否处理损坏的文件，False 时只报告.
+
+    返回:
+        list: [(路径, 损坏原因), ...].
+    """
+    workers = workers or os.cpu_count() or 1
+    known_pages = manifest.page_records()  # (作品ID, 页码) -> (大小, URL)
+    started = time.perf_counter()
+    files = checked_bytes = 0
+    corrupt = []
+    next_progress = started + PROGRESS_INTERVAL
+
+    batches = _batches(root, known_pages)
+    if workers == 1:
+        results = (check_batch(batch, crc) for batch in batches)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(check_batch, batches, itertools.repeat(crc))
+    try:
+        for batch_files, batch_bytes, batch_corrupt in results:
+            files += batch_files
+            checked_bytes += batch_bytes
+            corrupt.extend(batch_corrupt)
+            now = time.perf_counter()
+            if now >= next_progress:
+                next_progress = now + PROGRESS_INTERVAL
+                logger.info(f"已检查 {files} 个文件（{checked_bytes / (1024 * 1024):.0f} MB），损坏 {len(corrupt)} 个")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"完整性检查完成：{files} 个文件，{checked_bytes / (1024 * 1024):.1f} MB，用时 {elapsed:.2f} 秒"
+                f"（{checked_bytes / (1024 * 1024) / max(elapsed, 1e-9):.1f} MB/秒，{workers} 个进程），"
+                f"损坏 {len(corrupt)} 个")
+    for path, reason in corrupt:
+        logger.warning(f"文件损坏：{path}：{reason}")
+    if requeue and corrupt:
+        requeue_corrupt(corrupt, known_pages)
+    return corrupt
+
+
+def requeue_corrupt(corrupt, known_pages):
+    """
+    把损坏的文件改名为 {文件名}.corrupt 保留下来，并在清单中把该页标记为未完成，下一次同步时重新下载；
+    清单记录了该页的 URL 时同时写入错误日志，设置 retry_failed = True 可以只重新下载这些页.
+    """
+    moved = queued = 0
+    for path, reason in corrupt:
+        try:
+            os.replace(path, f"{path}.corrupt")
+        except OSError as e:
+            logger.error(f"无法移走损坏的文件 {path}：{e}")
+            continue
+        moved += 1
+        manifest.invalidate_page(path)
+        record = known_pages.get(parse_image_name(path))
+        if record and record[1]:
+            parts = Path(path).parts
+            error_journal.record_image(record[1], os.path.splitext(path)[0], path, parts[-3], parts[-2],
+                                       f"完整性检查：{reason}")
+            queued += 1
+    error_journal.close()
+    logger.info(f"已将 {moved} 个损坏的文件改名为 .corrupt，其中 {queued} 个已写入错误日志（retry_failed = True 时只重试这些页），"
+                f"其余在下一次同步时重新下载；重新下载完成后可以删除 .corrupt 文件")
+
+
+def main(argv=None):
+    """main.py verify 子命令，返回退出码：0 为全部完整，2 为发现损坏的文件."""
+    from pdi_config import config
+
+    parser = argparse.ArgumentParser(prog="main.py verify", description="检查下载目录中图片的完整性，损坏的页交给下一次下载")
+    parser.add_argument("path", nargs="?", help="要检查的目录，默认为配置中的下载路径")
+    parser.add_argument("--workers", type=int, default=0, help="检查进程数，默认为 CPU 核数")
+    parser.add_argument("--no-crc", action="store_true", help="不校验 PNG 数据块的 CRC，只读取块头（更快）")
+    parser.add_argument("--dry-run", action="store_true", help="只报告损坏的文件，不做处理")
+    args = parser.parse_args(argv)
+
+    down_path = config.down_path or args.path
+    root = args.path or down_path
+    if not root or not os.path.isdir(root):
+        logger.error(f"下载目录 ({root}) 无效！")
+        return 1
+    manifest_path = config.manifest_path or os.path.join(down_path, ".pdi_manifest.sqlite3")
+    if config.manifest and os.path.exists(manifest_path):
+        manifest.open(manifest_path)
+    error_journal.open("error_journal.jsonl")
+    try:
+        corrupt = verify_library(root, args.workers, crc=not args.no_crc, requeue=not args.dry_run)
+    finally:
+        manifest.close()
+    return 2 if corrupt else 0